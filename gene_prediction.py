@@ -9,6 +9,7 @@ using a custom Python pipeline also included in this repository.
 Requirements:
 	- Python (written for 2.7.x)
 		- BioPython (1.70)
+		- NumPy
 
 	- Exonerate (>2.2)
 
@@ -38,23 +39,52 @@ Maynooth University in 2017-2018 (Charley.McCarthy@nuim.ie).
 
 from __future__ import division
 
-import cStringIO
-import multiprocessing as mp
+import argparse
 import os
-import re
 import shutil
+import socket
 import subprocess as sp
 import sys
+import tempfile
 import time
+import traceback
 from collections import OrderedDict as od
 from csv import reader
 from glob import glob
+from itertools import groupby, izip
+
+import numpy as np
+from Bio import SeqIO
+
+from PanGLOSS.Tools import pairwise, get_gene_lengths, file_checksum, ExonerateFirstHit, unique_records, \
+    locus_sequence_key, BlastLengthMatches
+from PanGLOSS.Jobs import run_jobs
+from PanGLOSS.Resources import token_pool, allocated_cpus
+from PanGLOSS.Prefilter import GenomeIndex, parse_exonerate_windows
+from PanGLOSS.Tiling import shard_genome, batch_proteins, parse_exonerate_tile, best_tile_hits
+from PanGLOSS.Sequence import MappedGenome, RecordIndex, translate_exons
+from PanGLOSS.Features import group_features, sorted_features
+from PanGLOSS.Calls import GeneCalls, EXONERATE, GENEMARK, TRANSDECODER, within_any, count_within
+from PanGLOSS.Reconcile import PRIORITY, reconcile, parse_priority, write_decisions
+from PanGLOSS.Profiling import configure, set_label, stage, profiled
+from PanGLOSS.WorkQueue import WorkQueue
+from PanGLOSS.Compression import open_text, indexable, uncompressed, compress_file
+from PanGLOSS.Search import BACKENDS, get_backend
+from PanGLOSS.ExonerateServer import CLIENTS_PER_SERVER, ExonerateServers, build_index
+from PanGLOSS.Planning import Usage, CostModel, record_metrics, read_metrics, disk_usage, fasta_features, plan
 
-from Bio import SearchIO, SeqIO
+logfile = open("Predictions.log", "a", 0)
+joblog = open("Jobs.log", "a", 0)  # Per-job records for external tools.
 
-from PanGLOSS.Tools import pairwise, get_gene_lengths, exoneratecmdline
+# Buffer size for writing large output files.
+WRITE_BUFFER = 1 << 20
 
-logfile = open("Predictions.log", "a", 0)
+# Per-genome usage of previous runs, for calibrating --plan (see Planning).
+RUN_METRICS = "gene_calling/run_metrics.tsv"
+
+# Cheaper exonerate settings for retrying jobs that time out: a maximum intron of 2 kb (default 200 kb)
+# restricts how far alignments are extended, which is what makes pathological searches expensive.
+EXONERATE_RETRY_ARGS = ["--maxintron", "2000"]
 
 
 ##### Functions for gene prediction via exonerate. #####
@@ -68,7 +98,7 @@ def buildrefset(fasta):
 	"""
     if not os.path.isdir("{0}/reference_proteins".format(os.getcwd())):
         os.makedirs("{0}/reference_proteins".format(os.getcwd()))
-    db = SeqIO.index(fasta, "fasta")
+    db = SeqIO.index(indexable(fasta), "fasta")
     for seq in db:
         SeqIO.write(db[seq], "reference_proteins/{0}.faa".format(db[seq].id),
                     "fasta")
@@ -77,7 +107,7 @@ def buildrefset(fasta):
 
 def buildexontasks(genome, protein_dir):
     """
-	Generate list of exonerate commands to run through multiprocessing.
+	Generate list of exonerate commands to run through run_jobs.
 	"""
     exon_cmds = []
     for prot in glob("{0}/*.faa".format(protein_dir)):
@@ -86,6 +116,63 @@ def buildexontasks(genome, protein_dir):
     return exon_cmds
 
 
+def buildservertasks(targets, protein_dir):
+    """
+	Generate list of exonerate commands against exonerate-server targets (host:port), round-robin.
+	"""
+    exon_cmds = []
+    for index, prot in enumerate(glob("{0}/*.faa".format(protein_dir))):
+        exon_cmds.append(["exonerate", "--model", "protein2genome",
+                          "-t", targets[index % len(targets)], "-q", prot, "--bestn", "1"])
+    return exon_cmds
+
+
+def buildexontiles(genome, protein_dir, shards, batch_size, tile_dir):
+    """
+	Generate list of exonerate commands for (protein batch, contig shard) tiles.
+
+	Shard and batch FASTA files are written to tile_dir, which should be removed
+	once the commands have been run.
+	"""
+    shard_files = shard_genome(genome, shards, tile_dir)
+    batch_files = batch_proteins(protein_dir, batch_size, tile_dir)
+    exon_cmds = []
+    for batch in batch_files:
+        for shard in shard_files:
+            exon_cmds.append(["exonerate", "--model", "protein2genome",
+                              "-t", shard, "-q", batch, "--bestn", "1"])
+    return exon_cmds
+
+
+def buildprefiltertasks(genome, protein_dir, window_dir, fallback=True):
+    """
+	Generate list of exonerate commands against prefiltered genomic windows.
+
+	Builds a six-frame k-mer index of the genome once, and writes the candidate
+	windows of each reference protein to window_dir. Proteins without any
+	candidate windows are searched against the whole genome if fallback is
+	True, otherwise they are skipped.
+	"""
+    index = GenomeIndex(genome)
+    exon_cmds = []
+    skipped = 0
+    for prot in glob("{0}/*.faa".format(protein_dir)):
+        windows = "{0}/{1}.fna".format(window_dir, os.path.basename(prot))
+        if index.write_windows(str(SeqIO.read(prot, "fasta").seq), windows):
+            target = windows
+        elif fallback:
+            target = genome
+            skipped = skipped + 1
+        else:
+            skipped = skipped + 1
+            continue
+        exon_cmds.append(["exonerate", "--model", "protein2genome",
+                          "-t", target, "-q", prot, "--bestn", "1"])
+    logfile.write("{0} reference proteins had no candidate windows in {1} ({2})...\n".format(
+        skipped, genome, "searched whole genome" if fallback else "skipped"))
+    return exon_cmds
+
+
 def check_overlap(gene, ref_lengths):
     if gene:
         longest = max(ref_lengths[gene.ref.split("=")[1]], len(gene.called))
@@ -100,40 +187,87 @@ def check_overlap(gene, ref_lengths):
         return False
 
 
-def run_exonerate(genome, protein_dir, len_dict=None, cores=None):
+def run_exonerate(genome, protein_dir, len_dict=None, cores=None, shards=None, batch_size=1, prefilter=False,
+                  timeout=None, speculate=False, server=False):
     """
-	Farm list of exonerate commands to CPU threads using multiprocessing.
+	Farm list of exonerate commands to CPU threads using run_jobs.
 
 	Returns an unordered list of ExonerateGene instances. Default number of
-	threads = (number of cores on computer - 1).
+	threads = number of CPU tokens allocated to the pipeline (see Resources).
+
+	If shards is given, the genome is split into that many contig shards and
+	reference proteins into batches of batch_size, and each (batch, shard) tile
+	is run as a separate job. The best hit per protein across shards is kept,
+	so results are the same as searching the whole genome.
+
+	If prefilter is True, each reference protein is only searched against
+	candidate windows found using a six-frame k-mer index of the genome (see
+	buildprefiltertasks), and its hit's co-ordinates are lifted back onto the
+	full contig.
+
+	Only one of prefilter, shards and server applies (the pipeline's options
+	for them are mutually exclusive), in that order.
+
+	Jobs running longer than timeout seconds are killed and retried once with
+	cheaper settings, then dropped if they time out again, and stragglers can be
+	re-run speculatively (see Jobs.run_jobs). Per-job records go to Jobs.log.
+
+	If server is True, the genome's exonerate index is built once (and kept in
+	exonerate_index for later runs), and jobs search it through local
+	exonerate-server instances, one per CLIENTS_PER_SERVER CPU tokens, which
+	hold CPU tokens (all but one, at most) while they run.
+
+	Single-protein jobs are read as a stream (see Tools.ExonerateFirstHit) and
+	stopped as soon as their first alignment has arrived.
 	"""
-    exon_cmds = buildexontasks(genome, protein_dir)
-    if not cores:
-        cores = mp.cpu_count() - 1
-    farm = mp.Pool(processes=cores)
-    genes = farm.map(exoneratecmdline, exon_cmds)
-    farm.close()
-    farm.join()
+    jobs = {"processes": cores, "timeout": timeout, "retry_args": EXONERATE_RETRY_ARGS, "speculate": speculate,
+            "joblog": joblog, "log": logfile, "drop": True}
+    if prefilter:
+        window_dir = tempfile.mkdtemp(prefix="exonerate_windows_", dir=os.getcwd())
+        try:
+            exon_cmds = buildprefiltertasks(genome, protein_dir, window_dir)
+            genes = run_jobs(exon_cmds, stream=lambda: ExonerateFirstHit(parse_exonerate_windows), **jobs)
+        finally:
+            shutil.rmtree(window_dir)
+    elif shards:
+        tile_dir = tempfile.mkdtemp(prefix="exonerate_tiles_", dir=os.getcwd())
+        try:
+            exon_cmds = buildexontiles(genome, protein_dir, shards, batch_size, tile_dir)
+            genes = best_tile_hits(run_jobs(exon_cmds, parse_exonerate_tile, **jobs))
+        finally:
+            shutil.rmtree(tile_dir)
+    elif server:
+        esi = build_index(genome, "{0}/exonerate_index".format(os.getcwd()), logfile)
+        count = max(1, (cores or token_pool().tokens) // CLIENTS_PER_SERVER)
+        held = token_pool().try_acquire(min(count, token_pool().tokens - 1))  # Always leave one for the jobs.
+        try:
+            # Only as many servers as tokens held, so servers and jobs stay within the CPU budget.
+            with ExonerateServers(esi, max(1, held), logfile) as servers:
+                logfile.write("Started {0} exonerate-server instances for {1}...\n".format(len(servers.servers),
+                                                                                          genome))
+                exon_cmds = buildservertasks(servers.targets(), protein_dir)
+                genes = run_jobs(exon_cmds, stream=ExonerateFirstHit, **jobs)
+        finally:
+            token_pool().release(held)
+    else:
+        exon_cmds = buildexontasks(genome, protein_dir)
+        genes = run_jobs(exon_cmds, stream=ExonerateFirstHit, **jobs)
     if len_dict:
         return [gene for gene in genes if check_overlap(gene, len_dict)]
     else:
         return [gene for gene in genes if gene]
 
 
-def run_exonerate_for_transdecoder(genome, protein_dir, cores=None):
+def run_exonerate_for_transdecoder(genome, protein_dir, cores=None, timeout=None, speculate=False):
     """
-	Farm list of exonerate commands to CPU threads using multiprocessing.
+	Farm list of exonerate commands to CPU threads using run_jobs.
 
 	Returns an unordered list of ExonerateGene instances. Default number of
-	threads = (number of cores on computer - 1).
+	threads = number of CPU tokens allocated to the pipeline (see Resources).
 	"""
     exon_cmds = buildexontasks(genome, protein_dir)
-    if not cores:
-        cores = mp.cpu_count() - 1
-    farm = mp.Pool(processes=cores)
-    genes = farm.map(exoneratecmdline, exon_cmds)
-    farm.close()
-    farm.join()
+    genes = run_jobs(exon_cmds, stream=ExonerateFirstHit, processes=cores, timeout=timeout,
+                     retry_args=EXONERATE_RETRY_ARGS, speculate=speculate, joblog=joblog, log=logfile, drop=True)
     return [gene for gene in genes if gene]
 
 
@@ -142,57 +276,57 @@ def run_genemark(genome, cores=None):
     """
 	Run GeneMark-ES gene prediction on a genome with multithreading.
 
-	Prediction method uses self-training and a specific fungal model. Also runs
-	(a customized version of) GeneMark's retrevial script to generate protein
-	sequences from GeneMark's own GTF/GFF output. Returns a CSV reader object.
-	Default number of threads = (number of cores on computer - 1).
+	Prediction method uses self-training and a specific fungal model. Returns a
+	CSV reader object of GeneMark's own GTF/GFF output (see write_genemark_proteins
+	for protein sequences). Default number of threads = as many CPU tokens as are
+	free (see Resources).
 	"""
-    if not cores:
-        cores = mp.cpu_count() - 1
-    sp.call(["gmes_petap.pl", "--ES", "--fungus", "--cores", str(cores), "--sequence", genome])
-    sp.call(["get_sequence_from_GTF.pl", "genemark.gtf", genome])
+    with token_pool().cpus(cores or token_pool().tokens) as cpus:
+        sp.call(["gmes_petap.pl", "--ES", "--fungus", "--cores", str(cpus), "--sequence", genome])
     return reader(open("genemark.gtf"), delimiter="\t")
 
 
+def write_genemark_proteins(gtf, genome, tag, out):
+    """
+	Translate the genes predicted by GeneMark-ES and write them to a FASTA file.
+
+	Replaces GeneMark's get_sequence_from_GTF.pl: the GTF is read in a single
+	pass, one gene at a time, and each gene's CDS exons are spliced out of a
+	memory-mapped copy of the genome and translated. Proteins are named with
+	their final IDs (tag|contig_start_stop, see merge_all_calls), using the same
+	gene extents as genemark_gtf_to_attributes.
+	"""
+    mapped_genome = MappedGenome(genome)
+    rows = (row for row in reader(open_text(gtf), delimiter="\t") if len(row) > 8)
+    with open(out, "w") as outfile:
+        for gene_id, gene_rows in groupby(rows, key=lambda row: row[8].split("\"")[1]):
+            gene_rows = list(gene_rows)
+            contig_id = gene_rows[0][0].split(" ")[0]
+            locs = [int(row[column]) for row in gene_rows for column in (3, 4)]
+            cds = sorted((int(row[3]) - 1, int(row[4]), row[7]) for row in gene_rows if row[2] == "CDS")
+            if not cds:
+                continue
+            reverse = gene_rows[0][6] == "-"
+            phase = (cds[-1] if reverse else cds[0])[2]
+            protein = translate_exons(mapped_genome, contig_id, [exon[:2] for exon in cds], reverse,
+                                      int(phase) if phase.isdigit() else 0)
+            outfile.write(">{0}|{1}_{2}_{3}\n{4}\n".format(tag, contig_id, min(locs), max(locs), protein))
+    mapped_genome.close()
+
+
 def genemark_gtf_to_attributes(gtf, tag):
     """
 	Convert a GeneMark-produced GTF/GFF file (which is NOT in a valid format)
 	into an attributes file for easier merging with the predictions from
 	exonerate and TransDecoder downstream.
 
-	Uses a version of a FSM approach to get the correct locations of genes as
-	predicted by GeneMark-ES as well as exon count.
-	"""
-    attributes = []  # List for holding converted attribute info.
-    locs = []
-    exon_count = 0
-    for row, next_row in pairwise(gtf):  # "gtf" will be a CSV.reader object.
-        if next_row is not None:
-            if row[8].split("\"") == next_row[8].split("\""):
-                if row[2] == "exon":
-                    exon_count = exon_count + 1
-                locs = locs + [int(row[3]), int(row[4])]
-            else:
-                if row[2] == "exon":
-                    exon_count = exon_count + 1
-                locs = locs + [int(row[3]), int(row[4])]
-                contig_id = row[0].split(" ")[0]
-                gene_id = row[8].split("\"")[1]
-                annotations = "GeneMark={0};IS=False;Introns={1}".format(gene_id, exon_count - 1)
-                attributes.append([contig_id, gene_id, min(locs), max(locs),
-                                   annotations, tag])
-                locs = []
-                exon_count = 0
-        else:
-            if row[2] == "exon":
-                exon_count = exon_count + 1
-            locs = locs + [int(row[3]), int(row[4])]
-            contig_id = row[0].split(" ")[0]
-            gene_id = row[8].split("\"")[1]
-            annotations = "GeneMark={0};IS=False;Introns={1}".format(gene_id, exon_count - 1)
-            attributes.append([contig_id, gene_id, min(locs), max(locs),
-                               annotations, tag])
-    return sorted(attributes, key=lambda x: (x[0], int(x[2])))
+	Rows are reduced to one record per gene (location and exon count) as they
+	are read, and genes are yielded in (contig, start) order (see Features).
+	"""
+    genes = group_features(gtf, lambda row: row[8].split("\"")[1])  # "gtf" will be a CSV.reader object.
+    for gene in sorted_features(genes):
+        annotations = "GeneMark={0};IS=False;Introns={1}".format(gene.id, gene.exons - 1)
+        yield [gene.contig, gene.id, gene.start, gene.end, annotations, tag]
 
 
 # For locs, we assume lowest value is start, highest is stop.
@@ -229,95 +363,50 @@ def genemark_folder_handler(genome, to_move):
 def write_gene_calls(ordered_exonerate_genes, genemark_genes, tag):
     """
 	Write gene calls from exonerate and GeneMark-ES to files.
+
+	Exonerate proteins are written to FASTA, and the calls from both sources
+	are saved as GeneCalls stores (see Calls), which are also returned.
 	"""
-    with open("{0}/gene_calling/{1}/{1}_exonerate.txt".format(os.getcwd(), tag), "w") as outfile, open(
-            "{0}/gene_calling/{1}/{1}_exonerate.faa".format(os.getcwd(), tag), "w") as outfaa:
+    exonerate_rows = []
+    with open("{0}/gene_calling/{1}/{1}_exonerate.faa".format(os.getcwd(), tag), "w") as outfaa:
         for gene in ordered_exonerate_genes:
-            outfile.write("{0}\t{1}|{2}\t{3}\t{4}\t{5}\t{1}\n".format(gene.contig_id, tag,
-                                                                      gene.id, gene.locs[0], gene.locs[1],
-                                                                      ";".join([gene.ref, str(gene.internal_stop),
-                                                                                str(gene.introns)])))
+            exonerate_rows.append([gene.contig_id, "{0}|{1}".format(tag, gene.id), gene.locs[0], gene.locs[1],
+                                   ";".join([gene.ref, str(gene.internal_stop), str(gene.introns)])])
             outfaa.write(">{0}|{1}\n{2}\n".format(tag, gene.id, gene.called))
-    with open("{0}/gene_calling/{1}/{1}_genemark.txt".format(os.getcwd(), tag), "w") as outfile:
-        genemark_attributes = genemark_gtf_to_attributes(genemark_genes, tag)
-        for line in genemark_attributes:
-            outfile.write("\t".join([str(column) for column in line]) + "\n")
+    exonerate_calls = GeneCalls.from_rows(exonerate_rows, tag)
+    exonerate_calls.save("{0}/gene_calling/{1}/{1}_exonerate.npz".format(os.getcwd(), tag))
+    with stage("genemark_gtf_to_attributes"):
+        genemark_calls = GeneCalls.from_rows(genemark_gtf_to_attributes(genemark_genes, tag), tag)
+    genemark_calls.save("{0}/gene_calling/{1}/{1}_genemark.npz".format(os.getcwd(), tag))
+    return exonerate_calls, genemark_calls
 
 
 ##### Functions for merging exonerate and GeneMark-ES gene calls. ######
-def call_overlap(a, l):
-    """
-	Check overlapping co-ordinates for calls via exonerate vs. GeneMark-ES.
-	"""
-    for b in map(lambda x: (int(x[1]), int(x[2])), l):
-        if int(a[0]) <= b[0] <= int(a[1]):
-            return True
-        elif int(a[0]) <= b[1] <= int(a[1]):
-            return True
-        else:
-            for coord in a:
-                if b[0] <= int(coord) <= b[1]:
-                    return True
-                elif b[0] <= int(coord) - 20 <= b[1]:
-                    return True
-                elif b[0] <= int(coord) + 20 <= b[1]:
-                    return True
-
-
-def get_unique_calls(exonerate_output, genemark_output):
+@profiled("get_unique_calls")
+def get_unique_calls(exonerate_calls, genemark_calls, slop=20):
     """
 	Return genes called via GeneMark-ES that do not overlap with the
 	co-ordinates of genes called via exonerate.
+
+	A GeneMark-ES call overlaps if an exonerate call starts or ends within it,
+	or if either of its ends (or either end +/- slop) lies within an exonerate
+	call. Safest to do this on a per-chromosome basis: only GeneMark-ES calls on
+	contigs with exonerate calls are considered.
 	"""
-    unique_calls = []
-    exonerate_csv = reader(open(exonerate_output), delimiter="\t")
-    exonerate_dict = {}
-    for row in exonerate_csv:
-        if row[0] not in exonerate_dict.keys():
-            exonerate_dict[row[0]] = [row[1:]]
-        else:
-            exonerate_dict[row[0]].append(row[1:])
-    genemark_csv = reader(open(genemark_output), delimiter="\t")
-    for row in genemark_csv:  # Safest to do this on a per-chromosome basis.
-        if row[0] in exonerate_dict.keys():
-            if call_overlap((row[2], row[3]), exonerate_dict[row[0]]):
-                pass
-            else:
-                unique_calls.append(row)
-    return unique_calls
-
-
-def strip_duplicates(gtf):
-    """
-	Remove gene calls with duplicated locations.
-
-	Tends to effect exonerate calls moreso than GeneMark-ES calls. Necessary
-	because PanOCT can't handle duplicate locations (i.e. isoforms).
-	"""
-    stripped = []
-    for line, next_line in pairwise(gtf):
-        if next_line is not None:
-            if int(line[2]) == int(next_line[2]):
-                # If gene has identical start.
-                pass
-            elif int(line[3]) == int(next_line[3]):
-                # If gene has identical end (does this happen?).
-                pass
-            elif int(next_line[2]) <= int(line[2]) <= int(next_line[3]):
-                # If gene starts within next gene.
-                pass
-            elif int(next_line[2]) <= int(line[3]) <= int(next_line[3]):
-                # If gene ends within next gene.
-                pass
-            elif int(next_line[3]) <= int(line[3]):
-                # If gene overlaps with entirety of next gene.
-                pass
-            else:
-                stripped.append(line)
-        else:
-            if line not in stripped:
-                stripped.append(line)
-    return stripped
+    unique = np.zeros(len(genemark_calls), dtype=bool)
+    for code, contig_id in enumerate(genemark_calls.contigs):
+        if contig_id not in exonerate_calls.contigs:
+            continue
+        genemark = np.flatnonzero(genemark_calls.contig == code)
+        exonerate = exonerate_calls.contig == np.searchsorted(exonerate_calls.contigs, contig_id)
+        starts, ends = exonerate_calls.start[exonerate], exonerate_calls.end[exonerate]
+        left, right = genemark_calls.start[genemark], genemark_calls.end[genemark]
+        overlap = (count_within(starts, left, right) > 0) | (count_within(ends, left, right) > 0)
+        for coord in (left, right):
+            for offset in (0, -slop, slop):
+                overlap |= within_any(starts, ends, coord + offset)
+        unique[genemark[~overlap]] = True
+    return genemark_calls.select(unique)
 
 
 ##### Functions for predicting remaining genes using TransDecoder. ######
@@ -345,7 +434,7 @@ def get_noncoding_regions(seq_name, seq, list_of_coords):
     return ncr
 
 
-def run_transdecoder(genome, combined_output, tag):
+def run_transdecoder(genome, combined_calls, tag):
     """
 	Predict potential protein-coding ORFs from non-coding regions (NCR) using TransDecoder.
 
@@ -353,52 +442,38 @@ def run_transdecoder(genome, combined_output, tag):
 	not associated with any gene called either by exonerate or GeneMark. These
 	regions are then run through TransDecoder, which predicts the longest "ORF"
 	per region and then assesses whether it is coding or not.
+
+	combined_calls are the exonerate/GeneMark calls as a GeneCalls store, sorted
+	by (contig, start).
 	"""
     full_genome = SeqIO.index(genome, "fasta")
-    combined_csv = reader(open(combined_output), delimiter="\t")
-    combined_dict = {}
-    noncoding = []
-    for row in combined_csv:
-        if row[0] not in combined_dict.keys():
-            combined_dict[row[0]] = [row[1:]]
-        else:
-            combined_dict[row[0]].append(row[1:])
-    for seq in full_genome:
-        if seq in combined_dict.keys():
-            known_coords = map(lambda x: (int(x[1]), int(x[2])), combined_dict[seq])
-            noncoding = noncoding + get_noncoding_regions(seq, full_genome[seq], known_coords)
-    with open("{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), tag), "w") as outncr:
-        for line in noncoding:
-            outncr.write(line)
-    sp.call(["TransDecoder.LongOrfs", "-t", "{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), tag)])
-    sp.call(["TransDecoder.Predict", "-t", "{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), tag)])
+    contig_slices = dict(combined_calls.contig_slices())
+    with stage("noncoding_regions"), \
+            open("{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), tag), "w") as outncr:
+        for seq in full_genome:
+            if seq in contig_slices:
+                known_coords = zip(combined_calls.start[contig_slices[seq]].tolist(),
+                                   combined_calls.end[contig_slices[seq]].tolist())
+                for line in get_noncoding_regions(seq, full_genome[seq], known_coords):
+                    outncr.write(line)
+    with token_pool().cpus():
+        sp.call(["TransDecoder.LongOrfs", "-t", "{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), tag)])
+        sp.call(["TransDecoder.Predict", "-t", "{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), tag)])
 
 
 def transdecoder_gtf_to_attributes(feature_file, tag):
     """
 	Convert a TransDecoder-produced GTF/GFF file into an attributes list for
 	merging with exonerate and GeneMark-ES attributes.
+
+	Each gene's block of rows starts with its "gene" row, which carries its ID.
+	Genes are yielded in (contig, start) order (see Features).
 	"""
-    attributes = []  # List for holding converted attribute info.
-    exon_count = 0
-    contig_id = ""
-    gtf = reader(open(feature_file), delimiter="\t")
-    for row, next_row in pairwise(gtf):
-        if len(row) == 9:
-            if row[2] == "gene":
-                gene_id = row[8].split(";")[0].split("~")[2]
-                contig_id = row[0]
-                locs = (row[3], row[4])
-            if row[2] == "exon":
-                exon_count = exon_count + 1
-            if not next_row:
-                annotations = "TransDecoder={0};IS=False;Introns={1}".format(gene_id, exon_count - 1)
-                attributes.append([contig_id, gene_id, min(locs), max(locs),
-                                   annotations, tag])
-                exon_count = 0
-        else:
-            pass
-    return sorted(attributes, key=lambda x: (x[0], int(x[2])))
+    gtf = reader(open_text(feature_file), delimiter="\t")
+    genes = group_features(gtf, lambda row: row[8].split(";")[0].split("~")[2] if row[2] == "gene" else None)
+    for gene in sorted_features(genes):
+        annotations = "TransDecoder={0};IS=False;Introns={1}".format(gene.id, gene.exons - 1)
+        yield [gene.contig, gene.id, str(gene.start), str(gene.end), annotations, tag]
 
 
 # For locs, we assume lowest value is start, highest is stop.
@@ -430,79 +505,119 @@ def realign_orfs(genome, tag):
 	a putative ORF's top exonerate hit is not within the original ORF's co-ordinates,
 	or on a different contig, the ORF is discarded (it's probably poor quality anyway).
 	"""
-    realigned_orfs = run_exonerate_for_transdecoder(genome, "{0}/gene_calling/{1}/temp_retained_orfs".format(os.getcwd(), tag))
-    with open("{0}/gene_calling/{1}/{1}_transdecoder.txt".format(os.getcwd(), tag), "w") as outfile, open(
-            "{0}/gene_calling/{1}/{1}_transdecoder.faa".format(os.getcwd(), tag), "w") as outfaa:
-        for gene in realigned_orfs:
+    realigned_orfs = run_exonerate_for_transdecoder(genome, "{0}/gene_calling/{1}/temp_retained_orfs".format(os.getcwd(), tag),
+                                                    timeout=args.exonerate_timeout, speculate=args.speculate)
+    transdecoder_rows = []
+    with open("{0}/gene_calling/{1}/{1}_transdecoder.faa".format(os.getcwd(), tag), "w") as outfaa:
+        for gene in sorted(realigned_orfs, key=lambda x: (x.contig_id, x.locs[0])):
             original_contig = gene.ref.split("=")[1].split("_")[0]
             if gene.contig_id == original_contig:  # If realigned ORF is on same contig as TransDecoder's call.
-                outfile.write("{0}\t{1}|{2}\t{3}\t{4}\t{5}\t{1}\n".format(gene.contig_id, tag,
-                                                                          gene.id, gene.locs[0], gene.locs[1],
-                                                                          ";".join(["TransDecoder={0}".format(
-                                                                              gene.ref.split("=")[1]),
-                                                                                    str(gene.internal_stop),
-                                                                                    str(gene.introns)])))
+                transdecoder_rows.append([gene.contig_id, "{0}|{1}".format(tag, gene.id), gene.locs[0], gene.locs[1],
+                                          ";".join(["TransDecoder={0}".format(gene.ref.split("=")[1]),
+                                                    str(gene.internal_stop), str(gene.introns)])])
                 outfaa.write(">{0}|{1}\n{2}\n".format(tag, gene.id, gene.called))
+    GeneCalls.from_rows(transdecoder_rows, tag).save(
+        "{0}/gene_calling/{1}/{1}_transdecoder.npz".format(os.getcwd(), tag))
 
 
-def remove_dubious_orfs(predicted_orfs, dubious_orf_faa):
+def dubious_orf_database(dubious_orf_faa, backend):
+    """
+	Return a search database (see Search) of dubious ORFs, building it if needed.
+
+	Databases are kept in dubious_orf_db/<checksum of the FASTA file>, so one
+	database is built per version of dubious_orfs.faa and reused by every
+	strain (and by later runs). Databases are built in a temporary directory
+	and then renamed into place, so concurrent runs never see a partial one.
+	Backends other than blastp get a _<backend> suffix.
+	"""
+    db_dir = "{0}/dubious_orf_db/{1}".format(os.getcwd(), file_checksum(dubious_orf_faa))
+    if backend.name != "blastp":
+        db_dir = "{0}_{1}".format(db_dir, backend.name)
+    if not os.path.isdir(db_dir):
+        try:
+            os.makedirs(os.path.dirname(db_dir))
+        except OSError as e:
+            if e.errno != os.errno.EEXIST:
+                raise
+        temp_dir = tempfile.mkdtemp(dir=os.path.dirname(db_dir))
+        with token_pool().cpus():
+            backend.build_db(dubious_orf_faa, "{0}/dubious_orfs".format(temp_dir), logfile)
+        try:
+            os.rename(temp_dir, db_dir)
+        except OSError:
+            shutil.rmtree(temp_dir)  # Another run built the same database first.
+    return backend.db_name("{0}/dubious_orfs".format(db_dir))
+
+
+def remove_dubious_orfs(predicted_orfs, dubious_orf_faa, min_ratio=0.7, search="blastp"):
     """
 	If dubious_orfs.faa is present, BLAST against TransDecoder ORFs.
 
 	Such a file is available for Saccharomyces cerevisiae (via SGD), but
 	IDK if that's the case for everything (e.g. it isn't for Aspergillus).
+
+	The ORFs are split into one shard per CPU token and BLASTed in parallel
+	against a cached database (see dubious_orf_database), with tabular output
+	streamed into a set of ORFs whose hit is at least min_ratio of their length
+	(or vice versa). search selects the search backend (see Search.BACKENDS).
 	"""
-    remove = []
-    keep = []
-    sp.call(["makeblastdb", "-in", dubious_orf_faa, "-dbtype", "prot"])
-    process = sp.check_output(["blastp", "-query", predicted_orfs, "-db",
-                               dubious_orf_faa, "-evalue", "0.0001", "-num_alignments", "1"])
-    for query in SearchIO.parse(cStringIO.StringIO(process), "blast-text"):
-        for subject in query:
-            lens = (subject.seq_len, query.seq_len)
-            if (min(lens) / max(lens)) >= 0.7:
-                remove.append(query.id.split("\n")[0])
-    logfile.write("{0} dubious ORFS identified...".format(len(remove)))
+    backend = get_backend(search)
+    db = dubious_orf_database(dubious_orf_faa, backend)
+    shard_dir = tempfile.mkdtemp(prefix="dubious_orfs_", dir=os.getcwd())
+    try:
+        shards = token_pool().tokens
+        handles = [open("{0}/shard{1}.faa".format(shard_dir, shard), "w") for shard in range(shards)]
+        counts = [0] * shards
+        for index, seq in enumerate(SeqIO.parse(predicted_orfs, "fasta")):
+            SeqIO.write(seq, handles[index % shards], "fasta")
+            counts[index % shards] = counts[index % shards] + 1
+        blast_cmds = []
+        for handle, count in zip(handles, counts):
+            handle.close()
+            if count:
+                blast_cmds.append(backend.command(handle.name, db, fields=["qseqid", "sseqid", "qlen", "slen"],
+                                                  max_evalue=0.0001, max_targets=1))
+        remove = set()
+        for matches in run_jobs(blast_cmds, stream=lambda: BlastLengthMatches(min_ratio), joblog=joblog,
+                                log=logfile, threads_arg=backend.threads_arg):
+            remove.update(matches)
+    finally:
+        shutil.rmtree(shard_dir)
+    logfile.write("{0} dubious ORFS identified...\n".format(len(remove)))
     with open("{0}.not_dubious".format(predicted_orfs), "w") as outfile:
-        for seq in SeqIO.parse(predicted_orfs, "fasta"):
-            if seq.id in remove:
-                pass
-            else:
-                keep.append(seq)
-        SeqIO.write(keep, outfile, "fasta")
+        SeqIO.write((seq for seq in SeqIO.parse(predicted_orfs, "fasta") if seq.id not in remove), outfile, "fasta")
     # We need to have the seq.descriptions in this file for filter_transdecoder_calls to work!
 
 
-def filter_transdecoder_calls(tag):
+def filter_transdecoder_calls(tag, min_score=100, min_length=200):
     """
 	Align TransDecoder reads back to your genome and filter based on coding score/ORF length.
+
+	ORFs are filtered with array masks over a RecordIndex of the .pep file
+	(IDs, scores and lengths from one pass over it), which is cached next to it
+	so that different thresholds can be re-applied without reparsing. Retained
+	ORFs are copied from the .pep file by offset.
 	"""
-    attributes = transdecoder_gtf_to_attributes(
-        "{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.gff3".format(os.getcwd(), tag), tag)
-    if os.path.isfile("{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.pep.not_dubious".format(
-            os.getcwd(), tag)):
-        orf_index = SeqIO.index(
-            "{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.pep.not_dubious".format(
-                os.getcwd(), tag), "fasta")
+    attributes = list(transdecoder_gtf_to_attributes(
+        "{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.gff3".format(os.getcwd(), tag), tag))
+    orfs = "{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.pep".format(os.getcwd(), tag)
+    if os.path.isfile("{0}.not_dubious".format(orfs)):
+        orfs = "{0}.not_dubious".format(orfs)
+    if os.path.isfile("{0}.index.npz".format(orfs)) and os.path.getmtime("{0}.index.npz".format(orfs)) >= \
+            os.path.getmtime(orfs):
+        orf_index = RecordIndex.load("{0}.index.npz".format(orfs))
     else:
-        orf_index = SeqIO.index(
-            "{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.pep".format(os.getcwd(), tag),
-            "fasta")
-    retained_attributes = []
-    retained_seqs = []
-    for attribute in attributes:
-        if attribute[1] in orf_index.keys():
-            score_match = re.search("(score=.*) ", orf_index[attribute[1]].description)
-            seq_score = float(score_match.group().strip(" ").split("=")[1])
-            if all([seq_score >= 100, len(orf_index[attribute[1]]) >= 200]):
-                retained_seqs.append(orf_index[attribute[1]])
-                retained_attributes.append(attribute)
-    with open("{0}/gene_calling/{1}/transdecoder_output/{1}_retained_orfs.txt".format(os.getcwd(), tag), "w") as outatt:
-        for line in retained_attributes:
-            outatt.write("\t".join(col for col in line) + "\n")
-    with open("{0}/gene_calling/{1}/transdecoder_output/{1}_retained_orfs.faa".format(os.getcwd(), tag), "w") as outfaa:
-        for seq in retained_seqs:
-            outfaa.write(">{0}\n{1}\n".format(seq.id, seq.seq))
+        orf_index = RecordIndex.build(orfs)
+        orf_index.save("{0}.index.npz".format(orfs))
+    retained = (orf_index.scores >= min_score) & (orf_index.lengths >= min_length)
+    retained_ids = set(orf_index.ids[retained].tolist())
+    retained_attributes = [attribute for attribute in attributes if attribute[1] in retained_ids]
+    called = np.in1d(orf_index.ids, [attribute[1] for attribute in attributes])
+    GeneCalls.from_rows(retained_attributes, tag).save(
+        "{0}/gene_calling/{1}/transdecoder_output/{1}_retained_orfs.npz".format(os.getcwd(), tag))
+    with open("{0}/gene_calling/{1}/transdecoder_output/{1}_retained_orfs.faa".format(os.getcwd(), tag), "w",
+              WRITE_BUFFER) as outfaa:
+        orf_index.copy_records(orfs, retained & called, outfaa)
 
 
 def transdecoder_folder_handler(genome):
@@ -534,25 +649,21 @@ def transdecoder_folder_handler(genome):
 
 
 ##### Final functions! #####
-def remove_duplicates(calls, tag, out_suffix):
+def remove_duplicates(calls, tag, out_suffix, by_sequence=False):
     """
 	Remove duplicate proteins from exonerate and TransDecoder predictions.
 
 	Basic reason for this is that SeqIO.index can't handle duplicated sequence
-	IDs, and PanOCT won't like it either.
-	"""
-    ids = []
-    unique = []
-    for seq in SeqIO.parse(calls, "fasta"):
-        if seq.id not in ids:
-            ids.append(seq.id)
-            unique.append(seq)
-        else:
-            pass
+	IDs, and PanOCT won't like it either. Proteins are written as they are read
+	(see Tools.unique_records). If by_sequence is True, identical sequences at
+	identical loci are also collapsed.
+	"""
     with open("{0}/gene_calling/{1}/{1}_{2}".format(os.getcwd(), tag, out_suffix), "w") as outfaa:
-        SeqIO.write(unique, outfaa, "fasta")
+        SeqIO.write(unique_records(SeqIO.parse(calls, "fasta"), locus_sequence_key if by_sequence else None),
+                    outfaa, "fasta")
 
 
+@profiled("merge_all_calls")
 def merge_all_calls(tag):
     """
 	Et voila! Kinda messy.
@@ -560,118 +671,306 @@ def merge_all_calls(tag):
 	Note: for TransDecoder calls, because their genomic locations get recalibrated
 	in exonerating them back to the genome, the final gene IDs and locations may
 	vary slightly from the original IDs and locations as assigned by TransDecoder.
+	Realigned TransDecoder calls can therefore overlap exonerate/GeneMark calls,
+	so all calls are reconciled once more (see Reconcile) before writing.
+
+	Both call stores are already sorted by (contig, start), so they are merged
+	rather than re-sorted, and proteins are copied from memory-mapped FASTA files
+	(see Sequence.MappedGenome) rather than parsed via SeqIO.index.
+	"""
+    sequences = {EXONERATE: MappedGenome("{0}/gene_calling/{1}/{1}_exonerate_unique.faa".format(os.getcwd(), tag)),
+                 GENEMARK: MappedGenome("{0}/gene_calling/{1}/genemark_output/prot_seq.faa".format(os.getcwd(), tag)),
+                 TRANSDECODER: MappedGenome("{0}/gene_calling/{1}/{1}_transdecoder_unique.faa".format(os.getcwd(),
+                                                                                                      tag))}
+    calls = GeneCalls.merge([GeneCalls.load("{0}/gene_calling/{1}/{1}_exon_gm.npz".format(os.getcwd(), tag)),
+                             GeneCalls.load("{0}/gene_calling/{1}/{1}_transdecoder.npz".format(os.getcwd(), tag))])
+    calls, decisions = reconcile(calls, args.priority, presorted=True)
+    write_decisions(decisions, "{0}/gene_calling/{1}/{1}_reconciliation.txt".format(os.getcwd(), tag), append=True)
+    final_ids = calls.final_ids()
+    # GeneMark-ES proteins are already named by final ID, the others by their call ID.
+    lookup_ids = np.where(calls.source == GENEMARK, final_ids, calls.ids.astype(object))
+    with open("{0}/gene_calling/{1}/{1}.faa".format(os.getcwd(), tag), "w", WRITE_BUFFER) as final_faa:
+        for final_id, source, lookup_id in izip(final_ids, calls.source, lookup_ids):
+            final_faa.write(">{0}\n{1}\n".format(final_id, sequences[source].sequence(lookup_id)))
+    for mapped in sequences.values():
+        mapped.close()
+    # Attributes for PanOCT are the only TSV written.
+    calls.write_tsv("{0}/gene_calling/{1}/{1}_attributes.txt".format(os.getcwd(), tag), final_ids)
+
+
+##### Functions for incremental runs. #####
+def prediction_checksum(genome):
+    """
+	Return a checksum of the inputs that determine a genome's gene calls.
+
+	Covers both the genome itself and the reference protein set, so a strain
+	is only considered unchanged if neither has been modified since its last
+	completed prediction.
+	"""
+    return "{0}\t{1}".format(file_checksum(genome), file_checksum(proteins))
+
+
+def prediction_is_current(genome, tag):
+    """
+	Check whether a genome already has complete, up-to-date gene calls.
+
+	A genome is up to date if its final protein set and attributes file exist
+	and the checksum recorded when they were written matches its current inputs.
+	Outputs of runs from before checksums were recorded have no checksum file;
+	they're up to date if they're newer than the genome and reference proteins,
+	and their checksum is recorded then, so later runs compare checksums.
+	"""
+    outputs = ["{0}/gene_calling/{1}/{1}.faa".format(os.getcwd(), tag),
+               "{0}/gene_calling/{1}/{1}_attributes.txt".format(os.getcwd(), tag)]
+    checksum = "{0}/gene_calling/{1}/{1}.checksum".format(os.getcwd(), tag)
+    if not all(os.path.isfile(f) for f in outputs):
+        return False
+    if os.path.isfile(checksum):
+        with open(checksum) as infile:
+            current = infile.read().strip("\n") == prediction_checksum(genome)
+        logfile.write("Gene calls for {0} checked by input checksum: {1}.\n".format(
+            tag, "unchanged" if current else "changed"))
+        return current
+    current = min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(genome), os.path.getmtime(proteins))
+    logfile.write("Gene calls for {0} have no input checksum, checked by modification time: {1}.\n".format(
+        tag, "newer than inputs" if current else "older than inputs"))
+    if current:
+        record_prediction(genome, tag)
+    return current
+
+
+def record_prediction(genome, tag):
+    """
+	Record the checksum of a genome's inputs once its gene calls are complete.
+	"""
+    with open("{0}/gene_calling/{1}/{1}.checksum".format(os.getcwd(), tag), "w") as outfile:
+        outfile.write(prediction_checksum(genome) + "\n")
+
+
+##### Distributed prediction. #####
+def enter_worker_directory():
+    """
+	Move into a private working directory for this worker.
+
+	GeneMark-ES and TransDecoder write to the current directory, so workers
+	sharing one would overwrite each other's files. Each worker runs in
+	workers/<host>_<pid>, with links to the shared gene_calling and
+	reference_proteins directories, so output still ends up in the shared
+	directory. The dubious ORF and exonerate index caches are linked too, so
+	workers build them once between them, and so is dubious_orfs.faa, so
+	workers screen ORFs exactly as a single run does.
 	"""
-    exonerate_index = SeqIO.index("{0}/gene_calling/{1}/{1}_exonerate_unique.faa".format(os.getcwd(), tag), "fasta")
-    genemark_index = SeqIO.index("{0}/gene_calling/{1}/genemark_output/prot_seq.faa".format(os.getcwd(), tag), "fasta")
-    transdecoder_index = SeqIO.index("{0}/gene_calling/{1}/{1}_transdecoder_unique.faa".format(os.getcwd(), tag),
-                                     "fasta")
-    final_faa = open("{0}/gene_calling/{1}/{1}.faa".format(os.getcwd(), tag), "w")
-    final_attributes = open("{0}/gene_calling/{1}/{1}_attributes.txt".format(os.getcwd(), tag), "w")
-    all_attributes = [line.strip("\n").split("\t") for line in
-                      open("{0}/gene_calling/{1}/{1}_exon_gm.txt".format(os.getcwd(), tag))]
-    for line in open("{0}/gene_calling/{1}/{1}_transdecoder.txt".format(os.getcwd(), tag)):
-        all_attributes.append(line.strip("\n").split("\t"))
-    sorted_attributes = sorted(all_attributes, key=lambda x: (x[0], int(x[2])))
-    for line in sorted_attributes:
-        if line[4].startswith("Exonerate"):
-            seq = line[1]
-            final_faa.write(">{0}\n{1}\n".format(exonerate_index[seq].id, exonerate_index[seq].seq))
-            final_attributes.write("\t".join(row for row in line) + "\n")
-        elif line[4].startswith("GeneMark"):
-            seq = line[1]
-            new_line = line
-            new_line[1] = "{0}|{1}_{2}_{3}".format(tag, line[0], line[2], line[3])
-            final_faa.write(">{0}\n{1}\n".format(new_line[1], genemark_index[seq].seq))
-            final_attributes.write("\t".join(row for row in new_line) + "\n")
-        elif line[4].startswith("TransDecoder"):
-            seq = line[1]
-            new_line = line
-            new_line[1] = "{0}|{1}_{2}_{3}".format(tag, line[0], line[2], line[3])
-            final_faa.write(">{0}\n{1}\n".format(new_line[1], transdecoder_index[seq].seq))
-            final_attributes.write("\t".join(row for row in new_line) + "\n")
+    shared = os.getcwd()
+    private = "{0}/workers/{1}_{2}".format(shared, socket.gethostname(), os.getpid())
+    os.makedirs(private)
+    for directory in ["gene_calling", "reference_proteins", "dubious_orf_db", "exonerate_index"]:
+        try:
+            os.makedirs("{0}/{1}".format(shared, directory))
+        except OSError as e:
+            if e.errno != os.errno.EEXIST:
+                raise
+        os.symlink("{0}/{1}".format(shared, directory), "{0}/{1}".format(private, directory))
+    if os.path.isfile("{0}/dubious_orfs.faa".format(shared)):
+        os.symlink("{0}/dubious_orfs.faa".format(shared), "{0}/dubious_orfs.faa".format(private))
+    os.chdir(private)
+
+
+def run_worker(genomes, ref_lengths, queue):
+    """
+	Predict genes for genomes claimed from a work queue shared with other workers.
+
+	Workers claim one genome at a time, so any number of them (e.g. a PBS array
+	job, or processes on several hosts) can be started on the same working
+	directory. Failed genomes are recorded and retried by any worker.
+	"""
+    tags = od((tag, genome) for genome, tag in genomes.items())
+    enter_worker_directory()
+    for genome_tag in queue.claims(tags):
+        genome = tags[genome_tag]
+        if args.incremental and prediction_is_current(genome, genome_tag):
+            logfile.write("Gene calls for {0} are up to date, skipping...\n".format(genome_tag))
+            queue.complete(genome_tag)
+            continue
+        try:
+            predict_genome(genome, genome_tag, ref_lengths)
+        except Exception:
+            logfile.write("Gene prediction for {0} failed on {1}:\n{2}".format(genome_tag, queue.worker,
+                                                                             traceback.format_exc()))
+            queue.fail(genome_tag, traceback.format_exc().splitlines()[-1])
+            continue
+        queue.complete(genome_tag)
+
+
+def plan_predictions(genomes, proteins, cores, max_walltime):
+    """
+	Print predicted CPU time, memory and disk usage, and PBS resources, for predicting genes for genomes.
+
+	Only reads the genomes and reference proteins. Predictions are calibrated
+	against the usage recorded for genomes of previous runs in this directory
+	(see Planning), if there are any.
+	"""
+    ref_proteins, ref_residues = fasta_features(proteins, open_text)
+    units = []
+    for genome, tag in genomes.items():
+        contigs, genome_bp = fasta_features(genome, open_text)
+        units.append((tag, {"genome_bp": genome_bp, "contigs": contigs, "ref_proteins": ref_proteins,
+                            "ref_residues": ref_residues}))
+    model = CostModel("gene_prediction", read_metrics(RUN_METRICS, "gene_prediction"))
+    sys.stdout.write("{0} genomes ({1} bp in {2} contigs), {3} reference proteins ({4} residues).\n".format(
+        len(units), sum(features["genome_bp"] for _, features in units),
+        sum(features["contigs"] for _, features in units), ref_proteins, ref_residues))
+    sys.stdout.write(plan(model, units, cores, max_walltime))
+
+
+def check_predictions(genomes, queue):
+    """
+	Check that every genome has complete, up-to-date gene calls, e.g. after all workers have finished.
+
+	Returns whether all genomes are complete, logging any that aren't.
+	"""
+    incomplete = [(genome, tag) for genome, tag in genomes.items() if not prediction_is_current(genome, tag)]
+    for genome, tag in incomplete:
+        logfile.write("Gene calls for {0} ({1}) are incomplete (queue status: {2}).\n".format(tag, genome,
+                                                                                            queue.status(tag)))
+    logfile.write("{0} of {1} genomes have complete gene calls.\n".format(len(genomes) - len(incomplete),
+                                                                        len(genomes)))
+    return not incomplete
 
 
 ##### Main. #####
-def main():
+def predict_genome(genome, genome_tag, ref_lengths):
     """
-	Main workflow of gene prediction per genome.
+	Predict gene models for a single genome.
 
-		1.  Create master gene_calling folder (outside of per genome loop).
-		2.  Generate dictionary list of genes from genome/tag list file (ditto).
-		3.  Call genes in genome based on homology to reference genes using exonerate.
-		4.  Call genes using self-trained branching HMM analysis with GeneMark-ES.
-		5.  Write output from exonerate and GeneMark-ES into PanOCT-compatible format.
-		6.  Clean up output from GeneMark-ES (compress it in future maybe?).
-		7.  Identify genes called by GeneMark that are non-overlapping relative to exonerate.
-		8.  Remove gene calls from this combined prediction that have duplicated locations.
-		9.  Call potential ORFs in (still) non-coding regions of genome using TransDecoder.
-		10. Filter out dubious ORFs and filter remainder based on sequence length and coding potenital.
-		10. Merge unique TransDecoder calls with exonerate/GeneMark-ES calls.
-		11. Write unified protein set file and attributes file.
+	See main for the individual steps. Compressed genomes are decompressed to
+	node-local scratch for the external tools (see Compression.uncompressed).
 	"""
+    genome_time = time.time()
+    usage = Usage()
+    set_label(genome_tag)
+    logfile.write("Predicting genes for {0}...\n".format(genome))
+    fasta = uncompressed(genome)
     try:
-        os.makedirs("{0}/gene_calling".format(os.getcwd()))
-    except OSError as e:
-        if e.errno != os.errno.EEXIST:
-            raise
-    genomes = od()
-    if not os.path.isdir("{0}/reference_proteins".format(os.getcwd())):
-        os.makedirs("{0}/reference_proteins".format(os.getcwd()))
-        buildrefset(proteins)
-    else:
-        pass
-    ref_lengths = get_gene_lengths(proteins)
-    for line in open(genomes_list):
-        genomes[line.split("\t")[1].strip("\n")] = line.split("\t")[0]
-    for genome in genomes.keys():
-        genome_time = time.time()
-        logfile.write("Predicting genes for {0}...\n".format(genome))
-        genome_tag = genomes[genome]
         try:
             os.makedirs("{0}/gene_calling/{1}".format(os.getcwd(), genome_tag))
         except OSError as e:
             if e.errno != os.errno.EEXIST:
                 raise
         logfile.write("Exonerating reference genes against {0}...\n".format(genome))
-        exonerate_genes = run_exonerate(genome, "reference_proteins", ref_lengths)
+        exonerate_genes = run_exonerate(fasta, "reference_proteins", ref_lengths,
+                                        shards=args.tile_shards, batch_size=args.tile_batch,
+                                        prefilter=args.prefilter, timeout=args.exonerate_timeout,
+                                        speculate=args.speculate, server=args.exonerate_server)
         ordered_exonerate_genes = sorted(exonerate_genes, key=lambda x: (x.contig_id, x.locs[0]))
         logfile.write("Running GeneMark-ES for {0}...\n".format(genome))
-        genemark_genes = run_genemark(genome)
-        gm_temp_data = ["data", "info", "output", "run", "gmes.log", "run.cfg", "prot_seq.faa", "nuc_seq.fna"]
+        genemark_genes = run_genemark(fasta)
+        gm_temp_data = ["data", "info", "output", "run", "gmes.log", "run.cfg"]
         genemark_folder_handler(genome_tag, gm_temp_data)
-        write_gene_calls(ordered_exonerate_genes, genemark_genes, genome_tag)
+        write_genemark_proteins("genemark.gtf", fasta, genome_tag,
+                                "{0}/gene_calling/{1}/genemark_output/prot_seq.faa".format(os.getcwd(), genome_tag))
+        exonerate_calls, genemark_calls = write_gene_calls(ordered_exonerate_genes, genemark_genes, genome_tag)
         if not os.path.isfile(
                 "{0}/gene_calling/{1}/genemark_output/{2}".format(os.getcwd(), genome_tag, "genemark.gtf")):
             shutil.move("genemark.gtf", "{0}/gene_calling/{1}/genemark_output".format(os.getcwd(), genome_tag))
-        unique_genes = get_unique_calls("{0}/gene_calling/{1}/{1}_exonerate.txt".format(os.getcwd(), genome_tag),
-                                        "{0}/gene_calling/{1}/{1}_genemark.txt".format(os.getcwd(), genome_tag))
-        exon_coords = [line.strip("\n").split("\t") for line in
-                       open("{0}/gene_calling/{1}/{1}_exonerate.txt".format(os.getcwd(), genome_tag)).readlines()]
-        combined_coords = sorted(exon_coords + unique_genes, key=lambda x: (x[0], int(x[2])))
-        corrected_coords = strip_duplicates(combined_coords)
-        logfile.write("Combined and corrected Exonerate and GeneMark predictions...\n")
-        with open("{0}/gene_calling/{1}/{1}_exon_gm.txt".format(os.getcwd(), genome_tag), "w") as outfile:
-            for line in corrected_coords:
-                outfile.write("\t".join(element for element in line) + "\n")
-        run_transdecoder(genome, "{0}/gene_calling/{1}/{1}_exon_gm.txt".format(os.getcwd(), genome_tag), genome_tag)
+        unique_genes = get_unique_calls(exonerate_calls, genemark_calls)
+        combined_calls = GeneCalls.concatenate([exonerate_calls, unique_genes]).sorted()
+        with stage("reconcile"):
+            corrected_calls, decisions = reconcile(combined_calls, args.priority)
+        write_decisions(decisions, "{0}/gene_calling/{1}/{1}_reconciliation.txt".format(os.getcwd(), genome_tag))
+        logfile.write("Combined and corrected Exonerate and GeneMark predictions ({0} overlapping calls dropped)...\n".format(
+            len(decisions)))
+        corrected_calls.save("{0}/gene_calling/{1}/{1}_exon_gm.npz".format(os.getcwd(), genome_tag))
+        run_transdecoder(fasta, corrected_calls, genome_tag)
         transdecoder_folder_handler(genome_tag)
+        if args.compress:
+            # Non-coding regions are only read by TransDecoder, so can be kept block-compressed.
+            with token_pool().cpus(most=token_pool().tokens) as cpus:
+                compress_file("{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), genome_tag),
+                              "{0}/gene_calling/{1}/{1}_noncoding.fna.gz".format(os.getcwd(), genome_tag), cpus)
+            os.remove("{0}/gene_calling/{1}/{1}_noncoding.fna".format(os.getcwd(), genome_tag))
         if os.path.isfile("{0}/dubious_orfs.faa".format(os.getcwd())):
             logfile.write("Checking for dubious ORFs...\n")
             remove_dubious_orfs(
                 "{0}/gene_calling/{1}/transdecoder_output/{1}_noncoding.fna.transdecoder.pep".format(os.getcwd(),
                                                                                                      genome_tag),
-                "./dubious_orfs.faa")
-        filter_transdecoder_calls(genome_tag)
+                "./dubious_orfs.faa", search=args.search)
+        filter_transdecoder_calls(genome_tag, args.orf_min_score, args.orf_min_length)
         split_retained_orfs(genome_tag)
-        realign_orfs(genome, genome_tag)
+        realign_orfs(fasta, genome_tag)
         logfile.write("Unifying all calls...\n")
         remove_duplicates("{0}/gene_calling/{1}/{1}_exonerate.faa".format(os.getcwd(), genome_tag), genome_tag,
                           "exonerate_unique.faa")
         remove_duplicates("{0}/gene_calling/{1}/{1}_transdecoder.faa".format(os.getcwd(), genome_tag), genome_tag,
                           "transdecoder_unique.faa")
         merge_all_calls(genome_tag)
-        logfile.write(
-            "Gene prediction for {0} completed... ({1} seconds)\n".format(genome_tag, time.time() - genome_time))
+        record_prediction(genome, genome_tag)
+        contigs, genome_bp = fasta_features(fasta)
+        record_metrics("{0}/{1}".format(os.getcwd(), RUN_METRICS), "gene_prediction", genome_tag,
+                       {"genome_bp": genome_bp, "contigs": contigs, "ref_proteins": len(ref_lengths),
+                        "ref_residues": sum(ref_lengths.values())}, usage.stop(),
+                       disk_usage("{0}/gene_calling/{1}".format(os.getcwd(), genome_tag)), token_pool().tokens)
+    finally:
+        if fasta != genome:
+            os.remove(fasta)  # Scratch copy of a compressed genome, also on failure.
+    logfile.write(
+        "Gene prediction for {0} completed... ({1} seconds)\n".format(genome_tag, time.time() - genome_time))
+
+
+def main():
+    """
+	Main workflow of gene prediction per genome.
+
+		1.  Create master gene_calling folder (outside of per genome loop).
+		2.  Generate dictionary list of genes from genome/tag list file (ditto).
+		3.  Skip genomes with up-to-date gene calls if running incrementally.
+		4.  Call genes in genome based on homology to reference genes using exonerate.
+		5.  Call genes using self-trained branching HMM analysis with GeneMark-ES.
+		6.  Write output from exonerate and GeneMark-ES into PanOCT-compatible format.
+		7.  Clean up output from GeneMark-ES (compress it in future maybe?).
+		8.  Identify genes called by GeneMark that are non-overlapping relative to exonerate.
+		9.  Reconcile overlapping calls in this combined prediction by source priority.
+		10. Call potential ORFs in (still) non-coding regions of genome using TransDecoder.
+		11. Filter out dubious ORFs and filter remainder based on sequence length and coding potenital.
+		12. Merge unique TransDecoder calls with exonerate/GeneMark-ES calls.
+		13. Write unified protein set file and attributes file, and record input checksums.
+
+	With --worker, genomes are claimed from a work queue in gene_calling/queue
+	(see run_worker), so several workers can share the genomes list, and with
+	--check, only the completeness of every genome's gene calls is checked.
+	With --plan, only resources for the run are predicted (see plan_predictions).
+	"""
+    try:
+        os.makedirs("{0}/gene_calling".format(os.getcwd()))
+    except OSError as e:
+        if e.errno != os.errno.EEXIST:
+            raise
+    genomes = od()
+    for line in open(genomes_list):
+        # Absolute paths, as workers run in their own directories.
+        genomes[os.path.abspath(line.split("\t")[1].strip("\n"))] = line.split("\t")[0]
+    if args.plan:
+        plan_predictions(genomes, proteins, args.plan_cores, args.plan_walltime * 3600)
+        return
+    queue = WorkQueue("{0}/gene_calling/queue".format(os.getcwd()), lease=args.lease)
+    if args.check:
+        if not check_predictions(genomes, queue):
+            exit(1)
+        return
+    if args.worker:
+        queue.run_once("reference_proteins", lambda: buildrefset(proteins))
+    elif not os.path.isdir("{0}/reference_proteins".format(os.getcwd())):
+        os.makedirs("{0}/reference_proteins".format(os.getcwd()))
+        buildrefset(proteins)
+    ref_lengths = get_gene_lengths(proteins)
+    if args.worker:
+        run_worker(genomes, ref_lengths, queue)
+        return
+    for genome in genomes.keys():
+        genome_tag = genomes[genome]
+        if args.incremental and prediction_is_current(genome, genome_tag):
+            logfile.write("Gene calls for {0} are up to date, skipping...\n".format(genome_tag))
+            continue
+        predict_genome(genome, genome_tag, ref_lengths)
 
 
 ##### Additional checks. ######
@@ -679,8 +978,10 @@ def check_dependencies():
     """
 	Check to see that everything is installed or in PATH.
 	"""
-    deps = ["exonerate", "gmes_petap.pl", "get_sequence_from_GTF.pl",
+    deps = ["exonerate", "gmes_petap.pl",
             "TransDecoder.LongOrfs", "TransDecoder.Predict"]
+    if args.exonerate_server:
+        deps.extend(["fasta2esd", "esd2esi", "exonerate-server"])
     for prog in deps:
         try:
             sp.check_output(["which", prog])
@@ -693,9 +994,56 @@ def check_dependencies():
 ##### User input. #####
 if __name__ == "__main__":
     start_time = time.time()
-    proteins = sys.argv[1]
-    genomes_list = sys.argv[2]
-    check_dependencies()
+    parser = argparse.ArgumentParser(description="Gene model prediction for pan-genome analysis.")
+    parser.add_argument("proteins", help="FASTA file of reference proteins.")
+    parser.add_argument("genomes_list", help="Tab-separated file of strain tags and genome FASTA files.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Skip genomes whose gene calls already exist and whose inputs are unchanged.")
+    # Ways of running exonerate's jobs: only one applies at a time (see run_exonerate).
+    exonerate_mode = parser.add_mutually_exclusive_group()
+    exonerate_mode.add_argument("--tile-shards", type=int, default=0, metavar="N",
+                                help="Split each genome into N contig shards for exonerate (default: no tiling).")
+    parser.add_argument("--tile-batch", type=int, default=1, metavar="N",
+                        help="Number of reference proteins per exonerate job when tiling (default: 1).")
+    exonerate_mode.add_argument("--prefilter", action="store_true",
+                                help="Only run exonerate against candidate windows from a six-frame k-mer index.")
+    exonerate_mode.add_argument("--exonerate-server", action="store_true",
+                                help="Index each genome once (fasta2esd/esd2esi) and run exonerate through local "
+                                     "exonerate-server instances.")
+    parser.add_argument("--exonerate-timeout", type=float, metavar="SECONDS",
+                        help="Kill exonerate jobs after this long, retry once with cheaper settings, then drop them.")
+    parser.add_argument("--speculate", action="store_true",
+                        help="Re-run exonerate jobs taking longer than the 99th percentile once the queue is empty.")
+    parser.add_argument("--orf-min-score", type=float, default=100, metavar="SCORE",
+                        help="Minimum TransDecoder coding score for ORFs in non-coding regions (default: 100).")
+    parser.add_argument("--orf-min-length", type=int, default=200, metavar="LENGTH",
+                        help="Minimum length of TransDecoder ORFs in non-coding regions (default: 200).")
+    parser.add_argument("--priority", type=parse_priority, default=PRIORITY, metavar="SOURCES",
+                        help="Order in which overlapping calls are kept (default: exonerate,genemark,transdecoder).")
+    parser.add_argument("--search", choices=sorted(BACKENDS), default="blastp",
+                        help="Protein search backend for dubious ORFs (default: blastp).")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="Write per-stage profiles to DIR (default: $PANPIPES_PROFILE, or no profiling).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Keep large intermediates (e.g. non-coding regions) BGZF-compressed.")
+    parser.add_argument("--worker", action="store_true",
+                        help="Claim genomes from a work queue shared with other workers in the same directory.")
+    parser.add_argument("--lease", type=float, default=600, metavar="SECONDS",
+                        help="Reclaim genomes from workers that stopped responding this long ago (default: 600).")
+    parser.add_argument("--check", action="store_true",
+                        help="Only check that every genome has complete gene calls (exits 1 if not).")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only predict CPU time, memory, disk and PBS resources for the run, without running it.")
+    parser.add_argument("--plan-cores", type=int, default=allocated_cpus(), metavar="N",
+                        help="CPUs to plan for with --plan (default: CPUs allocated now).")
+    parser.add_argument("--plan-walltime", type=float, default=48, metavar="HOURS",
+                        help="Walltime limit per job, beyond which --plan suggests batches of genomes (default: 48).")
+    args = parser.parse_args()
+    configure(args.profile)
+    proteins = os.path.abspath(args.proteins)
+    genomes_list = args.genomes_list
+    if not (args.check or args.plan):
+        check_dependencies()
     # Need absolute path for TransDecoder to run NCR realignment to genome!
     main()
     logfile.write(
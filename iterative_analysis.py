@@ -58,47 +58,70 @@ Maynooth University in 2017-2018 (Charley.McCarthy@nuim.ie).
 
 from __future__ import division
 
+import argparse
 import datetime
-import multiprocessing as mp
 import os
+import shutil
 import subprocess as sp
+import sys
 import time
-from collections import Counter
-from csv import reader
+from collections import OrderedDict as od
 from glob import glob
 
+import numpy as np
 from Bio import SearchIO, SeqIO
+from panpipes.Compression import open_text, indexable, open_output, compress_file
+from panpipes.Funnel import Funnel
+from panpipes.Jobs import run_jobs
+from panpipes.Matchtable import ABSENT, ABSENT_INDEX, ClusterMatrix
+from panpipes.Profiling import configure, stage
+from panpipes.Planning import Usage, CostModel, record_metrics, read_metrics, disk_usage, plan
+from panpipes.Resources import token_pool, allocated_cpus
+from panpipes.Search import BACKENDS, get_backend
+from panpipes.Sketch import MinHash, lsh_bands, candidate_blocks
 from panpipes.Tools import flatten, grouper, seq_ratio
-from panpipes.Tools import merge_clusters
+from panpipes.Tools import merge_clusters, unique_records, file_checksum
 from panpipes.Tools import subject_top_hit, query_top_hit, query_hit_dict, subject_hit_dict
 
-##### Here is the function to handle individual BLASTp searches in parallel_BLAST. #####
-def subprocess_BLAST(cmd):
-    """
-    Run an individual instance of a parallel_BLAST search.
-    """
-    subblastlog.write("Running {0}".format(" ".join(cmd)) + "\n")
-    sp.call(cmd)
-
+# Checks made by gap_finder, in order, for funnel counts (see Funnel).
+GAP_FINDER_STAGES = ["cluster_size", "query_hits", "strain_novelty", "seq_ratio", "hit_frequency", "subject_top_hit",
+                     "subject_lookup", "subject_size", "subject_hits", "subject_coverage", "strain_disjoint",
+                     "reciprocal_count", "query_top_hit"]
+FUNNEL_TABLE = "gap_finder_funnel.txt"
+CHECKPOINT = "cluster_clean_checkpoint.npz"
+RUN_METRICS = "run_metrics.tsv"  # Per-size usage, for calibrating --plan (see Planning).
+# Most proteins per BLASTp part when BLASTing within sketch blocks; small blocks are packed together up to this.
+BLOCK_PART_SIZE = 1000
 
 ##### Here are the major functions used in cluster_clean. #####
-def parallel_BLAST(list_of_genes, seqindex, split_by, out):
+def parallel_BLAST(list_of_genes, seqindex, split_by, out, db_genes=None, dbsize=None, timeout=None, blocks=None,
+                   search="blastp"):
     """
     Run a BLASTp all-vs.-all search on a subset of genes from a database.
 
     Splits queries into separate files by a divisor split_by, BLASTs them
     simultaneously and then concatenates them using cat. Currently uses
     subprocess over BioPython's BLASTp wrapper for easy parallelization
-    using mp.Pool and subprocess_BLAST. Returns a SearchIO BLAST tabular object.
+    using Jobs.run_jobs, which records per-part durations in the job log.
+    Returns a SearchIO BLAST tabular object.
 
-    Requires cat, makeblastdb and blastp in your $PATH!
+    Requires cat, and makeblastdb and blastp (or the programs of another
+    search backend, see Search) in your $PATH!
 
     Arguments:
         list_of_genes = List of (remaining) noncore protein IDs.
         seqindex      = SeqIO.index of all proteins.
         split_by      = Divisor to split files into.
         out           = File prefix for results files given current cluster size being investigated.
+        db_genes      = Protein IDs to search against, if not list_of_genes (i.e. not all-vs.-all).
+        dbsize        = Effective database size for BLASTp, keeps e-values comparable between
+                        searches against subsets of the same protein set.
+        timeout       = Seconds after which a BLASTp part is killed and its results dropped (default: no timeout).
+        blocks        = Lists of protein IDs (see sketch_blocks) to only BLAST against each other, instead of
+                        all-vs.-all. Blocks are packed into parts, each searched against itself only.
+        search        = Search backend (see Search.BACKENDS), all of which write BLAST tabular output.
     """
+    backend = get_backend(search)
 
     ##### Generate FASTA database of (remaining) noncore proteins. #####
     outfast = open(out, "w")
@@ -106,43 +129,71 @@ def parallel_BLAST(list_of_genes, seqindex, split_by, out):
         outfast.write(">{0}\n{1}\n".format(seqindex[seq].id, seqindex[seq].seq))
     outfast.close()  # Close file here, makeblastdb has problems otherwise.
     subblastlog.write("Wrote {0} sequences to {1}...\n".format(len(list_of_genes), out))
-
-    ##### Run makeblastdb on FASTA database. #####
-    sp.call(["makeblastdb", "-in", out, "-dbtype", "prot", "-out", "{0}.db".format(out)], stdout=subblastlog)
+    if db_genes is not None:
+        with open("{0}.subject".format(out), "w") as outsubj:
+            for seq in db_genes:
+                outsubj.write(">{0}\n{1}\n".format(seqindex[seq].id, seqindex[seq].seq))
+        subblastlog.write("Wrote {0} subject sequences to {1}.subject...\n".format(len(db_genes), out))
+        db_fasta = "{0}.subject".format(out)
+    else:
+        db_fasta = out
+
+    ##### Run makeblastdb (or the backend's equivalent) on FASTA database. #####
+    if blocks is None:
+        with token_pool().cpus():
+            part_db = backend.build_db(db_fasta, "{0}.db".format(out), subblastlog)
+        to_split = SeqIO.parse("{0}".format(out), "fasta")
+        parts = grouper(to_split, max(1, int(round(len(list_of_genes) / split_by))))
+    else:
+        parts = [[seqindex[seq] for seq in part] for part in pack_blocks(blocks, split_by)]
 
     ##### Split FASTA database by split_by and generate list of BLASTp commands. #####
     count = 0
     query_cmds = []  # Handle for simultaneous BLASTp commands.
-    to_split = SeqIO.parse("{0}".format(out), "fasta")
-    for part in grouper(to_split, int(round(len(list_of_genes) / split_by))):
+    for part in parts:
         count = count + 1
         seqs = filter(lambda x: x is not None, part)  # Remove fill values.
         if glob("{0}.part{1}.faa".format(out, count)):  # Remove previous versions of file if present.
             os.remove("{0}.part{1}.faa".format(out, count))
         SeqIO.write(seqs, "{0}.part{1}.faa".format(out, count), "fasta")
-        query_cmds.append(["blastp", "-query", "{0}.part{1}.faa".format(out, count),
-                           "-db", "{0}.db".format(out), "-outfmt", "6 std qlen slen", "-evalue",
-                           "0.0001", "-out",
-                           "{0}.part{1}.subblast".format(out, count),
-                           "-num_threads", "1"])
+        if blocks is not None:  # Each part of blocks is its own database.
+            with token_pool().cpus():
+                part_db = backend.build_db("{0}.part{1}.faa".format(out, count), "{0}.part{1}.db".format(out, count),
+                                           subblastlog)
+        query_cmds.append(backend.command("{0}.part{1}.faa".format(out, count), part_db,
+                                          "{0}.part{1}.subblast".format(out, count), max_evalue=0.0001,
+                                          db_size=dbsize))
     subblastlog.write("Split original query file {0} ({1} sequences) into {2} files.\n".format(out, len(list_of_genes),
-                                                                                               str(split_by)))
-
-    ##### Run BLASTp processes simultaneously using mp.Pool. #####
-    farm = mp.Pool(processes=split_by)
-    farm.map(subprocess_BLAST, query_cmds)
-    farm.close()
+                                                                                               str(count)))
+
+    ##### Run BLASTp processes simultaneously using run_jobs. #####
+    # No speculative copies here, as both copies of a part would write to the same output file.
+    # If there are fewer parts than CPU tokens, each part gets several BLASTp threads.
+    for cmd in query_cmds:
+        subblastlog.write("Running {0}".format(" ".join(cmd)) + "\n")
+    run_jobs(query_cmds, processes=split_by, timeout=timeout, joblog=joblog, log=subblastlog,
+             threads_arg=backend.threads_arg, drop=True)
     subblastlog.write(
-        "Finished BLAST+ searches for {0} ({1} sequences), split into {2} files.\n".format(out, len(list_of_genes),
-                                                                                           str(split_by)))
+        "Finished {0} searches for {1} ({2} sequences), split into {3} files.\n".format(search, out,
+                                                                                      len(list_of_genes),
+                                                                                      str(split_by)))
 
     ##### Concatenate parallel_BLAST results together in the shell and remove other files. #####
-    sp.call(["cat"] + glob("*subblast"), stdout=open("{0}.results".format(out), "wb"))
+    # Results only appear once complete, so that a resumed run can reuse them (see cluster_clean).
+    with open("{0}.results.tmp".format(out), "wb") as outresults:
+        if glob("*subblast"):  # None if sketch_blocks found no candidate pairs (cat alone would read stdin).
+            sp.call(["cat"] + glob("*subblast"), stdout=outresults)
+    os.rename("{0}.results.tmp".format(out), "{0}.results".format(out))
     for bin_file in glob("%s.db*" % out):
         os.remove(bin_file)
     for part_file in glob("%s.part*" % out):
-        os.remove(part_file)
+        if os.path.isdir(part_file):  # Temporary directories of some backends (e.g. mmseqs).
+            shutil.rmtree(part_file)
+        else:
+            os.remove(part_file)
     os.remove("%s" % out)
+    if db_genes is not None:
+        os.remove("{0}.subject".format(out))
     subblastlog.write(
         "Concatenated BLAST+ output for {0} ({1} sequences).\n".format(out, len(list_of_genes), str(split_by)))
 
@@ -152,7 +203,50 @@ def parallel_BLAST(list_of_genes, seqindex, split_by, out):
     return blast
 
 
-def gap_finder(blast_results, seqindex, noncore, total, current, min_id_cutoff, strain_cutoff):
+def pack_blocks(blocks, split_by, part_size=BLOCK_PART_SIZE):
+    """
+    Pack blocks of protein IDs into BLASTp parts of whole blocks, balancing the pairs searched in each part.
+
+    Uses at least split_by parts, and enough parts that small blocks share parts of up to part_size proteins
+    (larger blocks get a part each), so few pairs from different blocks get searched.
+    """
+    proteins = sum(len(block) for block in blocks)
+    count = min(len(blocks), max(split_by, int(np.ceil(proteins / part_size))))
+    parts = [[] for _ in range(count)]
+    pairs = np.zeros(count)
+    # Largest blocks first, each into the part with the fewest (query x subject) pairs so far.
+    for block in sorted(blocks, key=len, reverse=True):
+        emptiest = int(np.argmin(pairs))
+        parts[emptiest].extend(block)
+        pairs[emptiest] = len(parts[emptiest]) ** 2
+    return [part for part in parts if part]
+
+
+def sketch_blocks(list_of_genes, sketches, rows, threshold):
+    """
+    Group proteins into blocks of candidate homologs for parallel_BLAST, with MinHash sketches and banded LSH.
+
+    Proteins whose sketches share no LSH bucket with any other protein (i.e. below the Jaccard
+    similarity threshold with every protein, with high probability) aren't BLASTed at all.
+
+    Arguments:
+        list_of_genes = List of (remaining) noncore protein IDs.
+        sketches      = MinHash sketch matrix of all noncore proteins.
+        rows          = Dict of protein ID: row of sketches.
+        threshold     = Jaccard similarity of k-mer sets above which proteins are BLASTed against each other.
+    """
+    bands, band_rows = lsh_bands(sketches.shape[1], threshold)
+    indices, pairs = candidate_blocks(sketches[[rows[gene] for gene in list_of_genes]], bands, band_rows, threshold)
+    blocks = [[list_of_genes[index] for index in block] for block in indices]
+    blocked = sum(len(block) for block in blocks)
+    mainlogfile.write("Sketch prefilter ({0} bands of {1} rows): {2} candidate pairs in {3} blocks of {4} proteins, "
+                      "skipping BLAST for {5} of {6} proteins...\n".format(bands, band_rows, pairs, len(blocks),
+                                                                           blocked, len(list_of_genes) - blocked,
+                                                                           len(list_of_genes)))
+    return blocks
+
+
+def gap_finder(blast_results, seqindex, noncore, total, current, min_id_cutoff, strain_cutoff, funnel=None):
     """
     Find potential "gaps" in noncore clusters arising from microsynteny loss.
 
@@ -191,152 +285,274 @@ def gap_finder(blast_results, seqindex, noncore, total, current, min_id_cutoff,
         current       = Cluster size being queried.
         min_id_cutoff = Percentage identity of a BLASTp hit (default = 30).
         strain_cutoff = Cutoff fraction of reciprocal strain top hits between two clusters (default = 1).
+        funnel        = Funnel.Funnel counting candidates and time at each check (see GAP_FINDER_STAGES).
     """
+    funnel = funnel if funnel is not None else Funnel(GAP_FINDER_STAGES)
     homologs = {}
     for cluster in noncore:  # Loop through non-core clusters.
         found = []  # Default for strains "added" to cluster.
         members = filter(lambda x: x != "----------", noncore[cluster])  # Get actual cluster.
-        if len(members) != current:
-            pass  # Ignore clusters outside of the current size.
-        else:  # If cluster size = current.
-            query_cluster_length = len(members)
-            blast_hit_dict = query_hit_dict(members, blast_results, min_id_cutoff)
-            for key in blast_hit_dict:  # Loop through each protein in the "query cluster".
-                for hit in blast_hit_dict[key]:  # Loop through every hit from a given query cluster protein.
-                    strain_tag = hit.split("|")[0]
-                    if strain_tag not in [i.split("|")[0] for i in blast_hit_dict]:
-                        if strain_tag not in found:
-                            if seq_ratio(seqindex, key, hit) >= 0.6:
-                                singlehitcount = len(filter(lambda x: x == hit, flatten(blast_hit_dict.values())))
-                                if singlehitcount / query_cluster_length >= strain_cutoff:
-                                    if subject_top_hit(blast_hit_dict.values(), hit, query_cluster_length, strain_cutoff):
-                                        for subject_cluster in noncore:
-                                            if hit in noncore[subject_cluster]:
-                                                subject_cluster_length = len(filter(lambda x: x != "----------", noncore[subject_cluster]))
-                                                if total >= query_cluster_length + subject_cluster_length:  # If the size of the subject cluster is < the number of missing strains from the query cluster.
-                                                    subjhits = subject_hit_dict(noncore[subject_cluster], blast_results, min_id_cutoff)
-                                                    subshitinquery = len(filter(lambda x: x in noncore[subject_cluster], set(flatten(blast_hit_dict.values()))))
-                                                    if subject_cluster_length > 1:  # If the subject cluster is not a singleton cluster.
-                                                        if subshitinquery / subject_cluster_length >= strain_cutoff:
-                                                            strains_in_subject = [i.split("|")[0] for i in filter(lambda x: x != "----------", noncore[subject_cluster])]  # Strains present in the subject cluster.
-                                                            if not filter(lambda x: x in strains_in_subject, [i.split("|")[0] for i in blast_hit_dict]):  # If all strains present in the subject cluster are missing from the query cluster.
-                                                                reciphitcount = len(filter(lambda x: x in blast_hit_dict, set(flatten(subjhits.values()))))
-                                                                if reciphitcount / query_cluster_length >= strain_cutoff:
-                                                                    strains_in_query = [key.split("|")[0] for key in blast_hit_dict]
-                                                                    if query_top_hit(blast_hit_dict, strains_in_query, subjhits.values(), subject_cluster_length, strain_cutoff):
-                                                                        for s in strains_in_subject:
-                                                                            found.append(s)
-                                                                        if cluster in homologs:  # Allow more than one cluster to be associated.
-                                                                            homologs[cluster].append(subject_cluster)
-                                                                        else:
-                                                                            homologs[cluster] = [subject_cluster]
-                                                    else:
-                                                        if subshitinquery / subject_cluster_length >= strain_cutoff:  # If every member of the query cluster is also a subject of the protein in the singleton subject cluster.
-                                                            strains_in_query = [key.split("|")[0] for key in blast_hit_dict]
-                                                            if query_top_hit(blast_hit_dict, strains_in_query,
-                                                                             subjhits.values(), query_cluster_length,
-                                                                             strain_cutoff):
-                                                                found.append(hit.split("|")[
-                                                                                 0])  # Shortcut: append hit ID substring because we're only looking at a singleton.
-                                                                if cluster in homologs:  # Allow more than one subject cluster to be associated to a query cluster.
-                                                                    homologs[cluster].append(subject_cluster)
-                                                                else:
-                                                                    homologs[cluster] = [subject_cluster]
+        if not funnel.check("cluster_size", lambda: len(members) == current):
+            continue  # Ignore clusters outside of the current size.
+        query_cluster_length = len(members)
+        blast_hit_dict = funnel.check("query_hits", lambda: query_hit_dict(members, blast_results, min_id_cutoff))
+        for key in blast_hit_dict:  # Loop through each protein in the "query cluster".
+            for hit in blast_hit_dict[key]:  # Loop through every hit from a given query cluster protein.
+                strain_tag = hit.split("|")[0]
+                if not funnel.check("strain_novelty", lambda: strain_tag not in [i.split("|")[0] for i in blast_hit_dict]
+                                    and strain_tag not in found):
+                    continue
+                if not funnel.check("seq_ratio", lambda: seq_ratio(seqindex, key, hit) >= 0.6):
+                    continue
+                if not funnel.check("hit_frequency", lambda: len(filter(lambda x: x == hit, flatten(
+                        blast_hit_dict.values()))) / query_cluster_length >= strain_cutoff):
+                    continue
+                if not funnel.check("subject_top_hit", lambda: subject_top_hit(blast_hit_dict.values(), hit,
+                                                                               query_cluster_length, strain_cutoff)):
+                    continue
+                subject_clusters = funnel.check("subject_lookup", lambda: [subject_cluster for subject_cluster in noncore
+                                                                           if hit in noncore[subject_cluster]])
+                for subject_cluster in subject_clusters:
+                    subject_cluster_length = len(filter(lambda x: x != "----------", noncore[subject_cluster]))
+                    # If the size of the subject cluster is < the number of missing strains from the query cluster.
+                    if not funnel.check("subject_size", lambda: total >= query_cluster_length + subject_cluster_length):
+                        continue
+                    subjhits = funnel.check("subject_hits", lambda: subject_hit_dict(noncore[subject_cluster],
+                                                                                     blast_results, min_id_cutoff))
+                    # If every member of the subject cluster is also a subject of the query cluster.
+                    if not funnel.check("subject_coverage", lambda: len(filter(
+                            lambda x: x in noncore[subject_cluster], set(flatten(blast_hit_dict.values()))))
+                            / subject_cluster_length >= strain_cutoff):
+                        continue
+                    if subject_cluster_length > 1:  # If the subject cluster is not a singleton cluster.
+                        # Strains present in the subject cluster.
+                        strains_in_subject = [i.split("|")[0] for i in
+                                              filter(lambda x: x != "----------", noncore[subject_cluster])]
+                        # If all strains present in the subject cluster are missing from the query cluster.
+                        if not funnel.check("strain_disjoint", lambda: not filter(
+                                lambda x: x in strains_in_subject, [i.split("|")[0] for i in blast_hit_dict])):
+                            continue
+                        if not funnel.check("reciprocal_count", lambda: len(filter(
+                                lambda x: x in blast_hit_dict, set(flatten(subjhits.values()))))
+                                / query_cluster_length >= strain_cutoff):
+                            continue
+                        strains_in_query = [key.split("|")[0] for key in blast_hit_dict]
+                        if not funnel.check("query_top_hit", lambda: query_top_hit(
+                                blast_hit_dict, strains_in_query, subjhits.values(), subject_cluster_length,
+                                strain_cutoff)):
+                            continue
+                        found.extend(strains_in_subject)
+                    else:
+                        strains_in_query = [key.split("|")[0] for key in blast_hit_dict]
+                        if not funnel.check("query_top_hit", lambda: query_top_hit(
+                                blast_hit_dict, strains_in_query, subjhits.values(), query_cluster_length,
+                                strain_cutoff)):
+                            continue
+                        found.append(strain_tag)  # Shortcut: a singleton subject cluster only has the hit's strain.
+                    # Allow more than one subject cluster to be associated to a query cluster.
+                    homologs.setdefault(cluster, []).append(subject_cluster)
     return homologs
 
-def cluster_clean(panoct_clusters, fasta_handle, split_by=4, min_id_cutoff=30, strain_cutoff=1.0, iterations=1):
+
+def merge_gaps(gaps, noncore, softcore, total):
+    """
+    Merge homologous clusters found by gap_finder.
+
+    Merged clusters that now contain every genome are moved from noncore to
+    softcore, otherwise the merged cluster stays in noncore under the query
+    cluster's ID. Returns the number of clusters merged into softcore and
+    noncore clusters respectively.
+    """
+    filled_count = 0
+    merged_count = 0
+    for cluster in gaps:
+        if cluster in noncore:
+            cluster_strains = [i.split("|")[0] for i in filter(lambda x: x != "----------", noncore[cluster])]
+            for candidate in gaps[cluster]:
+                if candidate in noncore:
+                    candidate_strains = [i.split("|")[0] for i in
+                                         filter(lambda x: x != "----------", noncore[candidate])]
+                    if len(set(candidate_strains) & set(cluster_strains)) == 0:
+                        merge_size = (len(filter(lambda x: x != "----------", noncore[cluster])) + len(
+                            filter(lambda x: x != "----------", noncore[candidate])))
+                        if merge_size == total:
+                            mainlogfile.write("{0} (size: {1}) has a homologous cluster: {2} (size: {3})\n".format
+                                              (cluster, len(filter(lambda x: x != "----------", noncore[cluster])),
+                                               candidate, len(filter(lambda x: x != "----------", noncore[candidate]))))
+                            mainlogfile.write(
+                                "Merging smaller cluster {0} into larger cluster {1}...\n".format(candidate, cluster))
+                            mainlogfile.write("Merged cluster {0} has size {1}.\n".format(cluster, merge_size))
+                            filled = merge_clusters(noncore[cluster], noncore[candidate])
+                            softcore[cluster] = filled
+                            del noncore[cluster], noncore[candidate]
+                            filled_count = filled_count + 2
+                        elif merge_size < total:
+                            mainlogfile.write("{0} (size: {1}) has a homologous cluster: {2} (size: {3})\n".format
+                                              (cluster, len(filter(lambda x: x != "----------", noncore[cluster])),
+                                               candidate, len(filter(lambda x: x != "----------", noncore[candidate]))))
+                            mainlogfile.write(
+                                "Merging smaller cluster {0} into larger cluster {1}...\n".format(candidate, cluster))
+                            mainlogfile.write("Merged cluster {0} has size {1}.\n".format(cluster, merge_size))
+                            merged = merge_clusters(noncore[cluster], noncore[candidate])
+                            noncore[cluster] = merged
+                            del noncore[candidate]
+                            merged_count = merged_count + 2
+    return filled_count, merged_count
+
+
+def archive_file(path, destination, compress=False):
+    """
+    Move a file to destination, BGZF-compressing it on the way if compress is set.
+    """
+    if compress:
+        with token_pool().cpus(most=token_pool().tokens) as cpus:
+            compress_file(path, destination, cpus)
+        os.remove(path)
+    else:
+        os.rename(path, destination)
+
+
+def save_checkpoint(path, matchtable, iteration, size, noncore, softcore, total, results):
+    """
+    Atomically save cluster_clean's merge state after finishing a cluster size.
+
+    Noncore and softcore clusters are saved as ClusterMatrix arrays, with the
+    iteration and size just completed, the paths of BLAST results so far and
+    the matchtable's checksum, to a temporary file which then replaces the
+    previous checkpoint.
+    """
+    with open("{0}.tmp".format(path), "wb") as outfile:
+        np.savez(outfile, matchtable=matchtable, matchtable_checksum=file_checksum(matchtable), iteration=iteration, size=size, results=np.array(results, dtype=str),
+                 **dict(ClusterMatrix.from_clusters(noncore, total).arrays("noncore"),
+                        **ClusterMatrix.from_clusters(softcore, total).arrays("softcore")))
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.rename("{0}.tmp".format(path), path)
+
+
+def load_checkpoint(path, matchtable):
+    """
+    Load a checkpoint saved by save_checkpoint for the given matchtable.
+
+    The matchtable must be unchanged since the checkpoint was saved, as the
+    merge state was derived from it.
+
+    Returns (iteration, size, noncore, softcore, results).
+    """
+    data = np.load(path)
+    try:
+        if str(data["matchtable"]) != matchtable:
+            raise ValueError("Checkpoint {0} is for {1}, not {2}.".format(path, data["matchtable"], matchtable))
+        if "matchtable_checksum" not in data.files or str(data["matchtable_checksum"]) != file_checksum(matchtable):
+            raise ValueError("{0} has changed since checkpoint {1} was saved, remove it to start again.".format(
+                matchtable, path))
+        return (int(data["iteration"]), int(data["size"]), ClusterMatrix.from_arrays(data, "noncore").to_clusters(),
+                ClusterMatrix.from_arrays(data, "softcore").to_clusters(), data["results"].tolist())
+    finally:
+        data.close()
+
+
+def cluster_clean(panoct_clusters, fasta_handle, split_by=4, min_id_cutoff=30, strain_cutoff=1.0, iterations=1,
+                  blast_timeout=None, resume=False, compress=False, sketch_threshold=None, search="blastp"):
     """
     Tidy up non-core clusters found by PanOCT.
 
     Feeds into parallel_BLAST, which expects you to have BLAST+ installed.
     Also feeds into gap_finder, which doesn't require anything else.
+
+    The merge state is checkpointed after every cluster size (see
+    save_checkpoint). With resume, a run picks up after the last completed
+    size, and reuses the BLAST results of an interrupted size if they exist.
+    With compress, each size's proteins and BLAST results are archived in
+    sub_BLASTs as BGZF, which SearchIO.index can still read.
+    With sketch_threshold, proteins are only BLASTed against candidate
+    homologs found with MinHash sketches (see sketch_blocks), instead of
+    all-vs.-all. search selects the search backend (see Search.BACKENDS).
     """
     ##### Load in FASTA database and PanOCT results. #####
-    db = SeqIO.index(fasta_handle, "fasta")
-    full_blast = SearchIO.index("blast_results.txt", "blast-tab")
-    matchtable = reader(open(panoct_clusters), delimiter="\t")
-
-    ##### Initialize empty dictionaries for cluster types. #####
-    core = {}
-    noncore = {}
+    db = SeqIO.index(indexable(fasta_handle), "fasta")
+    full_blast = SearchIO.index(indexable("blast_results.txt"), "blast-tab")
+
+    ##### Load PanOCT results as a cluster x genome matrix, split into core and noncore clusters. #####
+    # Only noncore clusters are merged, so only they are held as dicts of members for gap_finder/merge_gaps.
+    matrix = ClusterMatrix.read(panoct_clusters)
+    total = matrix.genomes  # Total number of genomes.
+    start = total - 1  # Max noncore cluster size.
+    sizes = matrix.sizes()
+    core = matrix.select(sizes == total)
+    noncore = matrix.select(sizes < total).to_clusters()
     softcore = {}
 
-    ##### Initialize variables for total/starting number of genomes. #####
-    total = 0
-    start = 0
-
-    ##### Populate core & noncore dictionaries by reading PanOCT results. #####
-    for row in matchtable:
-        if "----------" in row:
-            noncore[row[0]] = row[1:]  # Populating our initial noncore dict.
-        else:
-            core[row[0]] = row[1:]  # Populating our core dict.
-            if total == 0:
-                total = len(row) - 1  # Total number of genomes.
-                print total
-                start = total - 1  # Max noncore cluster size.
-
     mainlogfile.write(
         "{0} core clusters and {1} noncore clusters identified...\n".format(len(core), len(noncore)))
 
+    ##### Restore merge state from the last completed cluster size if resuming. #####
+    done = (-1, total)  # (iteration, size) of the last completed step.
+    blasted = []  # BLAST results of completed steps.
+    if resume and os.path.isfile(CHECKPOINT):
+        last_iteration, last_size, noncore, softcore, blasted = load_checkpoint(CHECKPOINT, panoct_clusters)
+        done = (last_iteration, last_size)
+        mainlogfile.write("Resuming from {0} after iteration {1}, cluster size {2} "
+                          "({3} noncore and {4} softcore clusters)...\n".format(CHECKPOINT, last_iteration + 1,
+                                                                                last_size, len(noncore),
+                                                                                len(softcore)))
+    elif resume:
+        mainlogfile.write("No checkpoint {0} found, starting from the beginning...\n".format(CHECKPOINT))
+
+    ##### Sketch all noncore proteins once, as later sizes only BLAST subsets of them. #####
+    if sketch_threshold:
+        with stage("sketch"):
+            sketched = filter(lambda x: x != "----------", flatten([noncore[key] for key in noncore]))
+            sketches = MinHash().sketch_all([db[seq].seq for seq in sketched])
+            sketch_rows = dict((seq, row) for row, seq in enumerate(sketched))
+        mainlogfile.write("Sketched {0} noncore proteins...\n".format(len(sketched)))
+
     #### Run parallel_BLAST and gap finding for n iterations. #####
+    funnels = {}  # Cluster size: gap_finder funnel summed over iterations.
     for iteration in range(0, iterations, 1):
         mainlogfile.write("Running iteration {0}...\n".format(iteration + 1))
         ##### Loop through noncore clusters from size (total -1) to 2. #####
         for size in range(start, 0, -1):
-            filled_count = 0
-            merged_count = 0
-    
+            if (iteration, -size) <= (done[0], -done[1]):
+                continue  # Completed before the checkpoint we resumed from.
+            usage = Usage()
+
             ##### Get list of (remaining) noncore protein IDs. #####
             to_blast = filter(lambda x: x != "----------", flatten([noncore[key] for key in noncore]))
             mainlogfile.write("All-vs.-all BLAST of {0} proteins...\n".format(len(to_blast)))
     
-            ##### Run parallel_BLAST. #####
-            results = parallel_BLAST(to_blast, db, split_by, "ClusterBLAST_{0}.fasta".format(str(size)))
-            outfast = open("ClusterBLAST_{0}.fasta".format(str(size)), "w")
-            for seq in to_blast:
-                outfast.write(">{0}\n{1}\n".format(db[seq].id, db[seq].seq))
+            ##### Run parallel_BLAST, unless an interrupted run already finished it for the same clusters. #####
+            if resume and os.path.isfile("ClusterBLAST_{0}.fasta.results".format(str(size))):
+                mainlogfile.write("Reusing BLAST results ClusterBLAST_{0}.fasta.results...\n".format(str(size)))
+                results = SearchIO.index("ClusterBLAST_{0}.fasta.results".format(str(size)), "blast-tab",
+                                         fields=blast_fields)
+            elif sketch_threshold:
+                blocks = sketch_blocks(to_blast, sketches, sketch_rows, sketch_threshold)
+                # Effective database size of the all-vs.-all search, so e-values don't change.
+                results = parallel_BLAST(to_blast, db, split_by, "ClusterBLAST_{0}.fasta".format(str(size)),
+                                         dbsize=sum(len(db[seq].seq) for seq in to_blast), timeout=blast_timeout,
+                                         blocks=blocks, search=search)
+            else:
+                results = parallel_BLAST(to_blast, db, split_by, "ClusterBLAST_{0}.fasta".format(str(size)),
+                                         timeout=blast_timeout, search=search)
+            with open("ClusterBLAST_{0}.fasta".format(str(size)), "w") as outfast:
+                for seq in to_blast:
+                    outfast.write(">{0}\n{1}\n".format(db[seq].id, db[seq].seq))
             #results = SearchIO.index("ClusterBLAST_{0}.fasta.results".format(str(size)), "blast-tab",
             #                         fields=blast_fields)
             mainlogfile.write("Finding potential homology gaps in clusters of size {0}...\n".format(str(size)))
     
             ##### Run gap_finder. #####
-            gaps = gap_finder(results, db, noncore, total, size, min_id_cutoff, strain_cutoff)
+            funnel = Funnel(GAP_FINDER_STAGES)
+            with stage("gap_finder", label="size{0}".format(size)):
+                gaps = gap_finder(results, db, noncore, total, size, min_id_cutoff, strain_cutoff, funnel)
+            mainlogfile.write(funnel.report("gap_finder funnel for clusters of size {0}".format(size)))
+            funnels.setdefault(size, Funnel(GAP_FINDER_STAGES)).add(funnel)
     
             ##### Identify clusters that need to be merged and move merged clusters to appropriate dictionary. #####
-            for cluster in gaps:
-                if cluster in noncore:
-                    cluster_strains = [i.split("|")[0] for i in filter(lambda x: x != "----------", noncore[cluster])]
-                    for candidate in gaps[cluster]:
-                        if candidate in noncore:
-                            candidate_strains = [i.split("|")[0] for i in
-                                                 filter(lambda x: x != "----------", noncore[candidate])]
-                            if len(set(candidate_strains) & set(cluster_strains)) == 0:
-                                merge_size = (len(filter(lambda x: x != "----------", noncore[cluster])) + len(
-                                    filter(lambda x: x != "----------", noncore[candidate])))
-                                if merge_size == total:
-                                    mainlogfile.write("{0} (size: {1}) has a homologous cluster: {2} (size: {3})\n".format
-                                                      (cluster, len(filter(lambda x: x != "----------", noncore[cluster])),
-                                                       candidate, len(filter(lambda x: x != "----------", noncore[candidate]))))
-                                    mainlogfile.write(
-                                        "Merging smaller cluster {0} into larger cluster {1}...\n".format(candidate, cluster))
-                                    mainlogfile.write("Merged cluster {0} has size {1}.\n".format(cluster, merge_size))
-                                    filled = merge_clusters(noncore[cluster], noncore[candidate])
-                                    softcore[cluster] = filled
-                                    del noncore[cluster], noncore[candidate]
-                                    filled_count = filled_count + 2
-                                elif merge_size < total:
-                                    mainlogfile.write("{0} (size: {1}) has a homologous cluster: {2} (size: {3})\n".format
-                                                      (cluster, len(filter(lambda x: x != "----------", noncore[cluster])),
-                                                       candidate, len(filter(lambda x: x != "----------", noncore[candidate]))))
-                                    mainlogfile.write(
-                                        "Merging smaller cluster {0} into larger cluster {1}...\n".format(candidate, cluster))
-                                    mainlogfile.write("Merged cluster {0} has size {1}.\n".format(cluster, merge_size))
-                                    merged = merge_clusters(noncore[cluster], noncore[candidate])
-                                    noncore[cluster] = merged
-                                    del noncore[candidate]
-                                    merged_count = merged_count + 2
-    
+            with stage("merge_gaps", label="size{0}".format(size)):
+                filled_count, merged_count = merge_gaps(gaps, noncore, softcore, total)
+
             mainlogfile.write(
                 "At cluster size (n = {0}): merged {1} homologous clusters into {2} softcore clusters.\n".format(size,
                                                                                                                  filled_count,
@@ -349,72 +565,198 @@ def cluster_clean(panoct_clusters, fasta_handle, split_by=4, min_id_cutoff=30, s
             if not os.path.isdir("{0}/sub_BLASTs".format(os.getcwd())):
                os.makedirs("{0}/sub_BLASTs/faa".format(os.getcwd()))
                os.makedirs("{0}/sub_BLASTs/results".format(os.getcwd()))
+            suffix = ".gz" if compress else ""
             for sub_faa in glob("ClusterBLAST_*.fasta"):
-               os.rename(sub_faa, "{0}/sub_BLASTs/faa/{1}".format(os.getcwd(), sub_faa))
+               archive_file(sub_faa, "{0}/sub_BLASTs/faa/{1}{2}".format(os.getcwd(), sub_faa, suffix), compress)
             for sub_results in glob("*.results"):
-               os.rename(sub_results, "{0}/sub_BLASTs/results/{1}".format(os.getcwd(), sub_results))
-
-    with open("new_matchtable.txt", "w") as outmatch:
-        for cluster in core:
-            outmatch.write("{0}\t{1}\n".format(cluster, "\t".join(core[cluster])))
-        for cluster in softcore:
-            outmatch.write("{0}\t{1}\n".format(cluster, "\t".join(softcore[cluster])))
-        for cluster in noncore:
-            outmatch.write("{0}\t{1}\n".format(cluster, "\t".join(noncore[cluster])))
-
-    with open("new_softtable.txt", "w") as outsofmatch:
-        for cluster in softcore:
-            outsofmatch.write("{0}\t{1}\n".format(cluster, "\t".join(softcore[cluster])))
-
-    with open("new_nontable.txt", "w") as outnonmatch:
-        for cluster in noncore:
-            outnonmatch.write("{0}\t{1}\n".format(cluster, "\t".join(noncore[cluster])))
-
-    with open("softcore_pam.txt", "w") as outsof:
-        for cluster in softcore:
-            pa = []
-            for el in softcore[cluster]:
-                if el == "----------":
-                    pa.append("0")
-                else:
-                    pa.append("1")
-            outsof.write("{0}\n".format("\t".join(pa)))
-
-
-    with open("noncore_pam.txt", "w") as outnon:
-        for cluster in noncore:
-            pa = []
-            for el in noncore[cluster]:
-                if el == "----------":
-                    pa.append("0")
-                else:
-                    pa.append("1")
-            outnon.write("{0}\n".format("\t".join(pa)))
-
-    sizes_arg = []
-    counts_arg = []
-    n_sizes = Counter([len(filter(lambda x: x != "----------", noncore[cluster])) for cluster in noncore])
-
-    for n_size in n_sizes:
-        if int(n_size) < 10:
-            sizes_arg.append("n0" + str(n_size))
-        else:
-            sizes_arg.append("n" + str(n_size))
-        counts_arg.append(str(n_sizes[n_size] * int(n_size)))
+               archive_file(sub_results, "{0}/sub_BLASTs/results/{1}{2}".format(os.getcwd(), sub_results, suffix),
+                            compress)
 
-    core_count = len(flatten(core.values())) + len(filter(lambda x: x != "----------", flatten(softcore.values())))
-    sizes_arg.append("n" + str(total))
-    counts_arg.append(str(core_count))
+            ##### Checkpoint merge state after each completed size. #####
+            blasted.append("sub_BLASTs/results/ClusterBLAST_{0}.fasta.results{1}".format(str(size), suffix))
+            save_checkpoint(CHECKPOINT, panoct_clusters, iteration, size, noncore, softcore, total, blasted)
+            record_metrics(RUN_METRICS, "cluster_clean", "size{0}".format(size),
+                           {"proteins": len(to_blast), "residues": sum(len(db[seq].seq) for seq in to_blast)},
+                           usage.stop(), disk_usage(blasted[-1]), split_by)
+
+    write_cluster_tables(core, softcore, noncore, total)
+    for size in sorted(funnels, reverse=True):
+        funnels[size].write_table(FUNNEL_TABLE, size)
+
+    mainlogfile.write("Remaining noncore clusters after prediction analysis: {0}\n".format(len(noncore)))
+    mainlogfile.write(
+        "prediction analysis finished in {0} seconds. Thank you for choosing prediction, the friendly pangenome software.\n".format(
+            time.time() - start_time))
+    mainlogfile.write("=== Finished prediction job at {0}. ===\n".format(str(datetime.datetime.now())))
+
+
+def plan_cluster_clean(panoct_clusters, fasta_handle, cores, max_walltime, iterations=1):
+    """
+    Print predicted CPU time, memory and disk usage, and PBS resources, for cluster_clean.
 
-    core_proteome = len(flatten(core.values()))
-    softcore_proteome = len(filter(lambda x: x != "----------", flatten(softcore.values())))
-    noncore_proteome = len(filter(lambda x: x != "----------", flatten(noncore.values())))
+    Only reads the matchtable and protein lengths. Each cluster size BLASTs
+    at most every noncore protein, so predictions per size are upper bounds.
+    Predictions are calibrated against the usage recorded for cluster sizes
+    of previous runs in this directory (see Planning), if there are any.
+    """
+    matrix = ClusterMatrix.read(panoct_clusters)
+    noncore = matrix.select(matrix.sizes() < matrix.genomes)
+    proteins = noncore.genes[np.unique(noncore.members[noncore.members != ABSENT_INDEX])]
+    lengths = dict((seq.id, len(seq)) for seq in SeqIO.parse(open_text(fasta_handle), "fasta"))
+    features = {"proteins": len(proteins), "residues": sum(lengths[protein] for protein in proteins)}
+    sys.stdout.write("Matchtable of {0} clusters x {1} genomes: {2} noncore clusters of {3} proteins "
+                     "({4} residues).\n".format(len(matrix), matrix.genomes, len(noncore), features["proteins"],
+                                                 features["residues"]))
+    units = [("size{0}".format(size), features) for size in range(matrix.genomes - 1, 0, -1)]
+    model = CostModel("cluster_clean", read_metrics(RUN_METRICS, "cluster_clean"))
+    sys.stdout.write(plan(model, units, cores, max_walltime, repeats=iterations, sequential=True))
+
+
+def add_strain(matchtable_handle, fasta_handle, strain_faa, split_by=4, min_id_cutoff=30, strain_cutoff=1.0,
+               blast_timeout=None, search="blastp"):
+    """
+    Incrementally add a newly predicted strain to a finished post-processing run.
+
+    Takes the merged matchtable from a previous cluster_clean run and adds a
+    column for the new strain, whose proteins start off as singleton clusters.
+    Every existing cluster is now missing the new strain, so all clusters are
+    treated as noncore. Rather than a full all-vs.-all search, only the new
+    strain's proteins are BLASTed against all proteins and all proteins are
+    BLASTed against the new strain's proteins (with the effective database size
+    of the full set, so e-values match a full search). Merging between existing
+    clusters has already been evaluated, so gap_finder is only run on clusters
+    which contain or hit a new protein.
 
-    mainlogfile.write("====Core: {0} clusters, {1} proteins."
-                      "Softcore: {2} clusters, {3} proteins."
-                      "Accessory: {4} clusters, {5} proteins.\n====".format(core.keys(), core_proteome, softcore.keys(), softcore_proteome, noncore.keys(), noncore_proteome))
+    Arguments:
+        matchtable_handle = Merged matchtable from a previous run (i.e. new_matchtable.txt).
+        fasta_handle      = FASTA database of all proteins, new strain's proteins are appended if missing.
+        strain_faa        = Final protein set of the new strain (i.e. gene_calling/<tag>/<tag>.faa).
+        search            = Search backend for parallel_BLAST (see Search.BACKENDS).
+    """
+    ##### Load new strain's proteins and add them to the protein database if needed. #####
+    new_ids = [seq.id for seq in SeqIO.parse(open_text(strain_faa), "fasta")]
+    if not new_ids:
+        mainlogfile.write("{0} contains no proteins (no genes were predicted?), nothing to add. Exiting!\n".format(
+            strain_faa))
+        exit(1)
+    tag = new_ids[0].split("|")[0]
+    db = SeqIO.index(indexable(fasta_handle), "fasta")
+    missing = [seq_id for seq_id in new_ids if seq_id not in db]
+    db.close()
+    if missing:
+        missing = set(missing)
+        with open_output(fasta_handle, append=True) as outfast:
+            for seq in unique_records(SeqIO.parse(open_text(strain_faa), "fasta")):
+                if seq.id in missing:
+                    outfast.write(">{0}\n{1}\n".format(seq.id, seq.seq))
+        mainlogfile.write("Added {0} proteins from {1} to {2}...\n".format(len(missing), strain_faa, fasta_handle))
+    db = SeqIO.index(indexable(fasta_handle), "fasta")
+
+    ##### Load previous matchtable, adding an empty column for the new strain. #####
+    matrix = ClusterMatrix.read(matchtable_handle)
+    if np.char.startswith(matrix.genes, "{0}|".format(tag)).any():
+        raise ValueError("Strain {0} is already present in {1}.".format(tag, matchtable_handle))
+    total = matrix.genomes + 1
+    core = ClusterMatrix.from_clusters({}, total)
+    noncore = od((cluster, members + [ABSENT]) for cluster, members in matrix.to_clusters().items())
+    softcore = {}
+    if all(cluster.isdigit() for cluster in noncore):
+        next_cluster = max(int(cluster) for cluster in noncore) + 1
+        new_clusters = [str(next_cluster + i) for i in range(len(new_ids))]
+    else:
+        new_clusters = ["{0}_{1}".format(tag, i + 1) for i in range(len(new_ids))]
+    for cluster, seq_id in zip(new_clusters, new_ids):
+        noncore[cluster] = ["----------"] * (total - 1) + [seq_id]
+    mainlogfile.write("Adding {0} ({1} proteins) to {2} clusters from {3}...\n".format(tag, len(new_ids),
+                                                                                     len(noncore) - len(new_ids),
+                                                                                     matchtable_handle))
+
+    ##### BLAST new-vs.-all and all-vs.-new, with e-values relative to the full protein set. #####
+    old_ids = filter(lambda x: x != "----------", flatten([noncore[key][:-1] for key in noncore]))
+    all_ids = old_ids + new_ids
+    dbsize = sum(len(db[seq].seq) for seq in all_ids)
+    parallel_BLAST(new_ids, db, split_by, "StrainBLAST_{0}_new.fasta".format(tag), db_genes=all_ids, dbsize=dbsize,
+                   timeout=blast_timeout, search=search)
+    parallel_BLAST(old_ids, db, split_by, "StrainBLAST_{0}_old.fasta".format(tag), db_genes=new_ids, dbsize=dbsize,
+                   timeout=blast_timeout, search=search)
+    with open("StrainBLAST_{0}.fasta.results".format(tag), "w") as outresults:
+        for part in ["new", "old"]:
+            with open("StrainBLAST_{0}_{1}.fasta.results".format(tag, part)) as inresults:
+                shutil.copyfileobj(inresults, outresults)
+            os.remove("StrainBLAST_{0}_{1}.fasta.results".format(tag, part))
+    results = SearchIO.index("StrainBLAST_{0}.fasta.results".format(tag), "blast-tab", fields=blast_fields)
+
+    ##### Only clusters containing or hitting a new protein can be merged. #####
+    protein_cluster = {}
+    for cluster in noncore:
+        for member in noncore[cluster]:
+            if member != "----------":
+                protein_cluster[member] = cluster
+    candidates = set(new_clusters)
+    for query in results:
+        for hit in results[query].hits:
+            candidates.add(protein_cluster[query])
+            candidates.add(protein_cluster[hit.id])
+    mainlogfile.write("{0} clusters can potentially merge with {1}...\n".format(len(candidates), tag))
+
+    ##### Run gap_finder and merge clusters from size (total - 1) to 1. #####
+    for size in range(total - 1, 0, -1):
+        subset = {cluster: noncore[cluster] for cluster in candidates if cluster in noncore}
+        mainlogfile.write("Finding potential homology gaps in clusters of size {0}...\n".format(str(size)))
+        funnel = Funnel(GAP_FINDER_STAGES)
+        with stage("gap_finder", label="{0}_size{1}".format(tag, size)):
+            gaps = gap_finder(results, db, subset, total, size, min_id_cutoff, strain_cutoff, funnel)
+        mainlogfile.write(funnel.report("gap_finder funnel for clusters of size {0}".format(size)))
+        funnel.write_table(FUNNEL_TABLE, size)
+        with stage("merge_gaps", label="{0}_size{1}".format(tag, size)):
+            filled_count, merged_count = merge_gaps(gaps, noncore, softcore, total)
+        mainlogfile.write(
+            "At cluster size (n = {0}): merged {1} homologous clusters into {2} softcore clusters.\n".format(
+                size, filled_count, filled_count / 2))
+        mainlogfile.write(
+            "At cluster size (n = {0}): merged {1} homologous clusters into {2} noncore clusters.\n".format(
+                size, merged_count, merged_count / 2))
+
+    write_cluster_tables(core, softcore, noncore, total)
+
+    mainlogfile.write("Remaining noncore clusters after adding {0}: {1}\n".format(tag, len(noncore)))
+    mainlogfile.write("=== Finished prediction job at {0}. ===\n".format(str(datetime.datetime.now())))
+
+
+def write_cluster_tables(core, softcore, noncore, total):
+    """
+    Write merged matchtables and PAMs, and plot them using R.
 
+    core is a ClusterMatrix, softcore and noncore are dicts of cluster ID:
+    members, which are converted to ClusterMatrix objects so that tables,
+    PAMs and counts are written and computed in bulk. The merged matchtable
+    is also saved as memory-mappable .npy files (see Matchtable).
+    """
+    softcore = ClusterMatrix.from_clusters(softcore, total)
+    noncore = ClusterMatrix.from_clusters(noncore, total)
+    merged = ClusterMatrix.concatenate([core, softcore, noncore])
+    merged.write_table("new_matchtable.txt")
+    merged.save("new_matchtable.txt")
+    softcore.write_table("new_softtable.txt")
+    noncore.write_table("new_nontable.txt")
+    softcore.write_pam("softcore_pam.txt")
+    noncore.write_pam("noncore_pam.txt")
+
+    ##### Proteins per noncore cluster size, plus core and softcore proteins, for the ring chart. #####
+    n_sizes = noncore.size_distribution()
+    sizes_arg = ["n{0:02d}".format(n_size) for n_size in np.flatnonzero(n_sizes)]
+    counts_arg = [str(n_sizes[n_size] * n_size) for n_size in np.flatnonzero(n_sizes)]
+    core_proteome = core.proteome()
+    softcore_proteome = softcore.proteome()
+    noncore_proteome = noncore.proteome()
+    sizes_arg.append("n" + str(total))
+    counts_arg.append(str(core_proteome + softcore_proteome))
 
+    mainlogfile.write("====Core: {0} clusters, {1} proteins. "
+                      "Softcore: {2} clusters, {3} proteins. "
+                      "Accessory: {4} clusters, {5} proteins.====\n".format(len(core), core_proteome, len(softcore),
+                                                                            softcore_proteome, len(noncore),
+                                                                            noncore_proteome))
 
     ring_plot = ["Rscript", "{0}/PlotRingChart.R".format(dirname), str(core_proteome), str(softcore_proteome), str(noncore_proteome), ",".join(size for size in sizes_arg), ",".join(count for count in counts_arg)]
     try:
@@ -441,12 +783,6 @@ def cluster_clean(panoct_clusters, fasta_handle, split_by=4, min_id_cutoff=30, s
             mainlogfile.write("Unable to run R script PlotUsingUpSet.R. Run command manually:\n")
             mainlogfile.write(" ".join(upset_plot) + "\n")
 
-    mainlogfile.write("Remaining noncore clusters after prediction analysis: {0}\n".format(len(noncore)))
-    mainlogfile.write(
-        "prediction analysis finished in {0} seconds. Thank you for choosing prediction, the friendly pangenome software.\n".format(
-            time.time() - start_time))
-    mainlogfile.write("=== Finished prediction job at {0}. ===\n".format(str(datetime.datetime.now())))
-
 
 ##### Here we define the workflow for prediction. #####
 
@@ -455,24 +791,65 @@ def main():
     """
     Main software workflow.
     """
-    cluster_clean("matchtable.txt", "panoct_db.fasta", split_by=cores, strain_cutoff=1.0)
+    if args.plan:
+        plan_cluster_clean(args.matchtable, args.fasta, args.plan_cores, args.plan_walltime * 3600)
+    elif args.add_strain:
+        add_strain(args.matchtable, args.fasta, args.add_strain, split_by=cores, strain_cutoff=1.0,
+                   blast_timeout=args.blast_timeout, search=args.search)
+    else:
+        cluster_clean(args.matchtable, args.fasta, split_by=cores, strain_cutoff=1.0,
+                      blast_timeout=args.blast_timeout, resume=args.resume, compress=args.compress,
+                      sketch_threshold=args.sketch_threshold, search=args.search)
 
 
 if __name__ == "__main__":
+    ##### Parse arguments. #####
+    parser = argparse.ArgumentParser(description="Post-processing of PanOCT clusters.")
+    parser.add_argument("--matchtable", default="matchtable.txt",
+                        help="PanOCT matchtable, or merged matchtable from a previous run with --add-strain.")
+    parser.add_argument("--fasta", default="panoct_db.fasta", help="FASTA database of all proteins.")
+    parser.add_argument("--add-strain", metavar="FAA",
+                        help="Add a new strain's proteins to a previous run (e.g. --matchtable new_matchtable.txt).")
+    parser.add_argument("--blast-timeout", type=float, metavar="SECONDS",
+                        help="Kill BLASTp parts after this long and drop their results (default: no timeout).")
+    parser.add_argument("--compress", action="store_true",
+                        help="Archive per-size proteins and BLAST results in sub_BLASTs BGZF-compressed.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted run from {0}, reusing finished BLAST results.".format(CHECKPOINT))
+    parser.add_argument("--search", choices=sorted(BACKENDS), default="blastp",
+                        help="Protein search backend (default: blastp). numpy needs no external programs, "
+                             "but is only fast enough for small sets of proteins.")
+    parser.add_argument("--sketch-threshold", type=float, metavar="JACCARD",
+                        help="Only BLAST noncore proteins against candidate homologs whose MinHash sketches of "
+                             "4-mers exceed this Jaccard similarity, e.g. 0.1 (default: all-vs.-all).")
+    parser.add_argument("--plan", action="store_true",
+                        help="Only predict CPU time, memory, disk and PBS resources for cluster_clean, without "
+                             "running it.")
+    parser.add_argument("--plan-cores", type=int, default=allocated_cpus(), metavar="N",
+                        help="CPUs to plan for with --plan (default: CPUs allocated now).")
+    parser.add_argument("--plan-walltime", type=float, default=48, metavar="HOURS",
+                        help="Walltime limit per job, beyond which --plan suggests consecutive --resume jobs "
+                             "(default: 48).")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="Write per-stage profiles to DIR (default: $PANPIPES_PROFILE, or no profiling).")
+    args = parser.parse_args()
+    configure(args.profile)
+
     ##### Open log files. #####
     mainlogfile = open("prediction.log", "a", 0)  # Flush to log immediately.
     mainlogfile.write("\n=== Started prediction job at {0}. ===\n".format(str(datetime.datetime.now())))
     start_time = time.time()
     subblastlog = open("parallel_BLAST.log", "a", 0)  # Log for parallel_BLAST.
     subblastlog.write("\n=== Started prediction job at {0}. ===\n".format(str(datetime.datetime.now())))
+    joblog = open("Jobs.log", "a", 0)  # Per-job records for BLASTp parts.
 
     ##### Define custom columns for parallel_BLAST. #####
     blast_fields = ['qseqid', 'sseqid', 'pident', 'length', 'mismatch', 'gapopen',
                     'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore',
                     'qlen', 'slen']
 
-    ##### Set default amount of cores used. #####
-    cores = mp.cpu_count() - 1
+    ##### Set default amount of cores used, from the CPUs allocated to the job. #####
+    cores = token_pool().tokens
 
     ##### Get absolute path of script, for running R commands. #####
     dirname = os.path.dirname(os.path.abspath(__file__))
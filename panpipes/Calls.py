@@ -0,0 +1,199 @@
+"""
+Columnar store for a strain's gene calls.
+
+Gene calls from exonerate, GeneMark-ES and TransDecoder are held as NumPy
+arrays (contig codes, int32 start/end, a source code, gene IDs and
+annotations) instead of lists of TSV rows, so that merging, overlap checks
+and sorting are array operations, and intermediate results are saved as
+.npz files instead of being re-parsed from text at every step. TSV is only
+written for PanOCT (see write_tsv).
+
+Contig codes index into the sorted list of contig IDs, so sorting by code
+then start gives the same (contig, start) order as the TSV-based code did.
+"""
+
+import heapq
+
+import numpy as np
+
+# Source codes, in order of the annotation prefix each source writes.
+SOURCES = ["Exonerate", "GeneMark", "TransDecoder"]
+EXONERATE, GENEMARK, TRANSDECODER = range(len(SOURCES))
+
+
+class GeneCalls:
+    """
+    A set of gene calls for one strain, held as parallel arrays.
+    """
+
+    def __init__(self, contigs, contig, start, end, source, ids, annotations, tag):
+        """
+        - contigs:     Sorted array of contig IDs.
+        - contig:      Index into contigs of each call's contig.
+        - start, end:  Genomic location of each call (start <= end).
+        - source:      Source code of each call (see SOURCES).
+        - ids:         Gene ID of each call.
+        - annotations: Attribute string of each call (e.g. "GeneMark=1_g;IS=False;Introns=0").
+        - tag:         Strain tag.
+        """
+        self.contigs = contigs
+        self.contig = contig
+        self.start = start
+        self.end = end
+        self.source = source
+        self.ids = ids
+        self.annotations = annotations
+        self.tag = tag
+
+    @classmethod
+    def from_rows(cls, rows, tag):
+        """
+        Build a GeneCalls object from attribute rows: [contig, id, start, end, annotations, ...].
+        """
+        rows = list(rows)
+        contig_ids = np.array([row[0] for row in rows], dtype=str)
+        contigs, contig = np.unique(contig_ids, return_inverse=True)
+        annotations = np.array([row[4] for row in rows], dtype=str)
+        source = np.zeros(len(rows), dtype=np.uint8)
+        for code, name in enumerate(SOURCES):
+            source[np.char.startswith(annotations, name)] = code
+        return cls(contigs, contig.astype(np.int32),
+                   np.array([int(row[2]) for row in rows], dtype=np.int32),
+                   np.array([int(row[3]) for row in rows], dtype=np.int32),
+                   source, np.array([row[1] for row in rows], dtype=str), annotations, tag)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a GeneCalls object saved with save.
+        """
+        data = np.load(path)
+        try:
+            return cls(data["contigs"], data["contig"], data["start"], data["end"], data["source"],
+                       data["ids"], data["annotations"], str(data["tag"]))
+        finally:
+            data.close()
+
+    @classmethod
+    def concatenate(cls, calls):
+        """
+        Combine several GeneCalls objects (for the same strain) into one, in the given order.
+        """
+        contigs = np.unique(np.concatenate([each.contigs for each in calls]))
+        return cls(contigs,
+                   np.concatenate([np.searchsorted(contigs, each.contigs)[each.contig] for each in calls]).astype(
+                       np.int32),
+                   np.concatenate([each.start for each in calls]),
+                   np.concatenate([each.end for each in calls]),
+                   np.concatenate([each.source for each in calls]),
+                   np.concatenate([each.ids for each in calls]),
+                   np.concatenate([each.annotations for each in calls]),
+                   calls[0].tag)
+
+    @classmethod
+    def merge(cls, calls):
+        """
+        Merge GeneCalls objects that are each sorted by (contig, start) into one sorted object.
+
+        A k-way merge of the sorted stores, keeping the given order of stores for ties.
+        """
+        combined = cls.concatenate(calls)
+        bounds = np.cumsum([0] + [len(each) for each in calls])
+        streams = [_keyed_calls(combined, store, bounds[store], bounds[store + 1]) for store in range(len(calls))]
+        order = np.array([index for _, index in heapq.merge(*streams)], dtype=np.int64)
+        return combined.select(order)
+
+    def __len__(self):
+        return len(self.start)
+
+    def save(self, path):
+        """
+        Save the calls to an (uncompressed) .npz file.
+        """
+        np.savez(path, contigs=self.contigs, contig=self.contig, start=self.start, end=self.end,
+                 source=self.source, ids=self.ids, annotations=self.annotations, tag=self.tag)
+
+    def select(self, index):
+        """
+        Return a subset of the calls, given a boolean mask or array of indices.
+        """
+        return GeneCalls(self.contigs, self.contig[index], self.start[index], self.end[index],
+                         self.source[index], self.ids[index], self.annotations[index], self.tag)
+
+    def sorted(self):
+        """
+        Return the calls sorted by (contig, start), keeping the existing order of ties.
+        """
+        return self.select(np.lexsort((self.start, self.contig)))
+
+    def contig_slices(self):
+        """
+        Yield (contig ID, slice) for each contig with calls, for calls sorted by contig.
+        """
+        bounds = np.searchsorted(self.contig, np.arange(len(self.contigs) + 1))
+        for code, contig_id in enumerate(self.contigs):
+            if bounds[code] < bounds[code + 1]:
+                yield contig_id, slice(bounds[code], bounds[code + 1])
+
+    def final_ids(self):
+        """
+        Return each call's ID in the final protein set.
+
+        Exonerate calls keep their IDs (already tag|contig_start_stop), while
+        GeneMark-ES and TransDecoder calls are renamed to tag|contig_start_stop.
+        """
+        ids = self.ids.astype(object)
+        renamed = np.flatnonzero(self.source != EXONERATE)
+        for index in renamed:
+            ids[index] = "{0}|{1}_{2}_{3}".format(self.tag, self.contigs[self.contig[index]], self.start[index],
+                                                  self.end[index])
+        return ids
+
+    def rows(self, ids=None):
+        """
+        Yield the calls as attribute rows: [contig, id, start, end, annotations, tag].
+        """
+        ids = self.ids if ids is None else ids
+        for index in range(len(self)):
+            yield [self.contigs[self.contig[index]], ids[index], str(self.start[index]), str(self.end[index]),
+                   self.annotations[index], self.tag]
+
+    def write_tsv(self, path, ids=None):
+        """
+        Write the calls as a tab-separated attributes file (e.g. for PanOCT).
+        """
+        with open(path, "w", 1 << 20) as outfile:
+            for row in self.rows(ids):
+                outfile.write("\t".join(row) + "\n")
+
+
+def _keyed_calls(calls, store, first, last):
+    """
+    Yield ((contig, start, store), index) for a sorted run of calls, for merging.
+    """
+    for index, contig, start in zip(range(first, last), calls.contig[first:last].tolist(),
+                                    calls.start[first:last].tolist()):
+        yield (contig, start, store), index
+
+
+def within_any(starts, ends, points):
+    """
+    Return whether each point lies within (inclusive) any of a set of intervals.
+
+    Intervals can overlap each other and needn't be sorted.
+    """
+    if not len(starts):
+        return np.zeros(len(points), dtype=bool)
+    order = np.argsort(starts, kind="mergesort")
+    # Furthest end of any interval starting at or before each sorted start.
+    reach = np.maximum.accumulate(ends[order])
+    index = np.searchsorted(starts[order], points, side="right") - 1
+    return (index >= 0) & (reach[np.maximum(index, 0)] >= points)
+
+
+def count_within(values, lefts, rights):
+    """
+    Return how many of a set of values lie within (inclusive) each of a set of intervals.
+    """
+    values = np.sort(values)
+    return np.searchsorted(values, rights, side="right") - np.searchsorted(values, lefts, side="left")
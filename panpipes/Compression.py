@@ -0,0 +1,191 @@
+"""
+Transparent reading of compressed inputs, and parallel block-compressed (BGZF) writing.
+
+Genomes, protein sets, BLAST results and intermediates can be plain, gzip or
+BGZF (bgzip) compressed:
+
+    - Streaming readers use open_text, which reads all three.
+    - SeqIO.index and SearchIO.index already read BGZF files with random
+      access (through virtual offsets into the compressed blocks), so index
+      call sites go through indexable, which only has to recompress plain
+      gzip files to BGZF, once, next to the original.
+    - External tools (exonerate, GeneMark-ES, TransDecoder) and memory-mapped
+      readers need plain files, so uncompressed() decompresses to node-local
+      scratch ($TMPDIR), which also keeps that traffic off shared filesystems.
+
+BlockWriter writes BGZF, compressing 64 KB blocks in a pool of threads (zlib
+releases the GIL while compressing), so compressed output stays randomly
+accessible and isn't limited to one core's compression speed.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# Uncompressed bytes per BGZF block (as in samtools), small enough that a block never outgrows 64 KB compressed.
+BLOCK_SIZE = 0xff00
+BGZF_HEADER = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+BGZF_EOF = BGZF_HEADER + "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def compression(path):
+    """
+    Return "bgzf", "gzip" or None (uncompressed) for a file.
+    """
+    with open(path, "rb") as infile:
+        header = infile.read(16)
+    if not header.startswith("\x1f\x8b"):
+        return None
+    elif len(header) == 16 and ord(header[3]) & 4 and header[12:14] == "BC":
+        return "bgzf"
+    else:
+        return "gzip"
+
+
+def open_text(path):
+    """
+    Open a plain, gzip or BGZF file for streaming reads.
+    """
+    return gzip.open(path, "rb") if compression(path) else open(path)
+
+
+def _is_current(derived, path):
+    return os.path.isfile(derived) and os.path.getmtime(derived) >= os.path.getmtime(path)
+
+
+def indexable(path, threads=1):
+    """
+    Return a path to the same data that SeqIO.index/SearchIO.index can read (plain or BGZF).
+
+    Plain gzip files are recompressed to <path>.bgz, unless that is already up to date.
+    """
+    if compression(path) != "gzip":
+        return path
+    bgzf = "{0}.bgz".format(path)
+    if not _is_current(bgzf, path):
+        compress_file(path, bgzf, threads)
+    return bgzf
+
+
+def uncompressed(path, directory=None):
+    """
+    Return a plain copy of a compressed file (or path itself, if it isn't compressed).
+
+    Copies are written to directory (default: $TMPDIR, i.e. node-local
+    scratch on most clusters) and reused while they're up to date.
+    """
+    if not compression(path):
+        return path
+    name = os.path.basename(path)
+    for suffix in [".gz", ".bgz", ".bgzf"]:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    # Named by the original's full path too, as different genomes are often called e.g. genome.fasta.gz.
+    copy = os.path.join(directory or tempfile.gettempdir(), "panpipes_{0}_{1}_{2}".format(
+        os.getuid(), hashlib.md5(os.path.abspath(path)).hexdigest()[:8], name))
+    if not _is_current(copy, path):
+        with gzip.open(path, "rb") as infile, open("{0}.{1}".format(copy, os.getpid()), "wb") as outfile:
+            shutil.copyfileobj(infile, outfile, 1 << 20)
+        os.rename("{0}.{1}".format(copy, os.getpid()), copy)
+    return copy
+
+
+def compress_block(block, level=6):
+    """
+    Return one BGZF block holding block (at most 64 KB of data).
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, 0)
+    compressed = compressor.compress(block) + compressor.flush()
+    return "".join([BGZF_HEADER, struct.pack("<H", len(compressed) + 25), compressed,
+                    struct.pack("<I", zlib.crc32(block) & 0xffffffff), struct.pack("<I", len(block))])
+
+
+class BlockWriter:
+    """
+    File-like writer of BGZF output, compressing blocks in a thread pool.
+    """
+
+    def __init__(self, path, threads=1, level=6, append=False):
+        """
+        - path:    Output file.
+        - threads: Number of compression threads.
+        - level:   zlib compression level.
+        - append:  Add blocks to the end of an existing BGZF file instead of replacing it.
+        """
+        self._handle = open(path, "ab" if append else "wb")
+        if append and self._handle.tell() >= len(BGZF_EOF):
+            # Readers stop at the empty end-of-file block, so new blocks have to replace it.
+            with open(path, "rb") as infile:
+                infile.seek(-len(BGZF_EOF), os.SEEK_END)
+                if infile.read() == BGZF_EOF:
+                    self._handle.truncate(self._handle.tell() - len(BGZF_EOF))
+        self._threads = max(1, threads)
+        self._pool = ThreadPool(self._threads) if self._threads > 1 else None
+        self._level = level
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered = self._buffered + len(data)
+        if self._buffered >= BLOCK_SIZE * self._threads * 4:
+            self._flush_blocks(final=False)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _flush_blocks(self, final):
+        data = "".join(self._buffer)
+        end = len(data) if final else len(data) - len(data) % BLOCK_SIZE
+        blocks = [data[start:start + BLOCK_SIZE] for start in range(0, end, BLOCK_SIZE)]
+        if self._pool is not None:
+            compressed = self._pool.map(lambda block: compress_block(block, self._level), blocks)
+        else:
+            compressed = [compress_block(block, self._level) for block in blocks]
+        self._handle.write("".join(compressed))
+        self._buffer = [data[end:]] if end < len(data) else []
+        self._buffered = len(data) - end
+
+    def close(self):
+        if self._handle.closed:
+            return
+        self._flush_blocks(final=True)
+        self._handle.write(BGZF_EOF)
+        self._handle.close()
+        if self._pool is not None:
+            self._pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compress_file(source, destination, threads=1):
+    """
+    Write a (plain or compressed) file's contents to destination as BGZF.
+    """
+    with open_text(source) as infile, BlockWriter(destination, threads) as outfile:
+        shutil.copyfileobj(infile, outfile, BLOCK_SIZE * max(1, threads) * 4)
+
+
+def open_output(path, threads=1, append=False):
+    """
+    Open a text file for writing, as BGZF if path ends in .gz or .bgz, or when appending to a BGZF file.
+
+    Appending to plain gzip files adds a gzip member.
+    """
+    existing = compression(path) if append and os.path.isfile(path) and os.path.getsize(path) else None
+    if existing == "bgzf" or (existing is None and path.endswith((".gz", ".bgz"))):
+        return BlockWriter(path, threads, append=append)
+    elif existing == "gzip":
+        return gzip.open(path, "ab")
+    else:
+        return open(path, "a" if append else "w", 1 << 20)
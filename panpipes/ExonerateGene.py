@@ -21,6 +21,7 @@ class ExonerateGene:
         - internal_stop: Internal stop codon present or not.
         - introns:       Number of introns in called gene.
         - called:        Called gene's translated protein sequence.
+        - score:         Raw exonerate score of the alignment.
 
         All attributes above are derived ultimately from exonerate output.
 
@@ -34,12 +35,14 @@ class ExonerateGene:
         """
         contig_id = ""
         introns = 0
+        score = 0
         called = []
         for result in SearchIO.parse(string, "exonerate-text"):
             ref = result.id
             stop = False
             for hit in result:
                 contig_id = hit.id
+                score = hit[0].score
                 called = []
                 introns = len(hit[0].hit_inter_ranges)
                 for fragment in hit[0].fragments:
@@ -53,6 +56,7 @@ class ExonerateGene:
             self.internal_stop = "IS={0}".format(str(stop))
             self.introns = "Introns={0}".format(str(introns))
             self.called = "".join(called)
+            self.score = score
         string.seek(0)
         for result in SearchIO.parse(string, "exonerate-vulgar"):
             for hit in result:
@@ -0,0 +1,195 @@
+"""
+Pre-built exonerate genome indexes, searched through local exonerate-server instances.
+
+Every plain exonerate job reads its target genome from FASTA and builds a
+word index of it from scratch, which for short reference proteins against
+large genomes is most of the job's runtime. Instead, a genome can be
+converted once into exonerate's sequence database (fasta2esd, .esd) and a
+translated word index (esd2esi, .esi), and served by exonerate-server
+processes. Jobs then give "localhost:<port>" as their target, and only do
+the alignment itself.
+
+Indexes are kept in a directory and reused while they're newer than their
+genome. Servers run in a with block (ExonerateServers), and are stopped when
+it exits for any reason, including exceptions and SIGTERM (e.g. from a PBS
+job being deleted).
+"""
+
+import errno
+import hashlib
+import os
+import signal
+import socket
+import subprocess as sp
+import time
+
+# Exonerate jobs (clients) per server: clients do the alignment, servers only look up words.
+CLIENTS_PER_SERVER = 4
+# Ports tried per server, as another process can take a port between free_port and the server binding it.
+START_ATTEMPTS = 3
+
+
+def _is_current(derived, path):
+    return os.path.isfile(derived) and os.path.getmtime(derived) >= os.path.getmtime(path)
+
+
+def build_index(genome, directory, log=None):
+    """
+    Return the .esi index of a genome in directory, building it (and its .esd) if missing or outdated.
+
+    Files are written under temporary names and then renamed, so concurrent runs never use a partial index.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Named by the genome's full path too, as different genomes are often called e.g. genome.fasta.
+    prefix = os.path.join(directory, "{0}_{1}".format(os.path.splitext(os.path.basename(genome))[0],
+                                                      hashlib.md5(os.path.abspath(genome)).hexdigest()[:8]))
+    esd, esi = "{0}.esd".format(prefix), "{0}.esi".format(prefix)
+    if not _is_current(esd, genome):
+        sp.check_call(["fasta2esd", "--softmask", "no", genome, "{0}.{1}".format(esd, os.getpid())], stdout=log,
+                      stderr=log)
+        os.rename("{0}.{1}".format(esd, os.getpid()), esd)
+    if not _is_current(esi, esd):
+        # The index refers to the .esd by path, so it's built from the final .esd.
+        sp.check_call(["esd2esi", esd, "{0}.{1}".format(esi, os.getpid()), "--translate", "yes"], stdout=log,
+                      stderr=log)
+        os.rename("{0}.{1}".format(esi, os.getpid()), esi)
+    return esi
+
+
+def free_port():
+    """
+    Return a TCP port on localhost that nothing is listening on (at the time).
+    """
+    probe = socket.socket()
+    probe.bind(("localhost", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def serving(process, port):
+    """
+    Return whether a server process (a Popen) is accepting connections on port.
+
+    Where /proc is available, the listening socket must be one of the process's own: a connection alone
+    could reach another process on the same port, e.g. another worker's server for a different genome.
+    """
+    pid = process.pid
+    if not os.path.isdir("/proc/{0}/fd".format(pid)):
+        try:
+            socket.create_connection(("localhost", port), 1).close()
+        except socket.error:
+            return False
+        time.sleep(1)  # A server that lost the port to another process exits on bind.
+        return process.poll() is None
+    sockets = set()
+    for table in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        if os.path.isfile(table):
+            with open(table) as infile:
+                next(infile)
+                for line in infile:
+                    fields = line.split()
+                    if int(fields[1].rsplit(":", 1)[1], 16) == port and fields[3] == "0A":  # 0A: LISTEN.
+                        sockets.add("socket:[{0}]".format(fields[9]))
+    for fd in os.listdir("/proc/{0}/fd".format(pid)):
+        try:
+            if os.readlink("/proc/{0}/fd/{1}".format(pid, fd)) in sockets:
+                return True
+        except OSError:  # Closed since listing.
+            continue
+    return False
+
+
+class ExonerateServers:
+    """
+    Local exonerate-server processes for one index, running for the duration of a with block.
+    """
+
+    def __init__(self, esi, count=1, log=None, startup=600):
+        """
+        - esi:     Index to serve (see build_index).
+        - count:   Number of servers.
+        - log:     File handle for the servers' output.
+        - startup: Seconds to wait for a server to load its index and accept connections.
+        """
+        self.esi = esi
+        self.count = max(1, count)
+        self.log = log
+        self.startup = startup
+        self.servers = []  # (port, Popen) of running servers.
+        self._sigterm = None
+
+    def targets(self):
+        """
+        Return the servers' addresses, for exonerate's -t option.
+        """
+        return ["localhost:{0}".format(port) for port, _ in self.servers]
+
+    def __enter__(self):
+        # Stop the servers if we're terminated, by turning SIGTERM into SystemExit so __exit__ runs.
+        self._sigterm = signal.signal(signal.SIGTERM, _terminate)
+        try:
+            for _ in range(self.count):
+                self.servers.append(self._start())
+            for index in range(len(self.servers)):
+                self._wait(index)
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def _start(self):
+        port = free_port()
+        return port, sp.Popen(["exonerate-server", self.esi, "--port", str(port)], stdout=self.log, stderr=self.log)
+
+    def _wait(self, index):
+        """
+        Wait until a server accepts connections, restarting it on a new port if it exits (e.g. failing to bind).
+        """
+        deadline = time.time() + self.startup
+        attempts = 1
+        while True:
+            port, process = self.servers[index]
+            if process.poll() is not None:
+                if attempts == START_ATTEMPTS:
+                    raise RuntimeError("exonerate-server for {0} exited with code {1} on start-up.".format(
+                        self.esi, process.returncode))
+                attempts = attempts + 1
+                self.servers[index] = self._start()
+                continue
+            if serving(process, port):
+                return
+            if time.time() > deadline:
+                raise RuntimeError("exonerate-server for {0} not ready after {1} seconds.".format(
+                    self.esi, self.startup))
+            time.sleep(0.5)
+
+    def stop(self, grace=10):
+        """
+        Terminate every server, killing any still running after grace seconds.
+        """
+        for _, process in self.servers:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.time() + grace
+        for _, process in self.servers:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.servers = []
+        if self._sigterm is not None:
+            signal.signal(signal.SIGTERM, self._sigterm)
+            self._sigterm = None
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _terminate(signum, frame):
+    raise SystemExit("Terminated by signal {0}.".format(signum))
@@ -0,0 +1,84 @@
+"""
+Streaming parsers for the GTF/GFF3 feature files produced by gene predictors.
+
+GeneMark-ES and TransDecoder both write one gene's features (gene, mRNA, exon,
+CDS rows, &c.) as a consecutive block of rows. Rather than collecting every
+row, these generators reduce each block to one compact Feature record as the
+rows stream in, and the records can then be ordered by contig and start by
+merging each contig's already-sorted runs instead of sorting everything.
+"""
+
+import heapq
+from collections import defaultdict, namedtuple
+
+# One record per gene: extent (min/max of all its rows' co-ordinates) and exon count.
+Feature = namedtuple("Feature", ["contig", "id", "start", "end", "exons"])
+
+
+def feature_rows(rows):
+    """
+    Yield only feature rows (nine columns) from a CSV reader of a GTF/GFF file.
+
+    Comment lines, blank separator lines and the like are skipped.
+    """
+    for row in rows:
+        if len(row) == 9 and not row[0].startswith("#"):
+            yield row
+
+
+def group_features(rows, key, exon_type="exon"):
+    """
+    Yield a Feature for each consecutive block of rows belonging to one gene.
+
+    key(row) returns the gene ID a row starts or belongs to, or None for rows
+    that continue the current gene (e.g. TransDecoder's mRNA/exon/CDS rows,
+    which only carry the ID on the gene row). Contig IDs are the first word of
+    the sequence column.
+    """
+    current = None
+    for row in feature_rows(rows):
+        gene_id = key(row)
+        left, right = sorted((int(row[3]), int(row[4])))
+        exon = 1 if row[2] == exon_type else 0
+        if current is None or (gene_id is not None and gene_id != current[1]):
+            if current is not None:
+                yield Feature(*current)
+            current = [row[0].split(" ")[0], gene_id, left, right, exon]
+        else:
+            current[2] = min(current[2], left)
+            current[3] = max(current[3], right)
+            current[4] = current[4] + exon
+    if current is not None:
+        yield Feature(*current)
+
+
+def sorted_features(features):
+    """
+    Yield features ordered by (contig, start).
+
+    Predictors write each contig's genes mostly in order, so features are
+    split into runs of ascending start per contig and each contig's runs are
+    merged, which is linear for already-sorted input. Ties keep input order.
+    """
+    runs = defaultdict(list)
+    for feature in features:
+        contig_runs = runs[feature.contig]
+        if not contig_runs or feature.start < contig_runs[-1][-1].start:
+            contig_runs.append([])
+        contig_runs[-1].append(feature)
+    for contig in sorted(runs):
+        if len(runs[contig]) == 1:
+            for feature in runs[contig][0]:
+                yield feature
+        else:
+            streams = [_decorate(run, index) for index, run in enumerate(runs[contig])]
+            for _, feature in heapq.merge(*streams):
+                yield feature
+
+
+def _decorate(run, index):
+    """
+    Key a run of features for merging by start, breaking ties by run order.
+    """
+    for feature in run:
+        yield (feature.start, index), feature
@@ -0,0 +1,77 @@
+"""
+Counters and cumulative timers for a chain of filter stages.
+
+A Funnel records, for each named stage of a filter pipeline (e.g. the
+nested checks in gap_finder), how many candidates reached it, how many
+passed it and how long the stage took in total. Each check costs a couple
+of clock reads and dictionary updates, so funnels can stay on in production.
+"""
+
+from __future__ import division
+
+import os
+import time
+
+
+class Funnel:
+    """
+    Per-stage counts of candidates entering and passing, and seconds spent.
+    """
+
+    def __init__(self, stages):
+        """
+        - stages: Stage names, in pipeline order (used to order reports).
+        """
+        self.stages = list(stages)
+        self.entered = dict.fromkeys(self.stages, 0)
+        self.passed = dict.fromkeys(self.stages, 0)
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+
+    def check(self, name, test):
+        """
+        Run test() as stage name, counting the candidate as passed if the result is true.
+
+        Returns the result, so checks can be used directly in conditions.
+        """
+        started = time.time()
+        result = test()
+        self.seconds[name] = self.seconds[name] + time.time() - started
+        self.entered[name] = self.entered[name] + 1
+        if result:
+            self.passed[name] = self.passed[name] + 1
+        return result
+
+    def add(self, other):
+        """
+        Add another funnel's counts and times (e.g. from another iteration) to this one.
+        """
+        for name in other.stages:
+            if name not in self.entered:
+                self.stages.append(name)
+                self.entered[name], self.passed[name], self.seconds[name] = 0, 0, 0.0
+            self.entered[name] = self.entered[name] + other.entered[name]
+            self.passed[name] = self.passed[name] + other.passed[name]
+            self.seconds[name] = self.seconds[name] + other.seconds[name]
+
+    def report(self, title):
+        """
+        Return a human-readable table of the funnel, one line per stage.
+        """
+        lines = ["{0} ({1:.3f} seconds):\n".format(title, sum(self.seconds.values())),
+                 "    {0:<20}{1:>12}{2:>12}{3:>12}\n".format("stage", "entered", "passed", "seconds")]
+        for name in self.stages:
+            lines.append("    {0:<20}{1:>12}{2:>12}{3:>12.3f}\n".format(name, self.entered[name], self.passed[name],
+                                                                      self.seconds[name]))
+        return "".join(lines)
+
+    def write_table(self, path, label):
+        """
+        Append the funnel to a tab-separated table, one row per stage, writing a header to new files.
+        """
+        new = not os.path.isfile(path)
+        with open(path, "a") as outfile:
+            if new:
+                outfile.write("label\tstage\tentered\tpassed\tseconds\n")
+            for name in self.stages:
+                outfile.write("{0}\t{1}\t{2}\t{3}\t{4:.6f}\n".format(label, name, self.entered[name],
+                                                                     self.passed[name], self.seconds[name]))
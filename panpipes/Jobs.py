@@ -0,0 +1,275 @@
+"""
+Running external tool jobs in parallel with timeouts, retries and speculation.
+
+A handful of jobs (e.g. exonerate on long, repetitive or low-complexity
+reference proteins) can run for hours while every other core sits idle. Jobs
+run here are timed, can be killed after a timeout and retried once with
+cheaper settings (or dropped, if the caller allows it), and stragglers
+running longer than the 99th percentile of completed jobs can be re-executed
+speculatively once the queue is empty, with whichever copy succeeds first
+being used. A job that fails raises CalledProcessError, as check_output does.
+
+Jobs are launched directly from a single event loop (select over the jobs'
+stdout pipes, the same idea as asyncio's subprocess support, which isn't
+available in Python 2). There are no Python worker processes in between, so
+a stage with thousands of jobs doesn't fork copies of the parent or pickle
+results back to it, and each job's stdout is read as it arrives.
+
+Each job holds CPU tokens from the shared pool (see Resources) while it runs,
+so jobs never oversubscribe the CPUs allocated to the pipeline.
+
+Every attempt is written as a tab-separated record to a job log:
+    task, copy, attempt, status, seconds, cpus, command
+where status is one of ok, failed, timeout, dropped or killed.
+"""
+
+from __future__ import division
+
+import errno
+import os
+import select
+import signal
+import subprocess as sp
+import time
+from collections import deque
+
+from Resources import token_pool
+
+
+class OutputCollector:
+    """
+    Collects a job's stdout as it arrives and parses it once the job finishes.
+
+    Streaming parsers follow the same interface: feed returns True once the
+    parser has everything it needs, at which point the job is stopped early.
+    """
+
+    def __init__(self, parse=None):
+        self.parse = parse
+        self.chunks = []
+
+    def feed(self, data):
+        self.chunks.append(data)
+        return False
+
+    def result(self):
+        output = "".join(self.chunks)
+        return self.parse(output) if self.parse else output
+
+
+class _Job:
+    """
+    A running attempt of a task.
+    """
+
+    def __init__(self, task, copy, attempt, cmd, cpus, parser, timeout):
+        self.task = task
+        self.copy = copy
+        self.attempt = attempt
+        self.cmd = cmd
+        self.cpus = cpus
+        self.parser = parser
+        self.start = time.time()
+        self.deadline = self.start + timeout if timeout else None
+        self.stopped_early = False
+        self.returncode = None
+        # Own process group, so kills reach any children (e.g. of wrapper scripts).
+        self.process = sp.Popen(cmd, stdout=sp.PIPE, preexec_fn=os.setpgrp)
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def kill(self):
+        _kill(self.process.pid)
+
+    def close(self):
+        """
+        Reap the job's process and return its status.
+        """
+        self.process.stdout.close()
+        returncode = self.returncode = self.process.wait()
+        if self.stopped_early or returncode == 0:
+            return "ok"
+        elif returncode < 0:
+            return "killed"
+        else:
+            return "failed"
+
+    def record(self, status):
+        return [self.task, self.copy, self.attempt, status, time.time() - self.start, self.cpus, self.cmd]
+
+
+def _kill(pid):
+    """
+    Kill a job's process group, ignoring processes that have already exited.
+    """
+    if pid:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError as e:
+            if e.errno not in (errno.ESRCH, errno.EPERM):
+                raise
+
+
+def percentile(values, pct):
+    """
+    Return the pct-th percentile of a list of values (nearest rank).
+    """
+    ordered = sorted(values)
+    rank = int(round(pct / 100 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def run_jobs(cmds, parse=None, processes=None, timeout=None, retry_args=None, speculate=False,
+             joblog=None, log=None, min_completed=20, threads_arg=None, stream=None, drop=False):
+    """
+    Run a list of commands in parallel and return their parsed outputs, in order.
+
+    Arguments:
+        cmds          = List of commands (lists of arguments).
+        parse         = Function applied to each job's stdout (default: return stdout).
+        processes     = Maximum number of jobs to run at once (default: number of CPU tokens).
+        timeout       = Seconds after which a job is killed (default: no timeout).
+        retry_args    = Extra arguments for a single retry of a timed-out job, e.g. cheaper settings.
+        speculate     = Re-execute jobs running longer than the 99th percentile of completed jobs
+                        once there are idle workers, keeping whichever copy succeeds first.
+        joblog        = File handle to write per-attempt job records to.
+        log           = File handle to write a summary of job durations to.
+        min_completed = Number of completed jobs needed before speculating.
+        threads_arg   = Thread count option of a multithreaded tool. When fewer jobs are queued than
+                        there are CPU tokens, each job is given several tokens and this many threads.
+        stream        = Factory for a streaming parser per job (see OutputCollector), used instead of parse.
+        drop          = Give jobs that time out without retry_args, or time out again, a result of None,
+                        instead of raising RuntimeError.
+
+    Jobs that fail (or are killed by something else) raise CalledProcessError, unless another copy of the
+    same task is still running.
+    """
+    pool = token_pool()
+    if not processes:
+        processes = pool.tokens
+    if stream is None:
+        stream = lambda: OutputCollector(parse)
+    results = [None] * len(cmds)
+    finished = set()
+    durations = []
+    pending = deque(range(len(cmds)))
+    jobs = []
+
+    def write(records):
+        if joblog:
+            for record in records:
+                joblog.write("{0}\t{1}\t{2}\t{3}\t{4:.3f}\t{5}\t{6}\n".format(*(record[:6] + [" ".join(record[6])])))
+
+    def launch(task, copy, attempt, cmd, cpus):
+        if threads_arg:
+            cmd = list(cmd)
+            cmd[cmd.index(threads_arg) + 1] = str(cpus)
+        jobs.append(_Job(task, copy, attempt, cmd, cpus, stream(), timeout))
+
+    def finish(job, status, elapsed):
+        jobs.remove(job)
+        pool.release(job.cpus)
+        if job.task in finished:
+            return  # Speculative copy that lost.
+        if status != "ok" and any(other.task == job.task for other in jobs):
+            return  # The other copy may still succeed.
+        if status == "dropped" and not drop:
+            raise RuntimeError("{0} timed out after {1:.0f} seconds.".format(" ".join(job.cmd), elapsed))
+        if status not in ("ok", "dropped"):
+            raise sp.CalledProcessError(job.returncode, job.cmd)
+        finished.add(job.task)
+        if status == "dropped":
+            return
+        results[job.task] = job.parser.result()
+        durations.append(elapsed)  # Only successful runs, so timeouts don't raise the speculation cutoff.
+        for other in [other for other in jobs if other.task == job.task]:
+            other.kill()
+            other.close()
+            write([other.record("killed")])
+            jobs.remove(other)
+            pool.release(other.cpus)
+
+    try:
+        while pending or jobs:
+            ##### Start jobs while there is capacity and CPU tokens are free. #####
+            while pending and len(jobs) < processes:
+                most = pool.share(len(pending) + len(jobs)) if threads_arg else 1
+                cpus = pool.try_acquire(most)
+                if not cpus:
+                    break
+                task = pending.popleft()
+                launch(task, 0, 1, cmds[task], cpus)
+
+            ##### Speculatively re-run stragglers once the queue is empty. #####
+            if speculate and not pending and len(jobs) < processes and len(durations) >= min_completed:
+                cutoff = percentile(durations, 99)
+                now = time.time()
+                copied = set(job.task for job in jobs if job.copy)
+                for job in sorted([job for job in jobs if job.task not in copied and now - job.start > cutoff],
+                                  key=lambda x: x.start)[:processes - len(jobs)]:
+                    cpus = pool.try_acquire()
+                    if not cpus:
+                        break
+                    launch(job.task, 1, 1, cmds[job.task], cpus)
+
+            ##### Wait for output, finished jobs, free tokens or a deadline. #####
+            waits = list(jobs)
+            if pending and len(jobs) < processes:
+                waits.append(pool)
+            wait = 1.0 if speculate else None
+            deadlines = [job.deadline for job in jobs if job.deadline]
+            if deadlines:
+                wait = max(0, min(deadlines + ([time.time() + wait] if wait else [])) - time.time())
+            try:
+                readable = select.select(waits, [], [], wait)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            for job in readable:
+                if job is pool:
+                    continue
+                data = os.read(job.fileno(), 65536)
+                if data and not job.parser.feed(data):
+                    continue
+                if data:
+                    job.stopped_early = True  # Parser has everything it needs.
+                    job.kill()
+                status = job.close()
+                record = job.record(status)
+                write([record])
+                finish(job, status, record[4])
+
+            ##### Kill jobs past their deadline, and retry or drop them. #####
+            now = time.time()
+            for job in [job for job in jobs if job.deadline and now > job.deadline]:
+                job.kill()
+                job.close()
+                if job.attempt == 1 and retry_args is not None:
+                    write([job.record("timeout")])
+                    jobs.remove(job)
+                    jobs.append(_Job(job.task, job.copy, 2, job.cmd + retry_args, job.cpus, stream(), timeout))
+                else:
+                    record = job.record("dropped")
+                    write([record])
+                    finish(job, "dropped", record[4])
+    finally:
+        for job in jobs:
+            job.kill()
+            job.close()
+            pool.release(job.cpus)
+    if log:
+        log.write("Finished {0} ({1} without results).\n".format(summarise_durations(durations),
+                                                               results.count(None)))
+    return results
+
+
+def summarise_durations(durations):
+    """
+    Return a one-line summary (n, median, p99, max seconds) of a list of job durations.
+    """
+    if not durations:
+        return "0 jobs"
+    return "{0} jobs, median {1:.1f}s, p99 {2:.1f}s, max {3:.1f}s".format(
+        len(durations), percentile(durations, 50), percentile(durations, 99), max(durations))
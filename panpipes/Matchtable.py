@@ -0,0 +1,200 @@
+"""
+Columnar cluster x genome matrix for PanOCT matchtables.
+
+A matchtable has one row per cluster: the cluster ID, then one column per
+genome holding that genome's member protein, or "----------" if it has none.
+Instead of dicts of string lists, a ClusterMatrix holds an int32 matrix of
+indices into an interned table of gene IDs (-1 for "----------"), so cluster
+sizes, presence/absence matrices (PAMs) and proteome counts are array
+operations, and tables are written in bulk.
+
+Matrices are saved as three .npy files (<prefix>.clusters.npy, .members.npy
+and .genes.npy), which load memory-mapped, so even pan-genomes of thousands
+of strains and hundreds of thousands of clusters open instantly.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from Compression import open_text
+
+ABSENT = "----------"
+ABSENT_INDEX = -1
+
+# Rows per block when writing tables, to bound memory for large matrices.
+WRITE_ROWS = 10000
+
+
+class ClusterMatrix:
+    """
+    Clusters as rows of an int32 matrix of gene indices, one column per genome.
+    """
+
+    def __init__(self, clusters, members, genes):
+        """
+        - clusters: Cluster ID of each row.
+        - members:  int32 matrix (clusters x genomes) of indices into genes, or -1 if absent.
+        - genes:    Interned gene IDs.
+        """
+        self.clusters = clusters
+        self.members = members
+        self.genes = genes
+
+    @classmethod
+    def from_clusters(cls, clusters, genomes):
+        """
+        Build a ClusterMatrix from a dict of cluster ID: list of members (ABSENT if missing), in its order.
+
+        genomes gives the number of columns, for empty dicts.
+        """
+        interned = OrderedDict()
+        members = np.full((len(clusters), genomes), ABSENT_INDEX, dtype=np.int32)
+        for row, cluster in enumerate(clusters):
+            members[row] = [ABSENT_INDEX if member == ABSENT else interned.setdefault(member, len(interned))
+                            for member in clusters[cluster]]
+        return cls(np.array(list(clusters), dtype=str), members, np.array(list(interned), dtype=str))
+
+    @classmethod
+    def read_matchtable(cls, path):
+        """
+        Parse a tab-separated matchtable (e.g. PanOCT's matchtable.txt), which may be compressed.
+        """
+        clusters = OrderedDict()
+        with open_text(path) as infile:
+            for line in infile:
+                row = line.rstrip("\r\n").split("\t")
+                if len(row) > 1:
+                    clusters[row[0]] = row[1:]
+        genomes = len(next(iter(clusters.values()))) if clusters else 0
+        return cls.from_clusters(clusters, genomes)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        """
+        Load a ClusterMatrix saved with save, memory-mapped (read-only) by default.
+        """
+        return cls(np.load("{0}.clusters.npy".format(prefix), mmap_mode=mmap_mode),
+                   np.load("{0}.members.npy".format(prefix), mmap_mode=mmap_mode),
+                   np.load("{0}.genes.npy".format(prefix), mmap_mode=mmap_mode))
+
+    @classmethod
+    def read(cls, path):
+        """
+        Load a matchtable from its .npy files if they're newer than it, otherwise parse it and save them.
+        """
+        cached = "{0}.members.npy".format(path)
+        if os.path.isfile(cached) and os.path.getmtime(cached) >= os.path.getmtime(path):
+            return cls.load(path)
+        matrix = cls.read_matchtable(path)
+        matrix.save(path)
+        return matrix
+
+    @classmethod
+    def from_arrays(cls, data, name):
+        """
+        Rebuild a ClusterMatrix from arrays saved under a name (see arrays), e.g. from an .npz file.
+        """
+        return cls(data["{0}_clusters".format(name)], data["{0}_members".format(name)],
+                   data["{0}_genes".format(name)])
+
+    @classmethod
+    def concatenate(cls, matrices):
+        """
+        Stack several ClusterMatrix objects (with the same genomes) into one, in the given order.
+        """
+        offsets = np.cumsum([0] + [len(matrix.genes) for matrix in matrices])
+        members = [np.where(matrix.members == ABSENT_INDEX, ABSENT_INDEX, matrix.members + offset).astype(np.int32)
+                   for matrix, offset in zip(matrices, offsets)]
+        return cls(np.concatenate([matrix.clusters for matrix in matrices]), np.concatenate(members),
+                   np.concatenate([matrix.genes for matrix in matrices]))
+
+    def __len__(self):
+        return len(self.clusters)
+
+    @property
+    def genomes(self):
+        return self.members.shape[1]
+
+    def save(self, prefix):
+        """
+        Save the matrix as <prefix>.clusters.npy, <prefix>.members.npy and <prefix>.genes.npy.
+        """
+        for name, array in [("clusters", self.clusters), ("members", self.members), ("genes", self.genes)]:
+            # Replace rather than overwrite, in case the old files are still memory-mapped.
+            path = "{0}.{1}.npy".format(prefix, name)
+            with open("{0}.tmp".format(path), "wb") as outfile:
+                np.save(outfile, array)
+            os.rename("{0}.tmp".format(path), path)
+
+    def arrays(self, name):
+        """
+        Return the matrix's arrays keyed <name>_clusters, <name>_members and <name>_genes, e.g. for np.savez.
+        """
+        return {"{0}_clusters".format(name): self.clusters, "{0}_members".format(name): self.members,
+                "{0}_genes".format(name): self.genes}
+
+    def select(self, index):
+        """
+        Return a subset of the clusters, given a boolean mask or array of indices.
+        """
+        return ClusterMatrix(self.clusters[index], self.members[index], self.genes)
+
+    def pam(self):
+        """
+        Return the presence/absence matrix (uint8, clusters x genomes).
+        """
+        return (self.members != ABSENT_INDEX).view(np.uint8)
+
+    def sizes(self):
+        """
+        Return the number of genomes present in each cluster.
+        """
+        return (self.members != ABSENT_INDEX).sum(axis=1)
+
+    def size_distribution(self):
+        """
+        Return the number of clusters of each size (0 to genomes).
+        """
+        return np.bincount(self.sizes(), minlength=self.genomes + 1)
+
+    def proteome(self):
+        """
+        Return the number of proteins in all clusters.
+        """
+        return int(np.count_nonzero(self.members != ABSENT_INDEX))
+
+    def names(self, rows=slice(None)):
+        """
+        Return member IDs (ABSENT if missing) of the given rows as a string matrix.
+        """
+        return np.append(self.genes, ABSENT)[self.members[rows]]
+
+    def to_clusters(self):
+        """
+        Return the clusters as an OrderedDict of cluster ID: list of members (ABSENT if missing).
+        """
+        return OrderedDict(zip(self.clusters.tolist(), self.names().tolist()))
+
+    def write_table(self, path):
+        """
+        Write the matrix as a tab-separated matchtable.
+        """
+        with open(path, "w") as outfile:
+            for first in range(0, len(self), WRITE_ROWS):
+                rows = slice(first, first + WRITE_ROWS)
+                table = np.column_stack((self.clusters[rows], self.names(rows))) if self.genomes else \
+                    self.clusters[rows, None]
+                outfile.writelines("{0}\n".format("\t".join(row)) for row in table.tolist())
+
+    def write_pam(self, path):
+        """
+        Write the presence/absence matrix as tab-separated 0/1 rows (without cluster IDs).
+        """
+        digits = np.array(["0", "1"])
+        pam = self.pam()
+        with open(path, "w") as outfile:
+            for first in range(0, len(self), WRITE_ROWS):
+                table = digits[pam[first:first + WRITE_ROWS]]
+                outfile.writelines("{0}\n".format("\t".join(row)) for row in table.tolist())
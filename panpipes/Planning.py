@@ -0,0 +1,338 @@
+"""
+Run metrics, and a cost model for planning PBS resource requests (--plan).
+
+Both pipelines record one row per unit of work (a genome in gene_prediction,
+a cluster size in cluster_clean) to a run metrics table:
+
+    stage, label, cpus, seconds, cpu_seconds, peak_rss, disk_bytes, features
+
+where features are the input sizes the cost model uses (e.g. genome_bp and
+ref_residues). CPU time includes external tools (children reaped so far),
+and peak_rss is the largest total resident set of the process and its
+children during the unit (see Usage).
+
+With --plan, the pipelines only read their inputs, and a CostModel per stage
+predicts each unit's CPU time, peak memory and disk usage: from default
+coefficients, or calibrated against whatever metrics earlier runs recorded.
+CPU time is fitted as a sum of terms (e.g. genome_bp * ref_residues for
+exonerate), memory as a base plus a term, and disk as a term.
+"""
+
+from __future__ import division
+
+import math
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+METRICS_HEADER = ["stage", "label", "cpus", "seconds", "cpu_seconds", "peak_rss", "disk_bytes", "features"]
+
+# Per stage: CPU time terms (name, function of features, default seconds per unit), then memory as
+# (feature, default base bytes, default bytes per unit) and disk as (feature, default bytes per unit).
+MODELS = {
+    "gene_prediction": {
+        "cpu": [("genome_bp*ref_residues", lambda f: f["genome_bp"] * f["ref_residues"], 1.5e-9),
+                ("genome_bp", lambda f: f["genome_bp"], 3e-4)],
+        "memory": ("genome_bp", 5e8, 50.0),
+        "disk": ("genome_bp", 10.0),
+    },
+    "cluster_clean": {
+        "cpu": [("residues^2", lambda f: f["residues"] ** 2, 2.5e-10)],
+        "memory": ("proteins", 1e9, 2e3),
+        "disk": ("proteins", 5e3),
+    },
+}
+
+DEFAULT_EFFICIENCY = 0.8  # CPU seconds / (wall seconds x CPUs), before calibration.
+MARGIN = 1.25  # Safety margin on recommended memory and walltime.
+SAMPLE_SECONDS = 1.0  # Interval between memory samples of the process tree.
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class Usage:
+    """
+    Wall time, CPU time (including reaped children) and peak memory since creation.
+
+    ru_maxrss is a maximum over the process's lifetime, so memory is instead
+    sampled every SAMPLE_SECONDS (see tree_rss) while the Usage runs. If the
+    lifetime maximum rose meanwhile, it was reached during this unit (e.g. by
+    a child too short-lived to be sampled), and counts too.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.cpu_started = cpu_seconds()
+        self.rss_started = peak_rss()
+        self._peak = [0]
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=_sample_rss, args=(self._stopped, self._peak))
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+        self.seconds = time.time() - self.started
+        self.cpu_seconds = cpu_seconds() - self.cpu_started
+        lifetime = peak_rss()
+        self.peak_rss = max(self._peak[0], lifetime if lifetime > self.rss_started or not self._peak[0] else 0)
+        return self
+
+    def __del__(self):
+        self._stopped.set()  # Units abandoned by an exception never call stop().
+
+
+def _sample_rss(stopped, peak):
+    while True:
+        peak[0] = max(peak[0], tree_rss())  # Once more after stopping, so short units get an end sample too.
+        if stopped.is_set():
+            return
+        stopped.wait(SAMPLE_SECONDS)
+
+
+def cpu_seconds():
+    return sum(usage.ru_utime + usage.ru_stime for usage in [resource.getrusage(resource.RUSAGE_SELF),
+                                                             resource.getrusage(resource.RUSAGE_CHILDREN)])
+
+
+def peak_rss():
+    """
+    Return the peak resident set size in bytes of this process or its largest child.
+    """
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS).
+    scale = 1 if os.uname()[0] == "Darwin" else 1024
+    return scale * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def tree_rss(pid=None):
+    """
+    Return the total resident set size in bytes of a process (default: this one) and its descendants.
+
+    Read from /proc, so 0 where there's none (e.g. macOS).
+    """
+    pid = pid or os.getpid()
+    children, rss = {}, {}
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{0}/stat".format(entry)) as infile:
+                stat = infile.read()
+        except IOError:  # Exited since listing.
+            continue
+        fields = stat[stat.rindex(")") + 2:].split()  # After the command name, which may contain spaces.
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        rss[int(entry)] = int(fields[21]) * PAGE_SIZE
+    total, pending = 0, [pid]
+    while pending:
+        process = pending.pop()
+        total = total + rss.get(process, 0)
+        pending.extend(children.get(process, []))
+    return total
+
+
+def disk_usage(path):
+    """
+    Return the total size in bytes of a file, or of the files under a directory.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+               if os.path.isfile(os.path.join(root, name)))
+
+
+def fasta_features(path, open_file=open):
+    """
+    Return (number of sequences, total residues) of a FASTA file, without parsing records.
+    """
+    count = residues = 0
+    with open_file(path) as infile:
+        for line in infile:
+            if line.startswith(">"):
+                count = count + 1
+            else:
+                residues = residues + len(line.strip())
+    return count, residues
+
+
+def record_metrics(path, stage, label, features, usage, disk_bytes, cpus):
+    """
+    Append a unit of work's usage (see Usage) to a run metrics table, writing a header to new files.
+
+    Rows are written with one write call, so workers can share a table.
+    """
+    row = [stage, label, cpus, "{0:.3f}".format(usage.seconds), "{0:.3f}".format(usage.cpu_seconds),
+           usage.peak_rss, disk_bytes, ",".join("{0}={1}".format(key, features[key]) for key in sorted(features))]
+    new = not os.path.isfile(path)
+    with open(path, "a") as outfile:
+        outfile.write("".join(["\t".join(METRICS_HEADER) + "\n" if new else "",
+                               "\t".join(str(value) for value in row) + "\n"]))
+
+
+def read_metrics(path, stage):
+    """
+    Return a stage's rows of a run metrics table as dicts (features as a dict of floats).
+    """
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path) as infile:
+        for line in infile:
+            row = dict(zip(METRICS_HEADER, line.rstrip("\n").split("\t")))
+            if row["stage"] != stage or len(row) < len(METRICS_HEADER):
+                continue
+            for key in ["cpus", "seconds", "cpu_seconds", "peak_rss", "disk_bytes"]:
+                row[key] = float(row[key])
+            row["features"] = dict((key, float(value)) for key, value in
+                                   (item.split("=") for item in row["features"].split(",") if item))
+            records.append(row)
+    return records
+
+
+class CostModel:
+    """
+    Predicted CPU time, peak memory and disk usage of one stage's units of work.
+    """
+
+    def __init__(self, stage, records=()):
+        """
+        - stage:   Stage in MODELS.
+        - records: Rows of earlier runs (see read_metrics) to calibrate the default coefficients against.
+        """
+        spec = MODELS[stage]
+        self.stage = stage
+        self.terms = [(name, function) for name, function, _ in spec["cpu"]]
+        self.cpu = np.array([coefficient for _, _, coefficient in spec["cpu"]])
+        self.memory_feature, self.memory_base, self.memory_slope = spec["memory"]
+        self.disk_feature, self.disk_slope = spec["disk"]
+        self.efficiency = DEFAULT_EFFICIENCY
+        self.records = [record for record in records if record["cpu_seconds"] > 0]
+        if self.records:
+            self._calibrate()
+
+    def _calibrate(self):
+        features = [record["features"] for record in self.records]
+        terms = np.array([[function(feature) for _, function in self.terms] for feature in features])
+        cpu = np.array([record["cpu_seconds"] for record in self.records])
+        fitted = np.linalg.lstsq(terms, cpu, rcond=None)[0] if len(cpu) > len(self.terms) else None
+        if fitted is not None and (fitted >= 0).all() and fitted.any():
+            self.cpu = fitted
+        else:  # Too few records, or a degenerate fit: only rescale the defaults.
+            self.cpu = self.cpu * np.median(cpu / terms.dot(self.cpu))
+        self.efficiency = min(1.0, float(np.median([record["cpu_seconds"] / (record["seconds"] * record["cpus"])
+                                                    for record in self.records])))
+
+        memory_x = np.array([feature[self.memory_feature] for feature in features])
+        memory = np.array([record["peak_rss"] for record in self.records])
+        if len(memory) >= 3 and np.ptp(memory_x):
+            slope, base = np.polyfit(memory_x, memory, 1)
+            if slope >= 0 and base >= 0:
+                self.memory_base, self.memory_slope = base, slope
+        # Never predict less than any recorded run used.
+        scale = max(1.0, max(memory / (self.memory_base + self.memory_slope * memory_x)))
+        self.memory_base, self.memory_slope = self.memory_base * scale, self.memory_slope * scale
+
+        disk_x = np.array([feature[self.disk_feature] for feature in features])
+        disk = np.array([record["disk_bytes"] for record in self.records])
+        if disk_x.any():
+            self.disk_slope = max(disk[disk_x > 0] / disk_x[disk_x > 0])
+
+    def cpu_seconds(self, features):
+        return float(np.dot([function(features) for _, function in self.terms], self.cpu))
+
+    def wall_seconds(self, features, cores):
+        return self.cpu_seconds(features) / (cores * self.efficiency)
+
+    def memory(self, features):
+        return self.memory_base + self.memory_slope * features[self.memory_feature]
+
+    def disk(self, features):
+        return self.disk_slope * features[self.disk_feature]
+
+    def describe(self):
+        """
+        Return a one-line description of the model's coefficients and what they were calibrated on.
+        """
+        source = "calibrated on {0} recorded runs".format(len(self.records)) if self.records else \
+            "default coefficients, no recorded runs"
+        terms = " + ".join("{0:.3g} x {1}".format(coefficient, name) for (name, _), coefficient in
+                           zip(self.terms, self.cpu))
+        return "{0}: CPU seconds = {1}; efficiency {2:.2f} ({3})".format(self.stage, terms, self.efficiency, source)
+
+
+def walltime(seconds):
+    """
+    Format seconds as a PBS walltime (HH:MM:SS), rounded up to the minute.
+    """
+    minutes = int(math.ceil(seconds / 60))
+    return "{0:02d}:{1:02d}:00".format(minutes // 60, minutes % 60)
+
+
+def gigabytes(size):
+    return int(math.ceil(size / (1 << 30)))
+
+
+def batch_units(walls, limit):
+    """
+    Split units of work (with predicted wall times) into the fewest batches that each fit within limit.
+
+    Units are assigned longest first to the batch with the least work so far. Returns lists of indices.
+    """
+    for count in range(max(1, int(math.ceil(sum(walls) / limit))), len(walls) + 1):
+        batches = [[] for _ in range(count)]
+        totals = [0.0] * count
+        for index in sorted(range(len(walls)), key=lambda index: -walls[index]):
+            emptiest = totals.index(min(totals))
+            batches[emptiest].append(index)
+            totals[emptiest] = totals[emptiest] + walls[index]
+        if max(totals) <= limit:
+            return batches
+    return [[index] for index in range(len(walls))]
+
+
+def plan(model, units, cores, max_walltime=None, repeats=1, sequential=False):
+    """
+    Return a human-readable plan for running units of work one after another on cores CPUs.
+
+    Arguments:
+        model        = CostModel of the units' stage.
+        units        = List of (label, features) pairs.
+        cores        = Number of CPUs to plan for.
+        max_walltime = Longest walltime (seconds) a job may request. If the units don't fit, they're split
+                       into batches (separate jobs) that do.
+        repeats      = Number of times the units are run (e.g. cluster_clean iterations).
+        sequential   = Units depend on each other (e.g. cluster sizes), so rather than batches, suggest
+                       consecutive jobs that each resume from the last one's checkpoint.
+    """
+    lines = [model.describe() + "\n\n",
+             "{0:<24}{1:>12}{2:>12}{3:>12}{4:>12}\n".format("unit", "CPU-hours", "wall", "memory", "disk")]
+    walls = []
+    for label, features in units:
+        walls.append(repeats * model.wall_seconds(features, cores))
+        lines.append("{0:<24}{1:>12.2f}{2:>12}{3:>10.1f}GB{4:>10.1f}GB\n".format(
+            label, repeats * model.cpu_seconds(features) / 3600, walltime(walls[-1]),
+            model.memory(features) / (1 << 30), repeats * model.disk(features) / (1 << 30)))
+    cpu_hours = repeats * sum(model.cpu_seconds(features) for _, features in units) / 3600
+    memory = max([model.memory(features) for _, features in units] or [0])
+    disk = repeats * sum(model.disk(features) for _, features in units)
+    lines.append("\nTotal: {0:.2f} CPU-hours, {1} wall on {2} CPUs, peak memory {3:.1f}GB, disk {4:.1f}GB.\n".format(
+        cpu_hours, walltime(sum(walls)), cores, memory / (1 << 30), disk / (1 << 30)))
+    lines.append("Recommended: #PBS -l select=1:ncpus={0}:mem={1}gb\n"
+                 "             #PBS -l walltime={2}\n".format(cores, gigabytes(MARGIN * memory),
+                                                              walltime(MARGIN * sum(walls))))
+    if max_walltime and MARGIN * sum(walls) > max_walltime and sequential:
+        lines.append("Exceeds the walltime limit of {0}, suggested {1} consecutive jobs with --resume.\n".format(
+            walltime(max_walltime), int(math.ceil(MARGIN * sum(walls) / max_walltime))))
+    elif max_walltime and MARGIN * sum(walls) > max_walltime and len(units) > 1:
+        batches = batch_units(walls, max_walltime / MARGIN)
+        lines.append("Exceeds the walltime limit of {0}, suggested batching into {1} jobs:\n".format(
+            walltime(max_walltime), len(batches)))
+        for number, batch in enumerate(batches):
+            lines.append("    batch {0} (walltime={1}): {2}\n".format(
+                number + 1, walltime(MARGIN * sum(walls[index] for index in batch)),
+                " ".join(units[index][0] for index in sorted(batch))))
+    return "".join(lines)
@@ -0,0 +1,192 @@
+"""
+Six-frame k-mer prefilter for routing reference proteins to genomic windows.
+
+Exonerate's protein2genome model is expensive when run against a whole genome,
+even though most reference proteins only have a single locus. GenomeIndex
+builds a k-mer index of a genome's six-frame translation once (as NumPy
+arrays), and then finds candidate windows for each reference protein by
+clustering shared k-mer seeds along diagonals. Exonerate can then be run
+against just the extracted windows, with co-ordinates lifted back to the
+full contig afterwards.
+"""
+
+import numpy as np
+
+from Bio import SeqIO
+from Sequence import AMINO_ACIDS, STOP, UNKNOWN, encode_nucleotides, encode_protein, six_frames
+from Tools import parse_exonerate
+
+ALPHABET = len(AMINO_ACIDS)
+
+
+def kmer_codes(aa_codes, k):
+    """
+    Return integer codes for every k-mer in an array of amino acid codes.
+
+    K-mers containing a stop or an unknown residue are given a code of -1.
+    """
+    if len(aa_codes) < k:
+        return np.zeros(0, dtype=np.int64)
+    codes = np.zeros(len(aa_codes) - k + 1, dtype=np.int64)
+    invalid = np.zeros(len(codes), dtype=bool)
+    for offset in range(k):
+        window = aa_codes[offset:offset + len(codes)]
+        codes = codes * ALPHABET + window
+        invalid |= (window == STOP) | (window == UNKNOWN)
+    codes[invalid] = -1
+    return codes
+
+
+class GenomeIndex:
+    """
+    A k-mer index of the six-frame translation of a genome.
+
+    All six frames of every contig are concatenated into one "segment" array,
+    k-mer positions are then bucketed by k-mer code so that looking up every
+    occurrence of a k-mer is a single slice of the positions array.
+    """
+
+    def __init__(self, genome, k=5, max_occurrences=1000):
+        """
+        Build the index.
+
+        - contigs:      List of (contig ID, sequence) tuples, for extracting windows.
+        - segments:     Start of each frame in the index, with the frame's contig
+                        index, strand and frame in segment_contig, segment_reverse
+                        and segment_frame.
+        - offsets:      Start of each k-mer code's bucket in positions.
+        - positions:    Index positions of k-mers, grouped by k-mer code.
+
+        K-mers occurring more than max_occurrences times (repeats, low
+        complexity) are dropped from the index.
+        """
+        self.k = k
+        self.contigs = []
+        segments = []
+        kmers = []
+        start = 0
+        for seq in SeqIO.parse(genome, "fasta"):
+            self.contigs.append((seq.id, str(seq.seq)))
+            for strand, frame, translation in six_frames(encode_nucleotides(seq.seq)):
+                codes = kmer_codes(translation, k)
+                segments.append((len(self.contigs) - 1, strand, frame, start))
+                kmers.append(codes.astype(np.int32))
+                start = start + len(codes)
+        self.segments = np.array([segment[3] for segment in segments] + [start], dtype=np.int64)
+        self.segment_contig = np.array([segment[0] for segment in segments], dtype=np.int64)
+        self.segment_reverse = np.array([segment[1] == "-" for segment in segments], dtype=bool)
+        self.segment_frame = np.array([segment[2] for segment in segments], dtype=np.int64)
+        self.contig_lengths = np.array([len(seq) for contig_id, seq in self.contigs], dtype=np.int64)
+        kmers = np.concatenate(kmers) if kmers else np.zeros(0, dtype=np.int32)
+        valid = np.flatnonzero(kmers >= 0)
+        counts = np.bincount(kmers[valid], minlength=ALPHABET ** k)
+        counts[counts > max_occurrences] = 0
+        keep = valid[counts[kmers[valid]] > 0]
+        self.positions = keep[np.argsort(kmers[keep], kind="mergesort")]
+        self.offsets = np.zeros(ALPHABET ** k + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def seeds(self, protein):
+        """
+        Return (query position, index position) arrays of all k-mer seeds for a protein.
+        """
+        codes = kmer_codes(encode_protein(protein), self.k)
+        query_pos = np.flatnonzero(codes >= 0)
+        codes = codes[query_pos]
+        starts = self.offsets[codes]
+        counts = self.offsets[codes + 1] - starts
+        total = counts.sum()
+        if not total:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        query_seeds = np.repeat(query_pos, counts)
+        # Offset of each seed within its k-mer's bucket, then absolute index into positions.
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return query_seeds, self.positions[np.repeat(starts, counts) + within]
+
+    def windows(self, protein, min_seeds=2, band=10, max_intron=5000, max_windows=3):
+        """
+        Find candidate genomic windows for a protein.
+
+        Seeds are first clustered by diagonal (index position - query position,
+        binned by band) within each frame, and diagonals with fewer than
+        min_seeds non-overlapping seeds are discarded as chance hits. Surviving diagonals on the
+        same contig and strand are then chained into a window if they are within
+        max_intron of each other, since the exons of one gene can lie on
+        different diagonals and frames. Each window is padded by the protein's
+        length in nucleotides either side to allow for unseeded ends.
+
+        Returns up to max_windows (contig index, start, end) tuples, best first.
+        """
+        query_seeds, index_seeds = self.seeds(protein)
+        if not len(query_seeds):
+            return []
+        segment = np.searchsorted(self.segments, index_seeds, side="right") - 1
+        aa_pos = index_seeds - self.segments[segment]
+        diagonal = (aa_pos - query_seeds) // band
+        diagonal = diagonal - diagonal.min()
+        keys = segment * (int(diagonal.max()) + 1) + diagonal
+        diagonals, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        # Overlapping seeds from one longer chance match share a diagonal, so also require
+        # that a diagonal's seeds span at least two non-overlapping k-mers.
+        first = np.full(len(diagonals), len(protein), dtype=np.int64)
+        last = np.zeros(len(diagonals), dtype=np.int64)
+        np.minimum.at(first, inverse, query_seeds)
+        np.maximum.at(last, inverse, query_seeds)
+        kept = (counts[inverse] >= min_seeds) & ((last - first)[inverse] >= self.k)
+        if not kept.any():
+            return []
+        segment = segment[kept]
+        aa_pos = aa_pos[kept]
+        contig = self.segment_contig[segment]
+        reverse = self.segment_reverse[segment]
+        frame = self.segment_frame[segment]
+        nt = np.where(reverse, self.contig_lengths[contig] - frame - 3 * aa_pos - 3, frame + 3 * aa_pos)
+        order = np.lexsort((nt, reverse, contig))
+        contig, reverse, nt = contig[order], reverse[order], nt[order]
+        breaks = np.ones(len(nt), dtype=bool)
+        breaks[1:] = (contig[1:] != contig[:-1]) | (reverse[1:] != reverse[:-1]) | (nt[1:] - nt[:-1] > max_intron)
+        starts = np.flatnonzero(breaks)
+        chain_seeds = np.diff(np.append(starts, len(nt)))
+        lefts = np.minimum.reduceat(nt, starts)
+        rights = np.maximum.reduceat(nt, starts)
+        flank = 3 * (len(protein) + self.k)
+        windows = []
+        for chain in np.argsort(-chain_seeds, kind="mergesort")[:max_windows]:
+            chain_contig = int(contig[starts[chain]])
+            windows.append((chain_contig, max(0, int(lefts[chain]) - flank),
+                            min(int(self.contig_lengths[chain_contig]), int(rights[chain]) + flank)))
+        return windows
+
+    def write_windows(self, protein, out, **kwargs):
+        """
+        Write a protein's candidate windows to a FASTA file, returning the number written.
+
+        Windows are named "<contig>@<offset>", which lift_gene uses to map
+        exonerate co-ordinates back onto the contig.
+        """
+        windows = self.windows(protein, **kwargs)
+        if windows:
+            with open(out, "w") as outfile:
+                for contig, start, end in windows:
+                    contig_id, seq = self.contigs[contig]
+                    outfile.write(">{0}@{1}\n{2}\n".format(contig_id, start, seq[start:end]))
+        return len(windows)
+
+
+def lift_gene(gene):
+    """
+    Lift an ExonerateGene called against a window back to contig co-ordinates.
+    """
+    if gene and "@" in gene.contig_id:
+        contig_id, offset = gene.contig_id.rsplit("@", 1)
+        gene.contig_id = contig_id
+        gene.locs = tuple(loc + int(offset) for loc in gene.locs)
+        gene.id = "{0}_{1}".format(contig_id, "_".join(str(loc) for loc in gene.locs))
+    return gene
+
+
+def parse_exonerate_windows(output):
+    """
+    Return exonerate output against prefiltered windows as a lifted ExonerateGene.
+    """
+    return lift_gene(parse_exonerate(output))
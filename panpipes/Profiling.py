@@ -0,0 +1,176 @@
+"""
+Opt-in profiling of named pipeline stages.
+
+Switched on with a pipeline's --profile option or the PANPIPES_PROFILE
+environment variable (the output directory). When it's off, stage() and
+profiled() only check one global, so they can stay wrapped around stages in
+production code.
+
+Each stage is profiled every time it runs, and results are aggregated per
+label (e.g. a genome tag, or a cluster size) and stage name:
+
+    <directory>/<label>/<stage>.collapsed   Collapsed stacks ("a;b;c count") for flamegraph.pl.
+    <directory>/<label>/<stage>.pstats      cProfile statistics (PANPIPES_PROFILE_MODE=cprofile).
+    <directory>/<label>/<stage>.memory.txt  Calls, total time and the stage's own peak RSS (of the
+                                            process and its children, see Planning.Usage), plus the
+                                            top allocations after the last call if tracemalloc is
+                                            available (Python >=3.4, or 2.7 with pytracemalloc).
+
+Results are written when the pipeline exits.
+
+The default "sample" mode uses a SIGPROF interval timer, so only the main
+thread's CPU time is sampled, and time spent waiting on external tools is not.
+"""
+
+import atexit
+import cProfile
+import os
+import signal
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from Planning import Usage
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PROFILE_VARIABLE = "PANPIPES_PROFILE"
+MODE_VARIABLE = "PANPIPES_PROFILE_MODE"
+
+_profiler = None
+
+
+class _Profiler:
+    """
+    Profiler state: output directory, mode, current label and active stages.
+    """
+
+    def __init__(self, directory, mode="sample", interval=0.005, top=25):
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.label = "pipeline"
+        self.active = []  # (label, name) of stages currently running, outermost first.
+        self.stacks = {}  # (label, name): Counter of collapsed stacks.
+        self.profiles = {}  # (label, name): cProfile.Profile.
+        self.totals = {}  # (label, name): [calls, seconds].
+        self.peaks = {}  # (label, name): peak RSS in bytes over all calls.
+        self.allocations = {}  # (label, name): top allocations at the end of the last call.
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append("{0}:{1}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            frame = frame.f_back
+        collapsed = ";".join(reversed(stack))
+        for key in self.active:
+            self.stacks[key][collapsed] += 1
+
+    def output(self, key, suffix):
+        directory = os.path.join(self.directory, str(key[0]))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return os.path.join(directory, "{0}.{1}".format(key[1], suffix))
+
+    def enter(self, key):
+        if self.mode == "cprofile":
+            self.profiles.setdefault(key, cProfile.Profile()).enable()
+        else:
+            self.stacks.setdefault(key, Counter())
+            if not self.active:
+                signal.signal(signal.SIGPROF, self.sample)
+                signal.siginterrupt(signal.SIGPROF, False)  # Restart interrupted system calls.
+                signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.active.append(key)
+        if tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return time.time(), Usage()
+
+    def exit(self, key, started, usage):
+        self.active.remove(key)
+        if self.mode == "cprofile":
+            self.profiles[key].disable()
+        elif not self.active:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        totals = self.totals.setdefault(key, [0, 0.0])
+        totals[0] = totals[0] + 1
+        totals[1] = totals[1] + time.time() - started
+        self.peaks[key] = max(self.peaks.get(key, 0), usage.stop().peak_rss)
+        if tracemalloc:
+            self.allocations[key] = tracemalloc.take_snapshot().statistics("lineno")[:self.top]
+            if not self.active:
+                tracemalloc.stop()
+
+    def flush(self):
+        """
+        Write every stage's results.
+        """
+        for key, (calls, seconds) in self.totals.items():
+            if key in self.profiles:
+                self.profiles[key].dump_stats(self.output(key, "pstats"))
+            if key in self.stacks:
+                with open(self.output(key, "collapsed"), "w") as outfile:
+                    for stack, count in sorted(self.stacks[key].items()):
+                        outfile.write("{0} {1}\n".format(stack, count))
+            with open(self.output(key, "memory.txt"), "w") as outfile:
+                outfile.write("# {0} calls, {1:.3f} seconds, peak RSS {2} KB\n".format(calls, seconds,
+                                                                                      self.peaks[key] // 1024))
+                for stat in self.allocations.get(key, []):
+                    outfile.write("{0}\n".format(stat))
+
+
+def configure(directory=None, mode=None):
+    """
+    Switch profiling on, writing to directory (default: $PANPIPES_PROFILE; off if neither is set).
+
+    mode is "sample" (default) or "cprofile" (default: $PANPIPES_PROFILE_MODE).
+    """
+    global _profiler
+    directory = directory or os.environ.get(PROFILE_VARIABLE)
+    if directory:
+        _profiler = _Profiler(directory, mode or os.environ.get(MODE_VARIABLE, "sample"))
+        atexit.register(_profiler.flush)
+
+
+def set_label(label):
+    """
+    Aggregate subsequent stages under label (e.g. a genome tag).
+    """
+    if _profiler is not None:
+        _profiler.label = label
+
+
+@contextmanager
+def stage(name, label=None):
+    """
+    Profile the body of a with block as the stage name.
+    """
+    if _profiler is None:
+        yield
+        return
+    key = (label if label is not None else _profiler.label, name)
+    started, usage = _profiler.enter(key)
+    try:
+        yield
+    finally:
+        _profiler.exit(key, started, usage)
+
+
+def profiled(name):
+    """
+    Decorator profiling every call of a function as the stage name.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,127 @@
+"""
+Sweep-line reconciliation of overlapping gene calls from different sources.
+
+PanOCT can't handle overlapping or duplicated gene locations (i.e. isoforms),
+so calls from exonerate, GeneMark-ES and TransDecoder have to be reduced to a
+non-overlapping set. Calls are swept per contig in order of start, and split
+into groups of transitively overlapping calls (a group ends where the sweep
+passes the end of every call in it). Within a group, calls are kept from
+strongest to weakest unless they overlap a call already kept, so a call is
+only dropped for overlapping a stronger call that is itself kept. In a chain
+where A overlaps B and C, and B (which beats A) doesn't overlap C, both B and
+C are kept. Groups are small, so the whole reconciliation costs about one
+O(n log n) sort, however fragmented the assembly.
+
+Overlaps are resolved by source priority (exonerate > GeneMark-ES >
+TransDecoder by default), then by keeping the longer call, then the earlier
+one. Every dropped call is reported, as (contig, kept ID, dropped ID, reason),
+against a call that is in the final set.
+"""
+
+import bisect
+import numpy as np
+
+from Calls import SOURCES, EXONERATE, GENEMARK, TRANSDECODER
+
+PRIORITY = (EXONERATE, GENEMARK, TRANSDECODER)
+
+
+def overlap_reason(start, end, other_start, other_end):
+    """
+    Describe how two overlapping calls overlap.
+    """
+    if start == other_start and end == other_end:
+        return "identical"
+    elif start == other_start:
+        return "identical start"
+    elif end == other_end:
+        return "identical end"
+    elif (start <= other_start and other_end <= end) or (other_start <= start and end <= other_end):
+        return "contained"
+    else:
+        return "overlap"
+
+
+def reconcile(calls, priority=PRIORITY, presorted=False):
+    """
+    Reduce a GeneCalls store to a non-overlapping set of calls.
+
+    Co-ordinates are inclusive, so calls sharing a single base overlap.
+    priority lists source codes from most to least trusted; sources not
+    listed rank below all listed sources. Pass presorted=True for calls
+    already sorted by (contig, start), e.g. from GeneCalls.merge.
+
+    Returns the kept calls, sorted by (contig, start), and a list of
+    (contig, kept ID, dropped ID, reason) decisions.
+    """
+    if not presorted:
+        calls = calls.sorted()
+    rank = np.full(len(SOURCES), len(priority), dtype=np.int64)
+    rank[list(priority)] = np.arange(len(priority))
+    contig = calls.contig.tolist()
+    start = calls.start.tolist()
+    end = calls.end.tolist()
+    # Sort key for winning an overlap: higher priority, then longer, then earlier.
+    strength = zip(rank[calls.source].tolist(), (calls.start - calls.end).tolist(), range(len(calls)))
+    keep = np.zeros(len(calls), dtype=bool)
+    dropped = []
+    group = []
+    reach = -1  # Last base covered by the current group.
+    for index in range(len(calls)):
+        if group and (contig[group[0]] != contig[index] or start[index] > reach):
+            dropped.extend(resolve_group(group, start, end, strength, keep))
+            group = []
+        reach = max(reach, end[index]) if group else end[index]
+        group.append(index)
+    if group:
+        dropped.extend(resolve_group(group, start, end, strength, keep))
+    decisions = [(calls.contigs[contig[loser]], calls.ids[winner], calls.ids[loser],
+                  overlap_reason(start[winner], end[winner], start[loser], end[loser]))
+                 for loser, winner in sorted(dropped)]
+    return calls.select(keep), decisions
+
+
+def resolve_group(group, start, end, strength, keep):
+    """
+    Keep the calls of a group of overlapping calls from strongest to weakest, skipping calls that overlap one kept.
+
+    Marks kept calls in keep, and returns (dropped, kept) index pairs, the kept call being one the dropped call
+    overlaps.
+    """
+    kept_starts = []  # Kept calls never overlap, so sorted by start they're also sorted by end.
+    kept = []
+    dropped = []
+    for index in sorted(group, key=strength.__getitem__):
+        position = bisect.bisect_right(kept_starts, end[index])
+        # Only the kept call starting last before this one ends can reach back over its start.
+        if position and end[kept[position - 1]] >= start[index]:
+            dropped.append((index, kept[position - 1]))
+            continue
+        kept_starts.insert(position, start[index])
+        kept.insert(position, index)
+        keep[index] = True
+    return dropped
+
+
+def parse_priority(text):
+    """
+    Parse a comma-separated list of source names (e.g. "exonerate,genemark") into source codes.
+    """
+    names = [source.lower() for source in SOURCES]
+    priority = []
+    for name in text.lower().split(","):
+        if name.strip() not in names:
+            raise ValueError("unknown source {0} (expected some of {1})".format(name, ", ".join(names)))
+        priority.append(names.index(name.strip()))
+    return tuple(priority)
+
+
+def write_decisions(decisions, path, append=False):
+    """
+    Write reconciliation decisions to a tab-separated report.
+    """
+    with open(path, "a" if append else "w") as outfile:
+        if not append:
+            outfile.write("contig\tkept\tdropped\treason\n")
+        for decision in decisions:
+            outfile.write("\t".join(decision) + "\n")
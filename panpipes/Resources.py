@@ -0,0 +1,210 @@
+"""
+A global pool of CPU tokens shared by every external tool launched by the pipelines.
+
+Works like make's jobserver: a named pipe (FIFO) holds one byte per allocated
+CPU, and a job must read (acquire) a token before it starts and write it back
+(release) when it finishes. Child processes inherit the pipe, and its path
+is exported as PANPIPES_JOBSERVER so that other pipeline processes on the same
+node (e.g. several gene_prediction.py runs in one PBS job) share the same
+tokens instead of oversubscribing the node.
+
+Tools that can use threads (GeneMark-ES, blastp) can ask for several tokens,
+and get as many as are free at the time (but always at least one).
+"""
+
+from __future__ import division
+
+import atexit
+import errno
+import multiprocessing as mp
+import os
+import select
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Environment variables giving the number of CPUs allocated, checked in order.
+CPU_VARIABLES = ["PANPIPES_CPUS", "NCPUS", "PBS_NUM_PPN", "PBS_NP", "SLURM_CPUS_PER_TASK", "NSLOTS"]
+
+
+def allocated_cpus():
+    """
+    Return the number of CPUs allocated to this job by the scheduler (or on the node).
+    """
+    for variable in CPU_VARIABLES:
+        if os.environ.get(variable, "").isdigit() and int(os.environ[variable]) > 0:
+            return int(os.environ[variable])
+    return mp.cpu_count()
+
+
+class TokenPool:
+    """
+    A make-style jobserver pool of CPU tokens, held in a named pipe.
+    """
+
+    def __init__(self, path=None, tokens=None):
+        """
+        Join the token pool at path, creating and filling it with tokens if it doesn't exist.
+
+        - path:   Path of the named pipe (default: a new pipe in a temporary directory).
+        - tokens: Number of CPU tokens in the pool (default: allocated_cpus()).
+
+        A pipe loses its tokens once no process holds it open, so a pipe left
+        behind by a finished run (e.g. PANPIPES_JOBSERVER inherited from a
+        parent that has exited) is replaced by a new pool rather than joined.
+        """
+        self._directory = None
+        if not path or not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            self._directory = tempfile.mkdtemp(prefix="panpipes_jobserver_")
+            path = os.path.join(self._directory, "tokens")
+        self.path = path
+        self._owner = os.getpid()
+        while True:
+            try:
+                os.mkfifo(path)
+                created = True
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            if _is_live(path):
+                created = False
+                break
+            for stale in [path, "{0}.size".format(path)]:
+                try:
+                    os.remove(stale)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        # Read/write descriptor for blocking acquires, plus a non-blocking one for extra tokens.
+        self._fd = os.open(path, os.O_RDWR)
+        self._nonblocking = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        if created:
+            self.tokens = tokens or allocated_cpus()
+            os.write(self._fd, "+" * self.tokens)
+            with open("{0}.size.{1}".format(path, os.getpid()), "w") as outfile:
+                outfile.write(str(self.tokens))
+            os.rename("{0}.size.{1}".format(path, os.getpid()), "{0}.size".format(path))
+        else:
+            while not os.path.isfile("{0}.size".format(path)):  # Creator may still be filling the pool.
+                time.sleep(0.1)
+            with open("{0}.size".format(path)) as infile:
+                self.tokens = int(infile.read())
+
+    def close(self):
+        """
+        Close the pool's descriptors, and remove a pool created in a temporary directory.
+
+        Only the creating process removes the directory, not processes forked from it.
+        """
+        if self._fd is None:
+            return
+        os.close(self._fd)
+        os.close(self._nonblocking)
+        self._fd = self._nonblocking = None
+        if self._directory and os.getpid() == self._owner:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def acquire(self, most=1):
+        """
+        Acquire between one and most tokens, blocking until at least one is free.
+
+        Returns the number of tokens acquired.
+        """
+        while True:
+            try:
+                os.read(self._fd, 1)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        count = 1
+        while count < most and select.select([self._nonblocking], [], [], 0)[0]:
+            try:
+                count = count + len(os.read(self._nonblocking, most - count))
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                break
+        return count
+
+    def try_acquire(self, most=1):
+        """
+        Acquire up to most tokens without blocking, returning the number acquired (possibly 0).
+        """
+        try:
+            return len(os.read(self._nonblocking, most))
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            return 0
+
+    def fileno(self):
+        """
+        Return a descriptor that is readable (e.g. by select) whenever a token is free.
+        """
+        return self._nonblocking
+
+    def release(self, count=1):
+        """
+        Return tokens to the pool.
+        """
+        os.write(self._fd, "+" * count)
+
+    def share(self, waiting):
+        """
+        Return how many tokens a job should ask for when waiting jobs share the pool.
+
+        When fewer jobs are queued than there are tokens, each job can use
+        several threads without starving the others.
+        """
+        return max(1, self.tokens // max(1, waiting))
+
+    @contextmanager
+    def cpus(self, most=1):
+        """
+        Hold between one and most tokens for the duration of a with block.
+        """
+        count = self.acquire(most)
+        try:
+            yield count
+        finally:
+            self.release(count)
+
+
+def _is_live(path, wait=10):
+    """
+    Return whether some process holds the named pipe at path open, i.e. whether its tokens still exist.
+
+    A pipe with no readers can't be opened for writing without blocking (ENXIO). The creator of a new
+    pool briefly has the pipe without holding it open, which is told apart by its missing size file.
+    """
+    deadline = time.time() + wait
+    while True:
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+            return True
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if os.path.isfile("{0}.size".format(path)) or time.time() > deadline:
+            return False
+        time.sleep(0.1)
+
+
+_pool = None
+
+
+def token_pool():
+    """
+    Return this process's TokenPool, joining PANPIPES_JOBSERVER or creating a new pool.
+
+    Call this before starting any child processes, so that they inherit the same pool.
+    """
+    global _pool
+    if _pool is None:
+        _pool = TokenPool(os.environ.get("PANPIPES_JOBSERVER"))
+        os.environ["PANPIPES_JOBSERVER"] = _pool.path
+        atexit.register(_pool.close)
+    return _pool
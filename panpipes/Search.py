@@ -0,0 +1,469 @@
+"""
+Homology search backends that all write the same tabular hit records.
+
+parallel_BLAST and remove_dubious_orfs build a database once and then run
+one search command per query shard through Jobs.run_jobs. A backend
+provides both steps for one search engine, writing BLAST tabular output
+(outfmt 6) with the requested columns, by default TABULAR:
+
+    blastp  BLAST+ (makeblastdb and blastp), the reference.
+    diamond DIAMOND, much faster for large sets of proteins.
+    mmseqs  MMseqs2 easy-search, likewise.
+    numpy   A built-in Smith-Waterman aligner (BLOSUM62, BLAST's default
+            gap costs of 11 + 1 per residue), vectorised with NumPy over
+            all database proteins at once. Needs no external programs, so
+            suits small or test inputs and machines without BLAST+.
+
+The built-in aligner reports the best local alignment of each query and
+subject pair, with e-values and bit scores from BLAST's Karlin-Altschul
+parameters for BLOSUM62 with these gap costs (without BLAST's length
+adjustment, so its e-values are slightly more conservative).
+
+Run as a script, this module is also the built-in aligner's command line
+("search"), and benchmarks the available backends against each other
+("benchmark"), e.g.:
+
+    python Search.py benchmark proteins.faa --backends blastp,diamond,numpy
+"""
+
+from __future__ import division
+
+import argparse
+import math
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+from multiprocessing import Pool
+
+import numpy as np
+from Bio import SeqIO
+
+# Columns of parallel_BLAST's tabular output (BLAST's "6 std qlen slen").
+TABULAR = ["qseqid", "sseqid", "pident", "length", "mismatch", "gapopen", "qstart", "qend", "sstart", "send",
+           "evalue", "bitscore", "qlen", "slen"]
+
+GAP_OPEN = 11
+GAP_EXTEND = 1
+# Karlin-Altschul parameters of BLOSUM62 with gap costs 11/1, as used by BLAST.
+LAMBDA = 0.267
+KAPPA = 0.041
+
+BLOSUM62 = """
+       A  R  N  D  C  Q  E  G  H  I  L  K  M  F  P  S  T  W  Y  V  B  Z  X  *
+    A  4 -1 -2 -2  0 -1 -1  0 -2 -1 -1 -1 -1 -2 -1  1  0 -3 -2  0 -2 -1  0 -4
+    R -1  5  0 -2 -3  1  0 -2  0 -3 -2  2 -1 -3 -2 -1 -1 -3 -2 -3 -1  0 -1 -4
+    N -2  0  6  1 -3  0  0  0  1 -3 -3  0 -2 -3 -2  1  0 -4 -2 -3  3  0 -1 -4
+    D -2 -2  1  6 -3  0  2 -1 -1 -3 -4 -1 -3 -3 -1  0 -1 -4 -3 -3  4  1 -1 -4
+    C  0 -3 -3 -3  9 -3 -4 -3 -3 -1 -1 -3 -1 -2 -3 -1 -1 -2 -2 -1 -3 -3 -2 -4
+    Q -1  1  0  0 -3  5  2 -2  0 -3 -2  1  0 -3 -1  0 -1 -2 -1 -2  0  3 -1 -4
+    E -1  0  0  2 -4  2  5 -2  0 -3 -3  1 -2 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+    G  0 -2  0 -1 -3 -2 -2  6 -2 -4 -4 -2 -3 -3 -2  0 -2 -2 -3 -3 -1 -2 -1 -4
+    H -2  0  1 -1 -3  0  0 -2  8 -3 -3 -1 -2 -1 -2 -1 -2 -2  2 -3  0  0 -1 -4
+    I -1 -3 -3 -3 -1 -3 -3 -4 -3  4  2 -3  1  0 -3 -2 -1 -3 -1  3 -3 -3 -1 -4
+    L -1 -2 -3 -4 -1 -2 -3 -4 -3  2  4 -2  2  0 -3 -2 -1 -2 -1  1 -4 -3 -1 -4
+    K -1  2  0 -1 -3  1  1 -2 -1 -3 -2  5 -1 -3 -1  0 -1 -3 -2 -2  0  1 -1 -4
+    M -1 -1 -2 -3 -1  0 -2 -3 -2  1  2 -1  5  0 -2 -1 -1 -1 -1  1 -3 -1 -1 -4
+    F -2 -3 -3 -3 -2 -3 -3 -3 -1  0  0 -3  0  6 -4 -2 -2  1  3 -1 -3 -3 -1 -4
+    P -1 -2 -2 -1 -3 -1 -1 -2 -2 -3 -3 -1 -2 -4  7 -1 -1 -4 -3 -2 -2 -1 -2 -4
+    S  1 -1  1  0 -1  0  0  0 -1 -2 -2  0 -1 -2 -1  4  1 -3 -2 -2  0  0  0 -4
+    T  0 -1  0 -1 -1 -1 -1 -2 -2 -1 -1 -1 -1 -2 -1  1  5 -2 -2  0 -1 -1  0 -4
+    W -3 -3 -4 -4 -2 -2 -3 -2 -2 -3 -2 -3 -1  1 -4 -3 -2 11  2 -3 -4 -3 -2 -4
+    Y -2 -2 -2 -3 -2 -1 -2 -3  2 -1 -1 -2 -1  3 -3 -2 -2  2  7 -1 -3 -2 -1 -4
+    V  0 -3 -3 -3 -1 -2 -2 -3 -3  3  1 -2  1 -1 -2 -2  0 -3 -1  4 -3 -2 -1 -4
+    B -2 -1  3  4 -3  0  1 -1  0 -3 -4  0 -3 -3 -2  0 -1 -4 -3 -3  4  1 -1 -4
+    Z -1  0  0  1 -3  3  4 -2  0 -3 -3  1 -1 -3 -1  0 -1 -3 -2 -2  1  4 -1 -4
+    X  0 -1 -1 -1 -2 -1 -1 -1 -1 -1 -1 -1 -1 -1 -2  0  0 -2 -1 -1 -1 -1 -1 -4
+    * -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4 -4  1
+"""
+
+
+def _blosum62():
+    """
+    Return the BLOSUM62 scores as a matrix over residue codes (see encode), with a separator code scoring 0.
+    """
+    rows = BLOSUM62.strip("\n").split("\n")
+    alphabet = rows[0].split()
+    scores = np.zeros((len(alphabet) + 1, len(alphabet) + 1), dtype=np.int32)
+    for index, row in enumerate(rows[1:]):
+        scores[index, :len(alphabet)] = [int(score) for score in row.split()[1:]]
+    codes = np.full(256, alphabet.index("X"), dtype=np.uint8)
+    for index, residue in enumerate(alphabet):
+        codes[ord(residue)] = codes[ord(residue.lower())] = index
+    return scores, codes, len(alphabet)
+
+
+SCORES, CODES, SEPARATOR = _blosum62()
+
+
+def encode(sequence):
+    """
+    Return a protein sequence as an array of residue codes (rows of SCORES), unknown residues as X.
+    """
+    return CODES[np.frombuffer(str(sequence), dtype=np.uint8)]
+
+
+def best_local_scores(query, subjects, band=None):
+    """
+    Return the best Smith-Waterman score of query against each of a list of subjects.
+
+    All subjects are aligned at once, concatenated with separators between
+    them, one query residue (a row of the dynamic programming matrix) at a
+    time. Horizontal gaps are found with a cumulative maximum per subject,
+    which is exact as gap opening costs at least as much as extending.
+    With band, cells more than band diagonals from the main diagonal
+    (query position = subject position) are excluded.
+    """
+    if not subjects:
+        return np.zeros(0, dtype=np.int64)
+    lengths = np.array([len(subject) for subject in subjects])
+    starts = np.concatenate([[0], np.cumsum(lengths + 1)[:-1]])
+    target = np.full(int(lengths.sum() + len(subjects)), SEPARATOR, dtype=np.uint8)
+    for start, subject in zip(starts, subjects):
+        target[start:start + len(subject)] = subject
+    columns = np.arange(len(target), dtype=np.int64)
+    segment = np.repeat(np.arange(len(subjects)), lengths + 1)
+    offset = segment * (4 * (len(query) + len(target)) * (SCORES.max() + GAP_EXTEND))  # Keeps maxima per subject.
+    position = columns - starts[segment]
+    separator = target == SEPARATOR
+    previous = np.zeros(len(target) + 1, dtype=np.int64)  # H of the previous row, with column -1 = 0.
+    vertical = np.full(len(target), -GAP_OPEN - GAP_EXTEND, dtype=np.int64)
+    best = np.zeros(len(target), dtype=np.int64)
+    for row, residue in enumerate(query):
+        vertical = np.maximum(previous[1:] - GAP_OPEN - GAP_EXTEND, vertical - GAP_EXTEND)
+        current = np.maximum(np.maximum(previous[:-1] + SCORES[residue][target], vertical), 0)
+        excluded = separator if band is None else separator | (np.abs(position - row) > band)
+        current[excluded] = 0
+        opened = np.maximum.accumulate(current + columns * GAP_EXTEND + offset)
+        horizontal = np.concatenate([[0], opened[:-1]]) - offset - GAP_OPEN - columns * GAP_EXTEND
+        current = np.maximum(current, horizontal)
+        current[excluded] = 0
+        np.maximum(best, current, out=best)
+        previous[1:] = current
+    return np.maximum.reduceat(best, starts)
+
+
+def align(query, subject, band=None):
+    """
+    Smith-Waterman align two encoded sequences, returning the best local alignment.
+
+    Returns (score, query start, query end, subject start, subject end,
+    identities, mismatches, gap opens, alignment length), with 0-based
+    half-open co-ordinates, or None if the sequences have no positive score.
+    """
+    rows, cols = len(query) + 1, len(subject) + 1
+    best = np.zeros((rows, cols), dtype=np.int64)
+    horizontal = np.full((rows, cols), -GAP_OPEN - GAP_EXTEND, dtype=np.int64)
+    vertical = np.full((rows, cols), -GAP_OPEN - GAP_EXTEND, dtype=np.int64)
+    columns = np.arange(1, cols)
+    for row in range(1, rows):
+        vertical[row, 1:] = np.maximum(best[row - 1, 1:] - GAP_OPEN - GAP_EXTEND, vertical[row - 1, 1:] - GAP_EXTEND)
+        current = np.maximum(np.maximum(best[row - 1, :-1] + SCORES[query[row - 1]][subject], vertical[row, 1:]), 0)
+        excluded = np.zeros(cols - 1, dtype=bool) if band is None else np.abs(columns - row) > band
+        current[excluded] = 0
+        # Horizontal gaps ending in each column, from any column to its left (the first column scoring 0).
+        opened = np.maximum.accumulate(np.concatenate([[0], current[:-1]]) + (columns - 1) * GAP_EXTEND)
+        horizontal[row, 1:] = opened - GAP_OPEN - columns * GAP_EXTEND
+        current = np.maximum(current, horizontal[row, 1:])
+        current[excluded] = 0
+        best[row, 1:] = current
+    row, col = np.unravel_index(np.argmax(best), best.shape)
+    score = int(best[row, col])
+    if score <= 0:
+        return None
+    end = (row, col)
+    identities = mismatches = opens = length = 0
+    state = "match"
+    while row > 0 and col > 0:
+        if state == "match":
+            if best[row, col] == 0:
+                break
+            elif best[row, col] == best[row - 1, col - 1] + SCORES[query[row - 1]][subject[col - 1]]:
+                identities, mismatches = (identities + 1, mismatches) if query[row - 1] == subject[col - 1] else \
+                    (identities, mismatches + 1)
+                row, col, length = row - 1, col - 1, length + 1
+                continue
+            state = "horizontal" if best[row, col] == horizontal[row, col] else "vertical"
+            opens = opens + 1
+        elif state == "horizontal":
+            opened = horizontal[row, col] == best[row, col - 1] - GAP_OPEN - GAP_EXTEND
+            col, length = col - 1, length + 1
+            state = "match" if opened else "horizontal"
+        else:
+            opened = vertical[row, col] == best[row - 1, col] - GAP_OPEN - GAP_EXTEND
+            row, length = row - 1, length + 1
+            state = "match" if opened else "vertical"
+    return score, row, end[0], col, end[1], identities, mismatches, opens, length
+
+
+def evalue(score, query_length, db_size):
+    return KAPPA * query_length * db_size * math.exp(-LAMBDA * score)
+
+
+def bitscore(score):
+    return (LAMBDA * score - math.log(KAPPA)) / math.log(2)
+
+
+def search_records(query, subjects, max_evalue=1e-4, db_size=None, max_targets=500, band=None):
+    """
+    Align one query SeqRecord against a list of subject SeqRecords, returning dicts of TABULAR fields.
+
+    Hits are sorted by score, best first, as in BLAST's output.
+    """
+    db_size = db_size or sum(len(subject) for subject in subjects)
+    encoded = encode(query.seq)
+    targets = [encode(subject.seq) for subject in subjects]
+    scores = best_local_scores(encoded, targets, band)
+    # E-values only fall as scores rise, so only subjects whose best score is significant need a traceback.
+    hits = []
+    for index in np.argsort(-scores, kind="mergesort")[:max_targets]:
+        if not scores[index] or evalue(scores[index], len(query), db_size) > max_evalue:
+            break
+        score, qstart, qend, sstart, send, identities, mismatches, opens, length = align(encoded, targets[index],
+                                                                                        band)
+        hits.append({"qseqid": query.id, "sseqid": subjects[index].id, "pident": 100 * identities / length,
+                     "length": length, "mismatch": mismatches, "gapopen": opens, "qstart": qstart + 1,
+                     "qend": qend, "sstart": sstart + 1, "send": send,
+                     "evalue": evalue(score, len(query), db_size), "bitscore": bitscore(score),
+                     "qlen": len(query), "slen": len(subjects[index]), "score": score})
+    return hits
+
+
+def format_hit(hit, fields):
+    values = {"pident": "{0:.3f}".format(hit["pident"]), "evalue": "{0:.2g}".format(hit["evalue"]),
+              "bitscore": "{0:.1f}".format(hit["bitscore"])}
+    return "\t".join(values.get(field, str(hit[field])) for field in fields) + "\n"
+
+
+def _search_one(task):
+    query, subjects, fields, max_evalue, db_size, max_targets, band = task
+    return "".join(format_hit(hit, fields) for hit in search_records(query, subjects, max_evalue, db_size,
+                                                                     max_targets, band))
+
+
+def search(query_fasta, db_fasta, out=None, fields=TABULAR, max_evalue=1e-4, db_size=None, max_targets=500,
+           band=None, threads=1):
+    """
+    Search every protein in query_fasta against db_fasta with the built-in aligner, writing tabular output.
+
+    Output goes to out, or stdout if out is None or "-". Queries are spread over threads processes.
+    """
+    unknown = [field for field in fields if field not in TABULAR]
+    if unknown:
+        raise ValueError("The built-in aligner can't report {0}.".format(", ".join(unknown)))
+    subjects = list(SeqIO.parse(db_fasta, "fasta"))
+    tasks = ((query, subjects, fields, max_evalue, db_size, max_targets, band)
+             for query in SeqIO.parse(query_fasta, "fasta"))
+    outfile = sys.stdout if out in (None, "-") else open(out, "w")
+    pool = Pool(threads) if threads > 1 else None
+    try:
+        for lines in (pool.imap(_search_one, tasks) if pool else (_search_one(task) for task in tasks)):
+            outfile.write(lines)
+            outfile.flush()
+    finally:
+        if pool:
+            pool.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+
+
+class Backend:
+    """
+    A homology search engine: builds databases and returns search commands for Jobs.run_jobs.
+    """
+    name = None
+    program = None
+    threads_arg = None  # Thread count option, for run_jobs' threads_arg.
+
+    def available(self):
+        return find_executable(self.program) is not None
+
+    def db_name(self, prefix):
+        """
+        Return the name (for command) of the database build_db builds at prefix.
+        """
+        return prefix
+
+    def build_db(self, fasta, prefix, log=None):
+        """
+        Build a database of the proteins in fasta at prefix, and return its name for command.
+        """
+        raise NotImplementedError
+
+    def command(self, query, db, out=None, fields=TABULAR, max_evalue=1e-4, db_size=None, max_targets=None):
+        """
+        Return the command searching query against db, writing tabular output to out (or stdout if None).
+
+        db_size is the effective database size (in residues), to keep e-values comparable between searches
+        against subsets of the same proteins, where the engine supports it.
+        """
+        raise NotImplementedError
+
+
+class BlastBackend(Backend):
+    name = "blastp"
+    program = "blastp"
+    threads_arg = "-num_threads"
+
+    def build_db(self, fasta, prefix, log=None):
+        sp.check_call(["makeblastdb", "-in", fasta, "-dbtype", "prot", "-out", prefix], stdout=log)
+        return prefix
+
+    def command(self, query, db, out=None, fields=TABULAR, max_evalue=1e-4, db_size=None, max_targets=None):
+        cmd = ["blastp", "-query", query, "-db", db, "-outfmt", "6 {0}".format(" ".join(fields)),
+               "-evalue", str(max_evalue), "-num_threads", "1"]
+        if out:
+            cmd.extend(["-out", out])
+        if db_size:
+            cmd.extend(["-dbsize", str(db_size)])
+        if max_targets:
+            cmd.extend(["-max_target_seqs", str(max_targets)])
+        return cmd
+
+
+class DiamondBackend(Backend):
+    name = "diamond"
+    program = "diamond"
+    threads_arg = "--threads"
+
+    def build_db(self, fasta, prefix, log=None):
+        sp.check_call(["diamond", "makedb", "--in", fasta, "--db", prefix], stdout=log, stderr=log)
+        return prefix
+
+    def command(self, query, db, out=None, fields=TABULAR, max_evalue=1e-4, db_size=None, max_targets=None):
+        # DIAMOND reports 25 targets per query by default, BLAST 500.
+        cmd = ["diamond", "blastp", "--query", query, "--db", db, "--outfmt", "6"] + list(fields) + \
+              ["--evalue", str(max_evalue), "--max-target-seqs", str(max_targets or 500), "--threads", "1",
+               "--quiet"]
+        if out:
+            cmd.extend(["--out", out])
+        if db_size:
+            cmd.extend(["--dbsize", str(db_size)])
+        return cmd
+
+
+class MMseqsBackend(Backend):
+    name = "mmseqs"
+    program = "mmseqs"
+    threads_arg = "--threads"
+    # MMseqs2's names for BLAST's tabular columns.
+    columns = {"qseqid": "query", "sseqid": "target", "length": "alnlen", "sstart": "tstart", "send": "tend",
+               "bitscore": "bits", "slen": "tlen"}
+
+    def build_db(self, fasta, prefix, log=None):
+        sp.check_call(["mmseqs", "createdb", fasta, prefix], stdout=log, stderr=log)
+        return prefix
+
+    def command(self, query, db, out=None, fields=TABULAR, max_evalue=1e-4, db_size=None, max_targets=None):
+        # MMseqs2 has no effective database size option, so db_size is ignored.
+        return ["mmseqs", "easy-search", query, db, out or "/dev/stdout", "{0}.mmseqs_tmp".format(query),
+                "--format-output", ",".join(self.columns.get(field, field) for field in fields),
+                "-e", str(max_evalue), "--max-seqs", str(max_targets or 500), "--threads", "1", "-v", "1"]
+
+
+class NumpyBackend(Backend):
+    name = "numpy"
+    program = None
+    threads_arg = "--threads"
+
+    def available(self):
+        return True
+
+    def db_name(self, prefix):
+        return "{0}.faa".format(prefix)
+
+    def build_db(self, fasta, prefix, log=None):
+        shutil.copyfile(fasta, self.db_name(prefix))
+        return self.db_name(prefix)
+
+    def command(self, query, db, out=None, fields=TABULAR, max_evalue=1e-4, db_size=None, max_targets=None):
+        cmd = [sys.executable, os.path.abspath(__file__).replace(".pyc", ".py"), "search", query, db,
+               "--out", out or "-", "--fields", ",".join(fields), "--evalue", str(max_evalue),
+               "--max-targets", str(max_targets or 500), "--threads", "1"]
+        if db_size:
+            cmd.extend(["--dbsize", str(db_size)])
+        return cmd
+
+
+BACKENDS = dict((backend.name, backend) for backend in [BlastBackend(), DiamondBackend(), MMseqsBackend(),
+                                                         NumpyBackend()])
+
+
+def get_backend(name):
+    """
+    Return the backend called name, if its program is installed.
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown search backend {0} (choose from {1}).".format(name, ", ".join(sorted(BACKENDS))))
+    if not BACKENDS[name].available():
+        raise RuntimeError("{0} either not installed or missing from your $PATH!".format(BACKENDS[name].program))
+    return BACKENDS[name]
+
+
+def benchmark(fasta, names, max_evalue=1e-4, threads=1):
+    """
+    Run an all-vs.-all search of fasta with each installed backend, and report speed and agreement.
+
+    Agreement is measured on (query, subject) pairs, against the first backend in names that's installed.
+    """
+    queries = sum(1 for _ in SeqIO.parse(fasta, "fasta"))
+    workdir = tempfile.mkdtemp(prefix="search_benchmark_")
+    reference = None
+    rows = []
+    try:
+        for name in names:
+            if not BACKENDS[name].available():
+                sys.stderr.write("Skipping {0}, as {1} isn't installed.\n".format(name, BACKENDS[name].program))
+                continue
+            backend = BACKENDS[name]
+            started = time.time()
+            with open(os.devnull, "w") as log:
+                db = backend.build_db(fasta, "{0}/{1}.db".format(workdir, name), log)
+                cmd = backend.command(fasta, db, "{0}/{1}.tsv".format(workdir, name), max_evalue=max_evalue)
+                cmd[cmd.index(backend.threads_arg) + 1] = str(threads)
+                sp.check_call(cmd, stdout=log)
+            seconds = time.time() - started
+            with open("{0}/{1}.tsv".format(workdir, name)) as infile:
+                pairs = set(tuple(line.split("\t")[:2]) for line in infile if line.strip())
+            if reference is None:
+                reference = pairs
+            shared = len(pairs & reference)
+            rows.append((name, seconds, queries / seconds, len(pairs), shared / len(pairs) if pairs else 1.0,
+                         shared / len(reference) if reference else 1.0))
+    finally:
+        shutil.rmtree(workdir)
+    lines = ["{0:<10}{1:>12}{2:>14}{3:>10}{4:>12}{5:>10}\n".format("backend", "seconds", "queries/s", "pairs",
+                                                                  "precision", "recall")]
+    for row in rows:
+        lines.append("{0:<10}{1:>12.2f}{2:>14.1f}{3:>10}{4:>12.3f}{5:>10.3f}\n".format(*row))
+    return "".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Built-in protein search, and benchmarks of search backends.")
+    commands = parser.add_subparsers(dest="command")
+    searcher = commands.add_parser("search", help="Search proteins with the built-in aligner (tabular output).")
+    searcher.add_argument("query", help="FASTA file of query proteins.")
+    searcher.add_argument("db", help="FASTA file of subject proteins.")
+    searcher.add_argument("--out", default="-", help="Output file (default: stdout).")
+    searcher.add_argument("--fields", default=",".join(TABULAR), help="Comma-separated output columns.")
+    searcher.add_argument("--evalue", type=float, default=1e-4, help="Maximum e-value (default: 0.0001).")
+    searcher.add_argument("--dbsize", type=int, help="Effective database size in residues (default: db's size).")
+    searcher.add_argument("--max-targets", type=int, default=500, help="Most hits per query (default: 500).")
+    searcher.add_argument("--band", type=int, help="Only align within this many diagonals of the main diagonal.")
+    searcher.add_argument("--threads", type=int, default=1, help="Number of processes (default: 1).")
+    benchmarker = commands.add_parser("benchmark", help="Compare installed backends on an all-vs.-all search.")
+    benchmarker.add_argument("fasta", help="FASTA file of proteins.")
+    benchmarker.add_argument("--backends", default="blastp,diamond,mmseqs,numpy",
+                             help="Comma-separated backends, the first installed one being the reference.")
+    benchmarker.add_argument("--evalue", type=float, default=1e-4, help="Maximum e-value (default: 0.0001).")
+    benchmarker.add_argument("--threads", type=int, default=1, help="Threads per backend (default: 1).")
+    args = parser.parse_args()
+    if args.command == "search":
+        search(args.query, args.db, args.out, args.fields.split(","), args.evalue, args.dbsize, args.max_targets,
+               args.band, args.threads)
+    else:
+        sys.stdout.write(benchmark(args.fasta, args.backends.split(","), args.evalue, args.threads))
@@ -0,0 +1,268 @@
+"""
+Vectorised nucleotide/protein encoding and translation using NumPy.
+
+Sequences are encoded as uint8 arrays of small integer codes so that
+translation, reverse complementing and k-mer extraction can be done with
+array operations rather than per-character Python loops.
+
+Nucleotide codes: A=0, C=1, G=2, T=3, anything else=4.
+Amino acid codes: index into AMINO_ACIDS, where "*" is a stop and "X" is unknown.
+
+MappedGenome gives random access to the contigs of a FASTA file through a
+memory map, so gene sequences can be spliced out without reading the whole
+genome into memory. RecordIndex holds compact per-record arrays (ID, score,
+length, byte offset) of a FASTA file, so records can be filtered with array
+masks and copied by offset without parsing them into SeqRecords.
+"""
+
+import mmap
+import os
+import re
+
+import numpy as np
+
+from Bio.Data import CodonTable
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY*X"
+STOP = AMINO_ACIDS.index("*")
+UNKNOWN = AMINO_ACIDS.index("X")
+
+_NT_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    _NT_CODES[ord(_base)] = _code
+    _NT_CODES[ord(_base.lower())] = _code
+
+_AA_CODES = np.full(256, UNKNOWN, dtype=np.uint8)
+for _code, _residue in enumerate(AMINO_ACIDS):
+    _AA_CODES[ord(_residue)] = _code
+    _AA_CODES[ord(_residue.lower())] = _code
+
+_COMPLEMENT = np.array([3, 2, 1, 0, 4], dtype=np.uint8)
+
+
+def _codon_table(table_id=1):
+    """
+    Build a lookup array of amino acid codes for all 64 codons (index = 16a + 4b + c).
+    """
+    table = CodonTable.unambiguous_dna_by_id[table_id]
+    lookup = np.full(64, UNKNOWN, dtype=np.uint8)
+    for a, first in enumerate("ACGT"):
+        for b, second in enumerate("ACGT"):
+            for c, third in enumerate("ACGT"):
+                codon = first + second + third
+                if codon in table.stop_codons:
+                    lookup[16 * a + 4 * b + c] = STOP
+                else:
+                    lookup[16 * a + 4 * b + c] = AMINO_ACIDS.index(table.forward_table[codon])
+    return lookup
+
+
+CODONS = _codon_table()
+
+
+def encode_nucleotides(seq):
+    """
+    Encode a nucleotide string as an array of nucleotide codes.
+    """
+    return _NT_CODES[np.frombuffer(str(seq), dtype=np.uint8)]
+
+
+def encode_protein(seq):
+    """
+    Encode a protein string as an array of amino acid codes.
+    """
+    return _AA_CODES[np.frombuffer(str(seq), dtype=np.uint8)]
+
+
+def decode_protein(codes):
+    """
+    Decode an array of amino acid codes back into a protein string.
+    """
+    return np.frombuffer(AMINO_ACIDS, dtype=np.uint8)[codes].tostring()
+
+
+def reverse_complement(codes):
+    """
+    Reverse complement an array of nucleotide codes.
+    """
+    return _COMPLEMENT[codes[::-1]]
+
+
+def translate(codes):
+    """
+    Translate an array of nucleotide codes in frame, ignoring any trailing partial codon.
+
+    Codons containing ambiguous bases are translated as unknown ("X").
+    """
+    length = (len(codes) // 3) * 3
+    codons = codes[:length].reshape(-1, 3).astype(np.int16)
+    translated = CODONS[np.minimum(16 * codons[:, 0] + 4 * codons[:, 1] + codons[:, 2], 63)]
+    translated[(codons > 3).any(axis=1)] = UNKNOWN
+    return translated
+
+
+def six_frames(codes):
+    """
+    Yield (strand, frame, translation) for all six reading frames of a sequence.
+
+    Reverse strand translations are of the reverse complement, so amino acid i
+    of frame f on the reverse strand starts at nucleotide len - f - 3 * i - 3 in
+    forward co-ordinates.
+    """
+    reverse = reverse_complement(codes)
+    for strand, strand_codes in (("+", codes), ("-", reverse)):
+        for frame in range(3):
+            yield strand, frame, translate(strand_codes[frame:])
+
+
+def translate_exons(genome, contig, exons, reverse=False, phase=0):
+    """
+    Splice a gene's coding exons out of a MappedGenome and translate them.
+
+    Exons are (start, end) tuples in 0-based, end-exclusive forward co-ordinates,
+    in ascending order. Reverse strand genes are reverse complemented after
+    splicing. phase is the number of bases to skip at the start of the coding
+    sequence (in transcription order), for genes that are partial at their
+    5' end. A trailing stop codon is removed.
+    """
+    codes = encode_nucleotides("".join(genome.fetch(contig, start, end) for start, end in exons))
+    if reverse:
+        codes = reverse_complement(codes)
+    return decode_protein(translate(codes[phase:])).rstrip("*")
+
+
+class MappedGenome:
+    """
+    Random access to the contigs of a (multi-line) FASTA file via a memory map.
+    """
+
+    def __init__(self, fasta):
+        """
+        Map the genome and index where every sequence line of every contig starts.
+
+        - contigs: Dictionary of contig ID (first word of the header) to a tuple
+                   of (byte offset of each line, number of bases before each line).
+
+        Lines don't need to be of equal length, and only the index (roughly two
+        integers per line) is held in memory. An empty file has no contigs (and no map, as
+        empty files can't be mapped).
+        """
+        self.contigs = {}
+        self._file = self._map = None
+        if os.path.getsize(fasta) == 0:
+            return
+        self._file = open(fasta, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = np.frombuffer(self._map, dtype=np.uint8)
+        newlines = np.flatnonzero(data == ord("\n"))
+        starts = np.append(0, newlines + 1)
+        ends = np.append(newlines, len(data))
+        ends = ends - ((ends > starts) & (data[np.maximum(ends - 1, 0)] == ord("\r")))
+        headers = np.flatnonzero((starts < len(data)) & (data[np.minimum(starts, len(data) - 1)] == ord(">")))
+        for index, header in enumerate(headers):
+            contig_id = self._map[starts[header] + 1:ends[header]].split()[0]
+            last = headers[index + 1] if index + 1 < len(headers) else len(starts)
+            lines = np.arange(header + 1, last)
+            self.contigs[contig_id] = (starts[lines], np.append(0, np.cumsum(ends[lines] - starts[lines])))
+
+    def length(self, contig):
+        """
+        Return the length of a contig.
+        """
+        return int(self.contigs[contig][1][-1])
+
+    def fetch(self, contig, start, end):
+        """
+        Return the sequence of a contig from start to end (0-based, end-exclusive).
+        """
+        offsets, bases = self.contigs[contig]
+        first = np.searchsorted(bases, start, side="right") - 1
+        last = np.searchsorted(bases, end, side="left")
+        pieces = []
+        for line in range(max(first, 0), min(last, len(offsets))):
+            left = max(start, bases[line]) - bases[line]
+            right = min(end, bases[line + 1]) - bases[line]
+            pieces.append(self._map[offsets[line] + left:offsets[line] + right])
+        return "".join(pieces)
+
+    def sequence(self, contig):
+        """
+        Return the whole sequence of a contig (or any other FASTA record, e.g. a protein).
+        """
+        return self.fetch(contig, 0, self.length(contig))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+
+
+class RecordIndex:
+    """
+    Compact arrays describing the records of a FASTA file, built in one streaming pass.
+    """
+
+    def __init__(self, ids, scores, lengths, offsets, sizes):
+        """
+        - ids:     Record IDs (first word of each header).
+        - scores:  Score parsed from each header's description (NaN if missing).
+        - lengths: Sequence length of each record.
+        - offsets: Byte offset of each record's header line.
+        - sizes:   Size in bytes of each record (header and sequence lines).
+        """
+        self.ids = ids
+        self.scores = scores
+        self.lengths = lengths
+        self.offsets = offsets
+        self.sizes = sizes
+
+    @classmethod
+    def build(cls, fasta, score_pattern=r"score=([^\s,]+)"):
+        """
+        Index a FASTA file, parsing scores from headers with score_pattern (e.g. TransDecoder's score=).
+        """
+        score_regex = re.compile(score_pattern)
+        ids, scores, lengths, offsets = [], [], [], []
+        position = 0
+        with open(fasta, "rb") as infile:
+            for line in infile:
+                if line.startswith(">"):
+                    header = line[1:].strip().split(None, 1)
+                    match = score_regex.search(header[1]) if len(header) > 1 else None
+                    ids.append(header[0] if header else "")
+                    scores.append(float(match.group(1)) if match else np.nan)
+                    lengths.append(0)
+                    offsets.append(position)
+                elif lengths:
+                    lengths[-1] = lengths[-1] + len(line.strip())
+                position = position + len(line)
+        offsets = np.array(offsets, dtype=np.int64)
+        return cls(np.array(ids, dtype=str), np.array(scores, dtype=np.float64),
+                   np.array(lengths, dtype=np.int64), offsets, np.diff(np.append(offsets, position)))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a RecordIndex saved with save.
+        """
+        data = np.load(path)
+        try:
+            return cls(data["ids"], data["scores"], data["lengths"], data["offsets"], data["sizes"])
+        finally:
+            data.close()
+
+    def save(self, path):
+        """
+        Save the index to an (uncompressed) .npz file.
+        """
+        np.savez(path, ids=self.ids, scores=self.scores, lengths=self.lengths, offsets=self.offsets,
+                 sizes=self.sizes)
+
+    def copy_records(self, fasta, mask, outfile):
+        """
+        Copy the records selected by a boolean mask from the indexed FASTA file, byte for byte.
+        """
+        with open(fasta, "rb") as infile:
+            for offset, size in zip(self.offsets[mask].tolist(), self.sizes[mask].tolist()):
+                infile.seek(offset)
+                outfile.write(infile.read(size))
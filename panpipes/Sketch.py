@@ -0,0 +1,156 @@
+"""
+MinHash sketches of protein k-mers, and banded LSH to find candidate homologs.
+
+All-vs.-all BLASTp of every noncore protein is quadratic, but most pairs of
+proteins share no homology. Each protein is reduced to a MinHash sketch (the
+minimum of num_hashes hash functions over its set of k-mers), so that the
+fraction of equal sketch entries estimates the Jaccard similarity of two
+proteins' k-mer sets. Sketches are then split into bands of rows; proteins
+with an identical band land in the same bucket, which finds pairs above a
+similarity threshold without comparing every pair. Candidate pairs whose
+sketches are similar enough are joined into blocks (connected components),
+and only proteins within the same block need to be BLASTed against each
+other.
+
+The default 4-mers are rare enough (160,000 possible) that unrelated
+proteins share almost none, which keeps unrelated families from being
+chained into one block.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+MERSENNE_PRIME = (1 << 31) - 1
+EMPTY = np.iinfo(np.uint32).max  # Sketch value of proteins without any k-mers.
+
+_codes = np.full(256, -1, dtype=np.int64)
+_codes[np.frombuffer(AMINO_ACIDS, dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+
+
+def kmer_codes(sequence, k=4):
+    """
+    Return the distinct k-mers of a protein sequence as integers, skipping k-mers with ambiguous residues.
+    """
+    residues = _codes[np.frombuffer(str(sequence).upper(), dtype=np.uint8)]
+    if len(residues) < k:
+        return np.zeros(0, dtype=np.int64)
+    windows = np.lib.stride_tricks.as_strided(residues, shape=(len(residues) - k + 1, k),
+                                              strides=(residues.strides[0], residues.strides[0]))
+    valid = (windows >= 0).all(axis=1)
+    return np.unique(windows[valid].dot(len(AMINO_ACIDS) ** np.arange(k - 1, -1, -1)))
+
+
+class MinHash:
+    """
+    MinHash sketcher for protein sequences, using universal hashes (a * x + b) mod (2^31 - 1).
+    """
+
+    def __init__(self, num_hashes=128, k=4, seed=0):
+        random = np.random.RandomState(seed)
+        self.num_hashes = num_hashes
+        self.k = k
+        self.a = random.randint(1, MERSENNE_PRIME, size=num_hashes).astype(np.int64)
+        self.b = random.randint(0, MERSENNE_PRIME, size=num_hashes).astype(np.int64)
+
+    def sketch(self, sequence):
+        """
+        Return the sketch of one sequence (uint32, num_hashes values; all EMPTY if it has no k-mers).
+        """
+        kmers = kmer_codes(sequence, self.k)
+        if not len(kmers):
+            return np.full(self.num_hashes, EMPTY, dtype=np.uint32)
+        return ((self.a[:, None] * kmers[None, :] + self.b[:, None]) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+    def sketch_all(self, sequences):
+        """
+        Return a (sequences x num_hashes) matrix of sketches.
+        """
+        sketches = np.empty((len(sequences), self.num_hashes), dtype=np.uint32)
+        for index, sequence in enumerate(sequences):
+            sketches[index] = self.sketch(sequence)
+        return sketches
+
+
+def similarity(sketch, other):
+    """
+    Estimate the Jaccard similarity of two sequences' k-mer sets from their sketches.
+    """
+    return np.mean(sketch == other)
+
+
+def lsh_bands(num_hashes, threshold):
+    """
+    Return (bands, rows) whose LSH threshold, (1 / bands) ** (1 / rows), is closest to threshold.
+
+    Pairs more similar than the threshold are likely to share a bucket in at least one band.
+    """
+    options = [(num_hashes // rows, rows) for rows in range(1, num_hashes + 1) if num_hashes // rows]
+    return min(options, key=lambda option: abs((1 / option[0]) ** (1 / option[1]) - threshold))
+
+
+def band_buckets(sketches, bands, rows):
+    """
+    Yield, for each band, the sorted order of proteins by bucket and the bucket boundaries.
+
+    Proteins without k-mers are left out, as their sketches are all equal.
+    """
+    present = np.flatnonzero((sketches != EMPTY).any(axis=1))
+    for band in range(bands):
+        keys = np.ascontiguousarray(sketches[present, band * rows:(band + 1) * rows])
+        keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * rows))).ravel()
+        _, buckets = np.unique(keys, return_inverse=True)
+        order = np.argsort(buckets, kind="mergesort")
+        bounds = np.flatnonzero(np.diff(buckets[order])) + 1
+        yield present[order], np.concatenate([[0], bounds, [len(order)]])
+
+
+def candidate_pairs(sketches, bands, rows, threshold):
+    """
+    Return the pairs of proteins (an array of (i, j) rows, i < j) that share an LSH bucket in any band,
+    and whose sketches' estimated similarity is at least threshold.
+    """
+    found = []
+    for members, bounds in band_buckets(sketches, bands, rows):
+        buckets = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+        # Pair each member with the members offset places after it in the same bucket.
+        for offset in range(1, int(np.diff(bounds).max()) if len(members) else 1):
+            same = np.flatnonzero(buckets[offset:] == buckets[:-offset])
+            found.append(np.column_stack((members[same], members[same + offset])))
+    if not found:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(found), axis=1)
+    pairs = np.unique(pairs[:, 0] * len(sketches) + pairs[:, 1])
+    pairs = np.column_stack((pairs // len(sketches), pairs % len(sketches)))
+    estimates = (sketches[pairs[:, 0]] == sketches[pairs[:, 1]]).mean(axis=1)
+    return pairs[estimates >= threshold]
+
+
+def candidate_blocks(sketches, bands, rows, threshold):
+    """
+    Group proteins into blocks of candidate homologs: connected components of candidate_pairs.
+
+    Returns (list of index arrays for blocks of two or more proteins, number of candidate pairs).
+    """
+    pairs = candidate_pairs(sketches, bands, rows, threshold)
+    labels = connected_labels(len(sketches), pairs[:, 0], pairs[:, 1])
+    order = np.argsort(labels, kind="mergesort")
+    blocks = np.split(order, np.flatnonzero(np.diff(labels[order])) + 1)
+    return [block for block in blocks if len(block) > 1], len(pairs)
+
+
+def connected_labels(count, sources, targets):
+    """
+    Label each of count nodes with the smallest node index in its connected component.
+    """
+    labels = np.arange(count)
+    while True:
+        lowest = np.minimum(labels[sources], labels[targets])
+        updated = labels.copy()
+        np.minimum.at(updated, sources, lowest)
+        np.minimum.at(updated, targets, lowest)
+        updated = updated[updated]  # Pointer jumping, to converge in few rounds.
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
@@ -0,0 +1,103 @@
+"""
+Two-dimensional tiling of exonerate searches: protein batches x contig shards.
+
+For large, fragmented assemblies a single protein-vs.-genome exonerate job can
+run for a long time, and jobs can't be split any finer than one protein. Here
+the genome is split into contig shards of roughly equal total length and the
+reference proteins into batches, and each (batch, shard) tile is run as a
+separate exonerate job. Results are merged per protein by keeping the best
+scoring alignment across shards, which is what --bestn 1 would have reported
+for the whole genome.
+"""
+
+import cStringIO
+import heapq
+from glob import glob
+
+from Bio import SeqIO
+from ExonerateGene import ExonerateGene
+
+
+def shard_genome(genome, shards, outdir):
+    """
+    Split a genome into FASTA files of contigs with balanced total lengths.
+
+    Contigs are assigned longest first to whichever shard currently has the
+    smallest total length. Contigs are never split, so co-ordinates reported
+    against a shard are the same as against the whole genome.
+    """
+    lengths = [(len(seq), seq.id) for seq in SeqIO.parse(genome, "fasta")]
+    shards = max(1, min(shards, len(lengths)))
+    bins = [(0, index) for index in range(shards)]
+    assignment = {}
+    for length, contig in sorted(lengths, reverse=True):
+        total, index = heapq.heappop(bins)
+        assignment[contig] = index
+        heapq.heappush(bins, (total + length, index))
+    handles = [open("{0}/shard{1}.fna".format(outdir, index), "w") for index in range(shards)]
+    for seq in SeqIO.parse(genome, "fasta"):
+        SeqIO.write(seq, handles[assignment[seq.id]], "fasta")
+    for handle in handles:
+        handle.close()
+    return [handle.name for handle in handles]
+
+
+def batch_proteins(protein_dir, batch_size, outdir):
+    """
+    Concatenate single-protein FASTA files from a protein bin into batches.
+    """
+    batches = []
+    prots = sorted(glob("{0}/*.faa".format(protein_dir)))
+    for start in range(0, len(prots), batch_size):
+        batch = "{0}/batch{1}.faa".format(outdir, len(batches) + 1)
+        with open(batch, "w") as outfile:
+            for prot in prots[start:start + batch_size]:
+                with open(prot) as infile:
+                    outfile.write(infile.read())
+        batches.append(batch)
+    return batches
+
+
+def split_alignments(output):
+    """
+    Split exonerate output into a list of single alignment blocks.
+
+    Each block runs from its "C4 Alignment:" line to its vulgar line, and is
+    terminated as if it were the only result in the run.
+    """
+    blocks = []
+    block = []
+    for line in output.splitlines(True):
+        if line.startswith("C4 Alignment:"):
+            block = [line]
+        elif block:
+            block.append(line)
+            if line.startswith("vulgar"):
+                block.append("-- completed exonerate analysis\n")
+                blocks.append("".join(block))
+                block = []
+    return blocks
+
+
+def parse_exonerate_tile(output):
+    """
+    Return exonerate output for a tile as a list of ExonerateGene objects.
+
+    A tile can contain many proteins, so there is one ExonerateGene object per
+    protein with a hit in the tile's contig shard.
+    """
+    return [ExonerateGene(cStringIO.StringIO(block)) for block in split_alignments(output)]
+
+
+def best_tile_hits(tile_results):
+    """
+    Merge per-tile results, keeping the best-scoring alignment per protein.
+
+    Ties are broken by shard order, i.e. the first tile with the best score wins.
+    """
+    best = {}
+    for genes in tile_results:
+        for gene in genes or []:  # Tiles without results (i.e. dropped jobs) are None.
+            if gene.ref not in best or gene.score > best[gene.ref].score:
+                best[gene.ref] = gene
+    return best.values()
@@ -7,13 +7,15 @@ Functions imported explictly via "from panpipes.Tools import <name>".
 from __future__ import division
 
 import cStringIO
-import subprocess as sp
+import hashlib
 
 from difflib import SequenceMatcher
 from itertools import chain, izip_longest, tee
 
 from Bio import SeqIO
+from Compression import indexable
 from ExonerateGene import ExonerateGene
+from Profiling import stage
 
 def pairwise(iterable):
     """
@@ -48,12 +50,48 @@ def get_gene_lengths(fasta):
     Generate dictionary of sequence length for a given SeqIO.index.
     """
     ref_lengths = {}
-    db = SeqIO.index(fasta, "fasta")
+    db = SeqIO.index(indexable(fasta), "fasta")
     for seq in db:
         ref_lengths[db[seq].id] = len(db[seq].seq)
     return ref_lengths
 
 
+def file_checksum(path, blocksize=1 << 20):
+    """
+    Return the MD5 hex digest of a file, read in blocks to keep memory low.
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(blocksize), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def unique_records(records, key=None):
+    """
+    Yield SeqRecords whose key (default: ID) hasn't been seen before, as they stream past.
+
+    Only a 16-byte MD5 digest of each key is kept, in a set, so checks are
+    constant time and no records are held in memory.
+    """
+    seen = set()
+    for record in records:
+        digest = hashlib.md5(key(record) if key else record.id).digest()
+        if digest not in seen:
+            seen.add(digest)
+            yield record
+
+
+def locus_sequence_key(record):
+    """
+    Key a protein by locus (its ID without the strain tag, i.e. contig_start_stop) and sequence.
+
+    Used with unique_records to collapse identical sequences called at identical
+    loci, even if their IDs were given different tags.
+    """
+    return "{0}\t{1}".format(record.id.split("|")[-1], record.seq)
+
+
 def flatten(iterable):
     """
     Flatten a list of lists, essential for ClusterClean and GapFinder.
@@ -185,23 +223,6 @@ def query_top_hit(cluster_members, strain_list, blast_hits, size, strain_cutoff)
     return top
 
 
-def exonerate_first_hits(instream):
-    """
-    Return first exonerate hit per protein-vs.-genome analysis.
-    """
-    first_align = False
-    block = []
-    for line in instream:
-        if not first_align:
-            block.append(line)
-            if line.startswith("vulgar"):
-                first_align = True
-        if "completed exonerate analysis" in line:
-            block.append(line)
-            first_align = False
-    return block
-
-
 def gene_within(left_end, right_end, query_coords):
     """
     Check overlap of co-ordinates of exonerate gene within known gene.
@@ -230,9 +251,9 @@ def gene_overlap(left_gene, right_gene, query_coords, threshold=0):
     return overlap
 
 
-def exoneratecmdline(cmd):
+def parse_exonerate(output):
     """
-    Carry out an exonerate command and return output as a ExonerateGene object.
+    Return exonerate output as a ExonerateGene object.
 
     If an exonerate command does not find a suitable homolog to the query gene
     within the target genome (which is fine!), then the output will fail to be
@@ -240,9 +261,77 @@ def exoneratecmdline(cmd):
     no information to make an object from). As such, the contains check makes
     sure only full exonerate hits are returned.
     """
-    print "Running {0}".format(" ".join(cmd))
-    process = sp.check_output(cmd)
-    if "C4 Alignment:" in process:  # Empty results don't contain this line!
-        return ExonerateGene(cStringIO.StringIO(process))
+    if "C4 Alignment:" in output:  # Empty results don't contain this line!
+        with stage("exonerate_parsing"):
+            return ExonerateGene(cStringIO.StringIO(output))
     else:
         pass
+
+
+class ExonerateFirstHit:
+    """
+    Streaming reader that keeps only the first alignment of an exonerate run.
+
+    Follows the feed/result interface of Jobs.OutputCollector: output is fed in
+    as it arrives, and feed returns True as soon as the first complete
+    alignment block (from its "C4 Alignment:" line to its vulgar line) has
+    been read, or the run has completed without a hit, so the job can be
+    stopped without reading the rest of its output. Nothing before the first
+    alignment is kept.
+    """
+
+    def __init__(self, parse=None):
+        self.parse = parse or parse_exonerate
+        self.partial = ""
+        self.block = []
+        self.done = False
+
+    def feed(self, data):
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            if line.startswith("C4 Alignment:"):
+                self.block = [line]
+            elif self.block:
+                self.block.append(line)
+                if line.startswith("vulgar"):
+                    self.block.append("-- completed exonerate analysis")
+                    self.done = True
+                    return True
+            elif "completed exonerate analysis" in line:
+                self.done = True  # No hit.
+                return True
+        return False
+
+    def result(self):
+        if self.block and self.block[-1].startswith("-- completed"):
+            return self.parse("\n".join(self.block) + "\n")
+
+
+class BlastLengthMatches:
+    """
+    Streaming reader of tabular BLAST output ("6 qseqid sseqid qlen slen") for run_jobs.
+
+    Collects the IDs of queries with a hit whose length ratio (shorter / longer)
+    is at least min_ratio, as lines arrive, without keeping the output itself.
+    """
+
+    def __init__(self, min_ratio=0.7):
+        self.min_ratio = min_ratio
+        self.partial = ""
+        self.matches = set()
+
+    def feed(self, data):
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            fields = line.split("\t")
+            if len(fields) >= 4:
+                lengths = (int(fields[2]), int(fields[3]))
+                if min(lengths) / max(lengths) >= self.min_ratio:
+                    self.matches.add(fields[0])
+        return False
+
+    def result(self):
+        self.feed("\n")
+        return self.matches
@@ -0,0 +1,204 @@
+"""
+A work queue held in lock files on a shared filesystem.
+
+Lets several workers (e.g. the tasks of a PBS array job, or plain processes
+on several hosts sharing a working directory) split a list of items, such as
+the genomes to predict genes for, without any service beyond the filesystem.
+For each item the queue directory can hold:
+
+    <item>.claim    Created atomically (O_CREAT | O_EXCL) by the worker that
+                    claims the item, and touched by it every lease / 4 seconds.
+    <item>.done     Written once the item is complete.
+    <item>.failed   One line per failed attempt.
+
+A claim whose file hasn't been touched for a whole lease belongs to a worker
+that died, so the item can be claimed again. Items that fail are retried (by
+any worker) until they have failed max_attempts times.
+"""
+
+from __future__ import division
+
+import errno
+import os
+import socket
+import threading
+import time
+
+
+class WorkQueue:
+    """
+    Lock-file work queue in a directory on a shared filesystem.
+    """
+
+    def __init__(self, directory, lease=600, max_attempts=3, poll=30):
+        """
+        - directory:    Queue directory, shared by all workers.
+        - lease:        Seconds after which an untouched claim is considered abandoned.
+        - max_attempts: Number of failed attempts after which an item is given up on.
+        - poll:         Seconds to wait before re-checking items claimed by other workers.
+        """
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.directory = directory
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll = poll
+        self.worker = "{0}_{1}".format(socket.gethostname(), os.getpid())
+        self._heartbeats = {}  # Claimed item: threading.Event stopping its heartbeat.
+
+    def path(self, item, state):
+        return os.path.join(self.directory, "{0}.{1}".format(item, state))
+
+    def done(self, item):
+        return os.path.isfile(self.path(item, "done"))
+
+    def failures(self, item):
+        """
+        Return the number of failed attempts at an item.
+        """
+        if not os.path.isfile(self.path(item, "failed")):
+            return 0
+        with open(self.path(item, "failed")) as infile:
+            return sum(1 for _ in infile)
+
+    def status(self, item):
+        """
+        Return "done", "failed" (given up on), "claimed" or "pending".
+        """
+        if self.done(item):
+            return "done"
+        elif self.failures(item) >= self.max_attempts:
+            return "failed"
+        elif os.path.isfile(self.path(item, "claim")):
+            return "claimed"
+        else:
+            return "pending"
+
+    def _expire(self, item):
+        """
+        Remove an item's claim if its lease has run out.
+        """
+        claim = self.path(item, "claim")
+        try:
+            if time.time() - os.path.getmtime(claim) <= self.lease:
+                return
+            # Rename first, so that only one worker removes it, then check it really was stale,
+            # in case its owner (or another worker) renewed it in the meantime.
+            stale = "{0}.{1}".format(claim, self.worker)
+            os.rename(claim, stale)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        if time.time() - os.path.getmtime(stale) <= self.lease:
+            try:
+                os.link(stale, claim)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        os.remove(stale)
+
+    def claim(self, item):
+        """
+        Try to claim an item, returning whether this worker now holds it.
+        """
+        if self.status(item) in ("done", "failed"):
+            return False
+        self._expire(item)
+        try:
+            fd = os.open(self.path(item, "claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        os.write(fd, "{0}\t{1}\n".format(self.worker, time.time()))
+        os.close(fd)
+        if self.done(item):  # Completed by another worker since we checked.
+            os.remove(self.path(item, "claim"))
+            return False
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(item, stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        self._heartbeats[item] = stop
+        return True
+
+    def _heartbeat(self, item, stop):
+        """
+        Renew the lease on a claimed item until stopped.
+        """
+        while not stop.wait(self.lease / 4):
+            try:
+                os.utime(self.path(item, "claim"), None)
+            except OSError:
+                pass
+
+    def release(self, item):
+        """
+        Give up a claimed item without completing it.
+        """
+        self._heartbeats.pop(item).set()
+        try:
+            os.remove(self.path(item, "claim"))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def complete(self, item):
+        """
+        Mark a claimed item as done and release it.
+        """
+        with open("{0}.{1}".format(self.path(item, "done"), self.worker), "w") as outfile:
+            outfile.write("{0}\t{1}\n".format(self.worker, time.time()))
+        os.rename("{0}.{1}".format(self.path(item, "done"), self.worker), self.path(item, "done"))
+        self.release(item)
+
+    def fail(self, item, message):
+        """
+        Record a failed attempt at a claimed item and release it for retrying.
+        """
+        with open(self.path(item, "failed"), "a") as outfile:
+            outfile.write("{0}\t{1}\t{2}\n".format(self.worker, time.time(), " ".join(message.split())))
+        self.release(item)
+
+    def claims(self, items):
+        """
+        Claim and yield items until every item is done or has been given up on.
+
+        The caller should complete or fail each item; items it doesn't are released.
+        Waits for items claimed by other workers, in case their workers die.
+        """
+        remaining = list(items)
+        while remaining:
+            claimed = False
+            for item in list(remaining):
+                if self.status(item) in ("done", "failed"):
+                    remaining.remove(item)
+                elif self.claim(item):
+                    claimed = True
+                    yield item
+                    if item in self._heartbeats:
+                        self.release(item)
+            if remaining and not claimed:
+                time.sleep(self.poll)
+
+    def run_once(self, item, function):
+        """
+        Run function once across all workers, waiting until whichever worker claims it has finished.
+        """
+        while not self.done(item):
+            if self.claim(item):
+                try:
+                    function()
+                except Exception as e:
+                    self.fail(item, str(e))
+                    raise
+                self.complete(item)
+            elif self.status(item) == "failed":
+                raise RuntimeError("{0} failed {1} times, see {2}.".format(item, self.max_attempts,
+                                                                           self.path(item, "failed")))
+            else:
+                time.sleep(self.poll)